@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from .persistence import configure_sqlite
+
+        # Tune SQLite connections as they are opened. The journal
+        # mode is set by the result writer and the job workers
+        connection_created.connect(configure_sqlite)
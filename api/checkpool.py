@@ -0,0 +1,145 @@
+""" Admission control for the async check endpoint
+
+Documents are fetched in a thread pool, so the event loop is not
+blocked on the network, and checked in a pool of pdfwamasyncworkers
+warm worker processes (see pdfpool). Requests are admitted up to the
+number of workers plus pdfwamasyncqueue waiting checks, and are
+turned away beyond that so they don't pile up. The counters are
+per server process.
+
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from api.pdf_checker import config
+from api.pdf_checker import helper
+from api.pdf_checker import pdffetch
+from api.pdf_checker import pdfpool
+
+class CheckPool(object):
+    """ Bounded pool checking PDF documents for async views """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        # Number of checks which can wait for a worker
+        self.queue_size = queue_size
+        self.logger = helper.get_logger()
+        # Created on first use. The threads of the
+        # executor wait for the workers of the pool
+        self.pool = None
+        self.executor = None
+        self.fetch_executor = None
+        self.lock = threading.Lock()
+        # Requests admitted and not finished
+        self.admitted = 0
+        # Documents being downloaded
+        self.fetching = 0
+        # Checks submitted to the workers and not finished
+        self.checking = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def capacity(self):
+        return self.workers + self.queue_size
+
+    def admit(self):
+        """ Admit a request if there is room for it, returning
+        whether it was. Admitted requests must be released """
+
+        with self.lock:
+            if self.admitted >= self.capacity():
+                self.rejected += 1
+                return False
+
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.admitted -= 1
+            self.completed += 1
+
+    def stats(self):
+        """ Return the queue depth and in-flight counts """
+
+        with self.lock:
+            stats = {'workers': self.workers,
+                     'queue_size': self.queue_size,
+                     'admitted': self.admitted,
+                     'fetching': self.fetching,
+                     'in_flight': min(self.checking, self.workers),
+                     'queued': max(self.checking - self.workers, 0),
+                     'rejected': self.rejected,
+                     'completed': self.completed}
+
+        if self.pool is not None:
+            stats['recycled'] = self.pool.stats()['recycled']
+
+        return stats
+
+    async def fetch(self, url):
+        """ Fetch the document at the URL without blocking the loop """
+
+        if self.fetch_executor is None:
+            self.fetch_executor = ThreadPoolExecutor(max_workers=int(config.pdfwamfetchpoolsize))
+
+        with self.lock:
+            self.fetching += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.fetch_executor, pdffetch.fetch, url)
+        finally:
+            with self.lock:
+                self.fetching -= 1
+
+    async def check(self, source, password=''):
+        """ Check the PDF document at the given path or URL,
+        or in the given stream, in a worker """
+
+        if self.pool is None:
+            self.pool = pdfpool.PdfWorkerPool(self.workers)
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        with self.lock:
+            self.checking += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.pool.check, source, password)
+        finally:
+            with self.lock:
+                self.checking -= 1
+
+    async def check_url(self, url, password=''):
+        """ Fetch and check the PDF document at the URL """
+
+        stream = await self.fetch(url)
+
+        # Lazy streams are read by the worker itself
+        if getattr(stream, 'lazy', False):
+            stream.close()
+            return await self.check(url, password)
+
+        try:
+            return await self.check_stream(stream, password)
+        finally:
+            stream.close()
+
+    async def check_stream(self, stream, password=''):
+        """ Check the PDF document in the given stream """
+
+        return await self.check(stream, password)
+
+# Pool of this process, created on first use
+pool = None
+
+def get_pool():
+    """ Return the pool configured by the pdfwamasync* settings """
+
+    global pool
+
+    if pool is None:
+        pool = CheckPool(int(config.pdfwamasyncworkers), int(config.pdfwamasyncqueue))
+
+    return pool
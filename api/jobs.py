@@ -0,0 +1,241 @@
+""" Queue of PDF checks kept in the database
+
+Jobs are rows of the Job model. Worker processes, started with
+'manage.py checkworkers', take the oldest queued job by switching
+its status from queued to running in a single UPDATE, so a job is
+only run by one worker, check it and save its result as a Logger
+row. Uploaded files are kept in pdfwamjobfolder till they are
+checked. Document passwords are kept encrypted with a key derived
+from SECRET_KEY, and cleared once the job is done or failed. While
+a job runs, its worker marks it as alive every pdfwamjobheartbeat
+seconds. Jobs not marked for pdfwamjobtimeout minutes, left running
+by a worker which died, are queued again, up to pdfwamjobattempts
+times. Workers exit after checking pdfwampoolmaxdocs documents or
+growing beyond pdfwampoolmaxrss MB, and are replaced like those
+which died. Checks are kept within the pdfwamtimelimit and
+pdfwammemorylimit budgets like in the worker pool, keeping partial
+results.
+
+"""
+
+import os
+import time
+import uuid
+import base64
+import hashlib
+import datetime
+import threading
+import multiprocessing
+
+from Crypto.Cipher import AES
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job, Logger, report_metrics
+from . import persistence
+from api.pdf_checker import config
+from api.pdf_checker import helper
+from api.pdf_checker import pdfpool
+from api.pdf_checker import pdfbudget
+
+def password_key():
+    """ Return the key encrypting the passwords of jobs """
+
+    return hashlib.sha256(b'pdfwam job password:' + settings.SECRET_KEY.encode('utf-8')).digest()
+
+def encrypt_password(password):
+    """ Return the password encrypted for a Job row """
+
+    if not password:
+        return ''
+
+    cipher = AES.new(password_key(), AES.MODE_GCM)
+    data, tag = cipher.encrypt_and_digest(password.encode('utf-8'))
+    return base64.b64encode(cipher.nonce + tag + data).decode('ascii')
+
+def decrypt_password(token):
+    """ Return the password encrypted by encrypt_password. Raises
+    ValueError if it can't be decrypted, like after SECRET_KEY
+    was changed """
+
+    if not token:
+        return ''
+
+    raw = base64.b64decode(token)
+    cipher = AES.new(password_key(), AES.MODE_GCM, nonce=raw[:16])
+    return cipher.decrypt_and_verify(raw[32:], raw[16:32]).decode('utf-8')
+
+def enqueue(pdf_url='', pdf_file=None, password=''):
+    """ Queue a check of the PDF document at the given URL,
+    or of the given uploaded file, and return its Job """
+
+    path = ''
+    if pdf_file is not None:
+        os.makedirs(config.pdfwamjobfolder, exist_ok=True)
+        path = os.path.join(config.pdfwamjobfolder, uuid.uuid4().hex + '.pdf')
+        with open(path, 'wb') as f:
+            for chunk in pdf_file.chunks():
+                f.write(chunk)
+
+    return Job.objects.create(pdf_url=pdf_url or '', pdf_file=path, password=encrypt_password(password))
+
+def claim_job():
+    """ Take the oldest queued job, marking it as running,
+    and return it. Returns None if the queue is empty """
+
+    while True:
+        job_id = Job.objects.filter(status=Job.QUEUED).order_by('id').values_list('id', flat=True).first()
+        if job_id is None:
+            return None
+
+        # Another worker may have taken it meanwhile
+        now = timezone.now()
+        if Job.objects.filter(id=job_id, status=Job.QUEUED).update(status=Job.RUNNING,
+                                                                   started_at=now,
+                                                                   heartbeat_at=now,
+                                                                   attempts=F('attempts') + 1):
+            return Job.objects.get(id=job_id)
+
+def heartbeat(job_id, stop):
+    """ Mark the running job with the given id as alive every
+    pdfwamjobheartbeat seconds, till stop is set """
+
+    logger = helper.get_logger()
+
+    try:
+        while not stop.wait(float(config.pdfwamjobheartbeat)):
+            try:
+                Job.objects.filter(id=job_id, status=Job.RUNNING).update(heartbeat_at=timezone.now())
+            except Exception as e:
+                logger.error('Job %d: could not mark it as alive: %s' % (job_id, str(e)))
+    finally:
+        # The connection of this thread
+        connections.close_all()
+
+def requeue_stale():
+    """ Queue again the running jobs whose worker did not mark them
+    as alive for pdfwamjobtimeout minutes, or fail them if they were
+    tried pdfwamjobattempts times. Jobs whose worker is alive are
+    left running, however long their check takes """
+
+    limit = timezone.now() - datetime.timedelta(minutes=float(config.pdfwamjobtimeout))
+    stale = Job.objects.filter(status=Job.RUNNING, heartbeat_at__lt=limit)
+
+    stale.filter(attempts__gte=int(config.pdfwamjobattempts)).update(status=Job.FAILED,
+                                                                      error='Check did not finish',
+                                                                      password='',
+                                                                      finished_at=timezone.now())
+    return stale.update(status=Job.QUEUED, started_at=None, heartbeat_at=None)
+
+def run_job(job):
+    """ Check the document of the job and save the result. Returns
+    whether the check ran out of its budget """
+
+    logger = helper.get_logger()
+    over = False
+
+    stop = threading.Event()
+    thread = threading.Thread(target=heartbeat, args=(job.id, stop), name='Heartbeat', daemon=True)
+    thread.start()
+
+    try:
+        start = time.time()
+        try:
+            password = decrypt_password(job.password)
+        except ValueError:
+            kind, value = 'error', 'The password of the job could not be decrypted'
+        else:
+            kind, value, over = pdfpool.check_budgeted(job.pdf_url or job.pdf_file, password,
+                                                       float(config.pdfwamtimelimit),
+                                                       float(config.pdfwammemorylimit))
+        if kind == 'error':
+            logger.error('Job %d failed: %s' % (job.id, str(value)))
+            job.status = Job.FAILED
+            job.error = str(value)
+        else:
+            # Partial results are saved too
+            job.logger = Logger.objects.create(pdf_url=job.pdf_url or "Uploaded file",
+                                               accessibility_report=value,
+                                               **report_metrics(value, time.time() - start))
+            job.status = Job.DONE
+            if over:
+                job.error = 'Check cut short, %s budget exceeded' % value['budget']
+    except Exception as e:
+        logger.error('Job %d failed: %s' % (job.id, str(e)))
+        job.status = Job.FAILED
+        job.error = str(e)
+
+    stop.set()
+    thread.join()
+
+    if job.pdf_file:
+        try:
+            os.remove(job.pdf_file)
+        except OSError:
+            pass
+
+    # The password is not needed anymore
+    job.password = ''
+    job.finished_at = timezone.now()
+    job.save()
+
+    return over
+
+def work(poll=None):
+    """ Run queued jobs till the worker should be recycled, polling
+    the queue every poll seconds (default pdfwamjobpoll) when it
+    is empty """
+
+    if poll is None:
+        poll = float(config.pdfwamjobpoll)
+
+    pdfbudget.set_memory_limit(float(config.pdfwammemorylimit))
+
+    ndocs = 0
+    while not pdfpool.should_recycle(ndocs):
+        job = claim_job()
+        if job is None:
+            time.sleep(poll)
+            continue
+
+        # Workers which ran out of a budget may be
+        # left in a bad state, and are recycled
+        if run_job(job):
+            break
+        ndocs += 1
+
+def run_workers(nworkers=None):
+    """ Run nworkers (default pdfwamjobworkers) worker processes
+    and wait for them """
+
+    if nworkers is None:
+        nworkers = int(config.pdfwamjobworkers)
+
+    workers = []
+    checked = 0
+
+    persistence.set_journal_mode()
+
+    try:
+        while True:
+            if time.time() - checked > 60:
+                requeue_stale()
+                # Connections can't be shared with the workers,
+                # so they are closed before starting them
+                connections.close_all()
+                checked = time.time()
+
+            # Start the workers, and new ones for those which
+            # died or were recycled
+            workers = [worker for worker in workers if worker.is_alive()]
+            while len(workers) < nworkers:
+                worker = multiprocessing.Process(target=work, daemon=True)
+                worker.start()
+                workers.append(worker)
+
+            time.sleep(1)
+    finally:
+        for worker in workers:
+            worker.terminate()
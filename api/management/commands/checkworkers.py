@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api import jobs
+
+class Command(BaseCommand):
+    help = 'Run worker processes checking the queued PDF documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (default pdfwamjobworkers)')
+
+    def handle(self, *args, **options):
+        try:
+            jobs.run_workers(options['workers'])
+        except KeyboardInterrupt:
+            pass
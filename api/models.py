@@ -1,16 +1,77 @@
 from django.db import models
 
+def report_metrics(accessibility_report, process_time=None):
+    """ Return the metric fields of a Logger for the given report """
+
+    document = accessibility_report.get('document', {})
+    summary = accessibility_report.get('summary', {})
+
+    return {'process_time': process_time,
+            'size': document.get('size'),
+            'pages': document.get('pages'),
+            'content_hash': document.get('hash'),
+            'total': summary.get('Total'),
+            'failed': summary.get('Fail'),
+            'passed': summary.get('Pass')}
+
 # Create your models here.
 class Logger(models.Model):
     pdf_url = models.CharField(max_length=500)
     accessibility_report = models.JSONField(default=dict)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     #ip = models.FloatField()
-    #process_time = models.FloatField()
-    #size = models.FloatField()
-    #pages = models.IntegerField()
+    # Metrics of the check, copied out of the report so they can
+    # be filtered and sorted on. Null for rows logged before them.
+    # Seconds
+    process_time = models.FloatField(null=True, blank=True, db_index=True)
+    # Bytes
+    size = models.BigIntegerField(null=True, blank=True, db_index=True)
+    pages = models.IntegerField(null=True, blank=True, db_index=True)
+    # SHA-256 of the document
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # Test totals of the report summary
+    total = models.IntegerField(null=True, blank=True, db_index=True)
+    failed = models.IntegerField(null=True, blank=True, db_index=True)
+    passed = models.IntegerField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+
+        return self.pdf_url
+
+class Job(models.Model):
+    """ A PDF check queued to be run by the check workers """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    pdf_url = models.CharField(max_length=500, blank=True)
+    # Path of the uploaded file, removed once checked
+    pdf_file = models.CharField(max_length=500, blank=True)
+    # Password of the document, encrypted (see jobs.encrypt_password)
+    # and cleared once the job is finished
+    password = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    # Number of times a worker took the job
+    attempts = models.IntegerField(default=0)
+    # The saved result
+    logger = models.ForeignKey(Logger, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Last time the worker running the job marked it as alive
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
 
-        return self.name
\ No newline at end of file
+        return 'Job %d (%s)' % (self.id, self.status)
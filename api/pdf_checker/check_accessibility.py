@@ -1,27 +1,30 @@
 # Function for API call
 from . import pdfAWAM
-import requests
-import io
+from . import pdffetch
 
 # Source is the PDF URL
 def check_accessibility(source, password='', verbose=False, report=False):
     """
     Returns the accessibility check result in JSON format.
-    Accepts a local file path or URL to a PDF.
+    Accepts a local file path or URL to a PDF, or a seekable
+    stream of the PDF which is left open for the caller.
     """
-    if source.startswith('http://') or source.startswith('https://'):
-        data = requests.get(source).content
-        stream = io.BytesIO(data)
+    if isinstance(source, str):
+        stream = pdffetch.open_source(source)
     else:
-        stream = open(source, 'rb')
+        stream = source
 
-    result = pdfAWAM.extractAWAMIndicators(
-        stream,
-        password,
-        verbose=verbose,
-        report=report,
-        json_value=True,
-        console=False
-    )
+    try:
+        result = pdfAWAM.extractAWAMIndicators(
+            stream,
+            password,
+            verbose=verbose,
+            report=report,
+            json_value=True,
+            console=False
+        )
+    finally:
+        if stream is not source:
+            stream.close()
 
     return result
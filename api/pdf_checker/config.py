@@ -4,9 +4,117 @@ pdfwamignoresinglebitimgs=0
 pdfwamurlcache=0
 pdfwamurlcachefolder='/tmp/pdfwam_cache/'
 pdfwamlogfile='logs/pdfwam.log'
+# TTL in hours of URL cache entries, after which
+# they are revalidated with the server.
 pdfwamurlcachettl=24
+# Maximum size in MB of the URL cache.
+pdfwamurlcachesize=500
+# Cache the reports of checked PDF files, keyed by their content.
+pdfwamresultcache=0
+pdfwamresultcachefolder='/tmp/pdfwam_cache/results/'
+# Maximum size in MB of the result cache.
+pdfwamresultcachesize=50
 # Maximum size in MB for a PDF file.
 pdfmaxsize=10
+# Size in MB up to which a downloaded PDF file is kept
+# in memory, larger ones are spooled to a temporary file.
+pdfwamspoolsize=1
+# Timeouts in seconds for connecting to and reading from
+# the server when downloading a PDF file.
+pdfwamconnecttimeout=10
+pdfwamreadtimeout=30
+# Maximum number of connections kept per host for downloading.
+pdfwamfetchpoolsize=10
+# Number of retries of failed downloads, with exponential
+# backoff starting at pdfwamfetchbackoff seconds.
+pdfwamfetchretries=3
+pdfwamfetchbackoff=0.5
+# Read large remote PDF files lazily with HTTP Range requests, for
+# documents from pdfwamrangeminsize up to pdfwamrangemaxsize MB.
+# pdfmaxsize still limits how much of a document is downloaded.
+pdfwamrangefetch=0
+pdfwamrangeminsize=4
+pdfwamrangemaxsize=1024
+# Size in KB of the blocks fetched, number of blocks fetched per
+# request and number of blocks cached for a document.
+pdfwamrangeblocksize=64
+pdfwamrangereadahead=4
+pdfwamrangecacheblocks=256
+# Maximum number of concurrent downloads when checking many
+# URLs, in total and per host.
+pdfwambulkconcurrency=16
+pdfwambulkperhost=4
+# Maximum number of documents checked at once, and in
+# total, by one request to the batch check API.
+pdfwambatchworkers=4
+pdfwambatchmaxitems=100
+# Default and maximum number of loggers per page listed
+# by the API.
+pdfwamlistsize=50
+pdfwamlistmaxsize=500
+# Number of worker processes running queued checks, and the
+# interval in seconds at which idle workers poll the queue.
+pdfwamjobworkers=2
+pdfwamjobpoll=1
+# Interval in seconds at which workers mark the job they run as
+# alive, minutes after which a running job not marked is taken to
+# be lost with its worker and queued again, and the number of times
+# a job is tried before it is failed.
+pdfwamjobheartbeat=60
+pdfwamjobtimeout=30
+pdfwamjobattempts=2
+# Folder keeping the uploaded files of queued jobs
+pdfwamjobfolder='/tmp/pdfwam_jobs/'
+# Number of worker processes checking documents for the async
+# check API, the number of checks which can wait for them, and
+# the seconds clients are told to wait when both are taken.
+pdfwamasyncworkers=2
+pdfwamasyncqueue=8
+pdfwamasyncretryafter=5
+# Whether to check documents in a pool of pdfwampoolworkers warm
+# worker processes, from the API and the command line.
+pdfwampool=0
+pdfwampoolworkers=2
+# Workers, also of the job queue, are replaced after checking
+# this many documents or growing beyond this many MB of memory
+# (0 for no limit).
+pdfwampoolmaxdocs=100
+pdfwampoolmaxrss=1024
+# Seconds and MB of address space a check in a worker
+# process may take (0 for no limit). Checks running out of
+# them return the results of the tests which were finished.
+pdfwamtimelimit=0
+pdfwammemorylimit=0
+# SQLite journal mode, switched to by the server and the job
+# workers, synchronous level of each connection (FULL also keeps
+# the last commits through a power loss, NORMAL only through a
+# crash of the server), milliseconds to wait for a locked
+# database and MB of page cache per connection.
+pdfwamdbjournal='WAL'
+pdfwamdbsynchronous='NORMAL'
+pdfwamdbbusytimeout=5000
+pdfwamdbcachesize=16
+# Results are saved by a background writer in batches of up
+# to this many, waiting this many seconds for a batch to fill.
+pdfwamdbbatchsize=100
+pdfwamdbflushinterval=0.05
+# Whether requests wait for their results to be committed. If
+# not, results still queued when the server stops are lost.
+pdfwamdbwait=1
+# Size in KB of the head and the tail of a PDF file which are
+# sniffed to reject non-PDF files before parsing them.
+pdfwamsniffsize=4
+# Maximum size in MB of page content streams whose parsed operations are
+# kept in memory per document. This counts the decoded content stream
+# bytes; the parsed operations themselves take several times more.
+pdfwamcontentcache=32
+# Documents with more pages than this have their page-local checks
+# run on shards of pages by a pool of worker processes. 0 disables it.
+pdfwamshardpages=0
+# Number of worker processes for the page shards.
+pdfwamshardworkers=4
+# Maximum number of pages sampled to find out if a document is scanned.
+pdfwamscansample=3
 pdfwamloglevel='info'
 dbfile='pdfwam_log.db'
 # static (temp) files prefix
@@ -1,5 +1,6 @@
 """ Helper functions """
 import logging
+import weakref
 
 def get_logger(name='pdfwam'):
     return FakeLogger(name)
@@ -7,7 +8,9 @@ def get_logger(name='pdfwam'):
 class FakeLogger:
     def __init__(self, name='pdfwam'):
         self.log = logging.getLogger(name)
-        self.log.addHandler(logging.StreamHandler())
+        # Loggers are shared, add the handler only once
+        if not self.log.handlers:
+            self.log.addHandler(logging.StreamHandler())
         self.log.setLevel(logging.INFO)
 
     def debug(self, msg, *args):
@@ -20,9 +23,10 @@ class FakeLogger:
 
 def memoize(function):
     """ Memoizing decorator serving as a cache for functions
-    whose state is memoized in dictionaries """
+    whose state is memoized in dictionaries. The cache of an
+    instance goes away with the instance """
 
-    _memoized = {}
+    _memoized = weakref.WeakKeyDictionary()
 
     def wrapper(instance, *args):
         # Create a place holder for the instance
@@ -5,9 +5,13 @@ pdfAWAM - Entry point into PDF accessibility checker
 
 from pypdf import PdfReader
 from pypdf.errors import PdfReadError
+from pypdf.generic import IndirectObject
 
 from . import helper
 from . import pdfwcag
+from . import pdfshard
+from . import pdfcache
+from . import pdfbudget
 import logging
 from . import config
 import time
@@ -29,6 +33,19 @@ class DecryptionFailedException(Exception):
 class PdfWamProcessingError(Exception):
     """ Class summarizing all PDF-WAM processing exceptions """
 
+class PdfWamBudgetExceeded(PdfWamProcessingError):
+    """ The check ran out of its time or memory budget. result
+    has the results of the tests which were finished, and budget
+    is 'time' or 'memory' """
+
+    def __init__(self, message, budget, result=None):
+        PdfWamProcessingError.__init__(self, message)
+        self.budget = budget
+        self.result = result
+
+    def __reduce__(self):
+        return (self.__class__, (str(self), self.budget, self.result))
+
 class PdfReaderWrapper(PdfReader, pdfwcag.PdfWCAG):
     """ Our own customized Pdf file reader class
     which inherits from the pyPdf one """
@@ -41,15 +58,56 @@ class PdfReaderWrapper(PdfReader, pdfwcag.PdfWCAG):
         self.strict = False
         self.logger = logger
         self.stream = stream
-        # Rewind stream to beginning
         pdfwcag.PdfWCAG.__init__(self, stream=stream)
+        # Reject non-PDF files before parsing. This is
+        # not self.read(), which is PdfReader's
+        pdfwcag.PdfWCAG.read(self, stream)
         PdfReader.__init__(self, stream)
-        # PdfStructureMixin.read(self, stream)
         # Fill in document information
         self.fill_info()
         # Set the root object
         self.root =  self.trailer['/Root'].get_object()
-    
+        # Page object -> page number index
+        self.build_page_index()
+
+    def build_page_index(self):
+        """ Build an index of page numbers keyed by the
+        indirect reference of the page objects """
+
+        self.page_index = {}
+
+        for pgnum, pg in enumerate(self.pages):
+            ref = pg.indirect_reference
+            if ref is not None:
+                self.page_index[(ref.idnum, ref.generation)] = pgnum + 1
+
+    def get_page_number(self, pg):
+        """ Return the page number (starting at 1) of the given
+        page object, or 0 if it is not a page of this document """
+
+        if type(pg) is not IndirectObject:
+            pg = getattr(pg, 'indirect_reference', None)
+            if pg is None:
+                return 0
+
+        return self.page_index.get((pg.idnum, pg.generation), 0)
+
+def document_info(pdf, pdfobj, digest):
+    """ Return the size in bytes, number of pages and
+    SHA-256 of the document, reported with the results """
+
+    pos = pdf.tell()
+    pdf.seek(0, io.SEEK_END)
+    size = pdf.tell()
+    pdf.seek(pos)
+
+    try:
+        pages = len(pdfobj.pages)
+    except Exception:
+        pages = None
+
+    return {'size': size, 'pages': pages, 'hash': digest}
+
 def extractAWAMIndicators(pdf,
                           password='',
                           verbose=False,
@@ -65,25 +123,66 @@ def extractAWAMIndicators(pdf,
 
     if logger == None:
         logger = helper.get_logger()
+
+    # The content hash of the document is reported with
+    # the results. Lazily fetched documents are not hashed,
+    # which would need all their content.
+    digest = None
+    if json_value and not getattr(pdf, 'lazy', False):
+        digest = pdfcache.stream_digest(pdf)
+
+    # Reports of documents already checked are cached
+    # by content, if the result cache is enabled
+    cache, key = None, None
+    if digest is not None and int(config.pdfwamresultcache):
+        try:
+            cache = pdfcache.get_result_cache()
+            key = cache.key(pdf, password, digest)
+            result = cache.get(key)
+        except OSError as e:
+            logger.error('Error using result cache: [%s]' % str(e))
+            cache, result = None, None
+
+        if result is not None:
+            logger.info('Result cache hit, processed in %.2f seconds' % (time.time() - t))
+            return result
         
+    # Set as soon as the document is parsed, to
+    # get partial results when a budget runs out
+    pdfobj = None
+
     # Takes an optional password which can be used to
     # unlock the document for encrypted documents.
     try:
         # pdfobj = MyPdfFileReader(pdf, password, logger)
         pdfobj = PdfReaderWrapper(pdf, password, logger)
         pdfobj.verbose = verbose
+        logger.info('Pre-flight: PDF %s, encrypted: %s, linearized: %s, tagged: %s, startxref: %s' % (pdfobj.preflight.version,
+                                                                                                    pdfobj.preflight.encrypted,
+                                                                                                    pdfobj.preflight.linearized,
+                                                                                                    pdfobj.preflight.tagged,
+                                                                                                    pdfobj.preflight.startxref))
         
         pdfobj.fix_indirect_object_xref()
 
+        # Run the page-local checks of very large documents
+        # on shards of pages in worker processes
+        npages = len(pdfobj.pages)
+        if int(config.pdfwamshardpages) and npages > int(config.pdfwamshardpages):
+            pdfobj.page_results = pdfshard.analyze_pages(pdf, password, npages, logger)
+
+        # Initializes the AWAM handler, walks the structure
+        # tree once and runs all tests on the results.
+        pdfobj.run_all_tests()
+
         # If developer, just print a dictionary containing
         # meta info, scanned, forms, tagged, permissions
         # and an accessibility score.
-        pdfobj.init()
-        pdfobj.process_awam()            
-
         if verbose:
             print("***PDF Summary: Start***")
             print('Version:',pdfobj.version)
+            print('Encrypted:',pdfobj.preflight.encrypted)
+            print('Linearized:',pdfobj.preflight.linearized)
             print('#Pages:', len(pdfobj.pages))
             print('Producer:',pdfobj.producer)
             print('Creator:',pdfobj.creator)
@@ -96,11 +195,10 @@ def extractAWAMIndicators(pdf,
             print('Has forms:', pdfobj.has_forms())
             print('Has bookmarks:',pdfobj.has_bookmarks())
             print('Scanned:',pdfobj.is_scanned)
+            print('Scanned pages fraction:',pdfobj.get_scanned_fraction())
             print('Num Images:',pdfobj.get_num_images())
 
             print('***PDF Summary: End ****\n')
-
-        pdfobj.run_all_tests()
     except DecryptionFailedException:
         # We are unable to decrypt document.
         # We have got no parsed pdfobj, and cannot do much more,
@@ -118,12 +216,36 @@ def extractAWAMIndicators(pdf,
         logger.error(errmsg)
         # Ticket 127 fix        
         raise PdfWamProcessingError(errmsg) 
+    except pdfwcag.PdfStructureError as e:
+        errmsg='Error, not a PDF file: ' + str(e)
+        logger.error(errmsg)
+        raise PdfWamProcessingError(errmsg)
     except PdfReadError as e:
         errmsg='Error, cannot read PDF file: ' + str(e)
         logger.error(errmsg)
         # Not a PDF file
         # return {}
         raise PdfWamProcessingError(errmsg)
+    except (pdfbudget.BudgetExceeded, MemoryError) as e:
+        # Out of time or memory, keep the results of the
+        # tests which were finished
+        pdfbudget.stop_timer()
+        if isinstance(e, MemoryError):
+            budget = 'memory'
+        else:
+            budget = 'time'
+
+        result = None
+        if pdfobj is not None and pdfobj.awamHandler is not None:
+            if json_value:
+                result = pdfobj.get_dict()
+                result['document'] = document_info(pdf, pdfobj, digest)
+            else:
+                result = pdfobj.awamHandler.resultMap
+
+        errmsg = 'Error, %s budget exceeded after %.2f seconds' % (budget, time.time() - t)
+        logger.error(errmsg)
+        raise PdfWamBudgetExceeded(errmsg, budget, result)
     except Exception as e:
         # Final global catch-all handler
         # Prepare error message
@@ -157,7 +279,14 @@ def extractAWAMIndicators(pdf,
     print('-'*80)
 
     if json_value:
-        return pdfobj.get_dict()
+        result = pdfobj.get_dict()
+        result['document'] = document_info(pdf, pdfobj, digest)
+        if cache is not None:
+            try:
+                cache.put(key, result)
+            except OSError as e:
+                logger.error('Error using result cache: [%s]' % str(e))
+        return result
 
     return rmap
         
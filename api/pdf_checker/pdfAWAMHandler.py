@@ -1,12 +1,21 @@
 from . import pdfstruct
+from collections import namedtuple
 from pypdf.generic import ArrayObject, DictionaryObject
 
+# Compact record of a figure element evaluated for alt text
+FigureRecord = namedtuple('FigureRecord', ('page', 'ordinal', 'has_alt', 'has_actualtext'))
+
 class PdfAWAMHandler:
     """
     AWAM handler for PDF structure tree elements.
     """
+
+    # Figures without alt text, by page
+    failedImgs = property(lambda self: self.get_failed_figures(), None, None)
+
     def __init__(self, resultMap=None,roleMap=None,validateImages=False,
-                 ignoreSingleBitImgs=False,debug=False):
+                 ignoreSingleBitImgs=False,debug=False,getPageNumber=None,
+                 getPageImages=None):
         if resultMap==None:
             self.resultMap={}
         else:
@@ -21,22 +30,68 @@ class PdfAWAMHandler:
         self.nFormEls = 0
         # Language check already done ?
         self.langcheck = False
-        # To make sure we don't add duplicate results
+        # Figures evaluated for alt text, keyed by reference.
+        # This also makes sure we don't add duplicate results
         # for alt-image test
-        self.figureEls = []
+        self.figures = {}
+        # Figures without alt text by page, built on
+        # first use after the figures were added
+        self.failedFigs = None
         # Table accessibility
         self.tableStruct = None
         # Tables evaluated for accessibility
         self.tableStructDict = {}
         # Links evaluated for accessibility
         self.linkAnnots = {}
-        # Images without alt text
-        self.failedImgs = {}
         # X-Validate alt-image tests with the page element ?
         self.validateImgs = validateImages
         # Ignore single-bit depth images when reporting
         # Alt image test results ?
         self.ignore1bitimgs = ignoreSingleBitImgs
+        # Function returning the page number of a page object,
+        # from the page index of the document
+        if getPageNumber==None:
+            self.getPageNumber=lambda pg: 0
+        else:
+            self.getPageNumber=getPageNumber
+        # Function returning the images used on a page,
+        # from the image catalog of the document
+        if getPageImages==None:
+            self.getPageImages=lambda pgnum: []
+        else:
+            self.getPageImages=getPageImages
+        # Structure type -> list of visitor functions which
+        # are called for elements of that type during the
+        # (single) walk of the structure tree
+        self.visitors = {}
+
+        self.register(('/Link',), self.handle_link)
+        self.register(list(pdfstruct.PdfTblStruct.typedict.keys()), self.handle_table)
+        self.register(('/Form',), self.handle_form)
+        self.register(('/Document',), self.handle_document)
+        self.register(('/Figure',), self.handle_figure)
+        # Types which the role map maps to '/Figure'
+        self.register(self.role_types('/Figure'), self.handle_role_figure)
+
+    def role_types(self, role):
+        """ Return the structure types mapped to the given
+        standard role by the role map of the document """
+
+        try:
+            return [structureType for structureType, mapped in self.roleMap.items() if mapped == role]
+        except:
+            # No roles defined
+            return []
+
+    def register(self, structureTypes, visitor):
+        """ Register a visitor function which is called with
+        every structure element of the given types """
+
+        for structureType in structureTypes:
+            try:
+                self.visitors[structureType].append(visitor)
+            except KeyError:
+                self.visitors[structureType] = [visitor]
         
     def check(self,element,awamId,dictKey,Pass=None,Fail=1,noAdd=False):
         """
@@ -66,25 +121,206 @@ class PdfAWAMHandler:
                 self.resultMap[awamId][(self.line,self.elementCount)]=Fail
             return 0
 
-    def get_flattened_pages(self, pgelem):
-        """ Return list of pages as a flattened list """
+    def figure_key(self, element):
+        """ Return the key of a figure element in the figure registry """
+
+        ref = getattr(element, 'indirect_reference', None)
+        if ref is None:
+            # Direct object
+            return id(element)
+
+        return (ref.idnum, ref.generation)
+
+    def add_figure(self, element, pgnum, has_alt, has_actualtext):
+        """ Add a figure element to the figure registry """
+
+        self.figures[self.figure_key(element)] = FigureRecord(pgnum, self.elementCount,
+                                                              bool(has_alt), bool(has_actualtext))
+        self.failedFigs = None
+
+    def get_failed_figures(self):
+        """ Return figures without alt text as a dictionary
+        of page number to list of figure records """
+
+        if self.failedFigs is not None:
+            return self.failedFigs
+
+        failed = {}
+        for figure in self.figures.values():
+            if (not figure.has_alt) and (not figure.has_actualtext):
+                try:
+                    failed[figure.page].append(figure)
+                except KeyError:
+                    failed[figure.page] = [figure]
+
+        self.failedFigs = failed
+        return failed
+
+    def handle_link(self, element):
+        """ Collect link annotations of a '/Link' element """
+
+        # import pdb; pdb.set_trace()
+        # If properly specified, this should have a kid
+        # of type '/OBJR' which points to the actual
+        # link object.
+        try:
+            kids = element['/K']
+            # This need not be a list, in that case put in a list
+            # since we don't want to miss objects due to PDF
+            # vagueness !
+            if type(kids) not in (list, ArrayObject):
+                kids = [kids]
+                
+            for kid in kids:
+                try:
+                    kid  = kid.get_object()
+                    # If this is not a dictionary object, skip it
+                    if type(kid) not in (dict, DictionaryObject):
+                        continue
+                    
+                    kidTyp = kid['/Type']
+
+                    if kidTyp == '/OBJR':
+                        # Get the object and append a tuple of the
+                        # object and the annotation to the list
+                        try:
+                            linkObj = kid['/Obj'].get_object()
+                            linkObjId = id(linkObj)
+                            if linkObjId not in self.linkAnnots:
+                                self.linkAnnots[id(linkObj)] = (linkObj, element)
+                        except Exception as e:
+                            pass
+                except Exception as e:
+                    pass
+        except Exception as e:
+            pass
 
-        parent = pgelem['/Parent'].get_object()
-        pages = []
+    def handle_table(self, element):
+        """ Add a table element to its table structure """
 
-        while parent['/Type'] == '/Pages':
-            pages.extend(parent['/Kids'])
+        if element['/S']=='/Table':
+            # import pdb; pdb.set_trace()
+            
             try:
-                parent = parent['/Parent'].get_object()
+                self.tableStruct = self.tableStructDict[id(element)]
             except KeyError:
-                break
+                self.tableStruct = pdfstruct.PdfTblStruct()
+                self.tableStructDict[id(element)] = self.tableStruct
+
+        try:
+            # Find if this has a page element
+            pg = element['/Pg']
+
+            if not self.tableStruct.is_page_set():
+                # Find the page number
+                pgnum = self.getPageNumber(pg)
+                if pgnum:
+                    self.tableStruct.set_page(pgnum)
+        except KeyError:
+            raise
+        
+        
+        try:
+            self.tableStruct.add(element)
+        except pdfstruct.PdfTblStructInvalidException as e:
+            raise
+
+    def handle_form(self, element):
+        """ Check a '/Form' element for an '/Obj' kid """
 
-        pages = [pg.get_object() for pg in pages if pg != None]
-        return pages
+        # For the time being, simply checking if the ['/K']['/Obj']
+        # is there for all form elements, not inspecting deep into
+        # it
+        try:
+            elem_acc = element['/K']['/Obj']
+            self.nFormEls += 1
+        except KeyError:
+            # Mark failure and don't check further
+            self.resultMap['EIAO.A.15.2.1.4.PDF.4.1'] = {(0, 1): 0}
+
+    def handle_document(self, element):
+        """ Language checks on the '/Document' element """
+
+        # if not self.langcheck:
+        if 0:
+            # LANG AWAM is applicable
+            # Check if /Lang attribute exists. Return "" if not.
+            # AWAM indicator for /Lang in BWAM
+            self.check(element,"EIAO.A.10.4.1.4.PDF.1.1","/Lang",Pass=1,Fail=0)
+            # AWAM indicator for /lang in MWAM
+            self.check(element,"EIAO.A.0.0.0.4.PDF.4.1","/Lang",Fail=None)
+
+    def handle_figure(self, element):
+        """ Alt text checks on a '/Figure' element """
+
+        if self.figure_key(element) not in self.figures:
+            # Check if /Alt attribute exists.
+            # NOTE: If self.validateImgs is False, the AWAM values would be already
+            # updated after this step, so the if block below doesn't execute                
+            r1=self.check(element,"EIAO.A.10.1.1.4.PDF.1.1","/Alt",Pass=1,Fail=0,
+                          noAdd=self.validateImgs)
+            # Check if /ActualText attribute exists.
+
+            # NOTE: If self.validateImgs is False, the AWAM values would be already
+            # updated after this step, so the if block below doesn't execute
+            r2=self.check(element,"EIAO.A.10.1.1.4.PDF.2.1","/ActualText",Pass=1,Fail=0,
+                          noAdd=self.validateImgs)
+
+            pgnum, checked = 0, False
             
+            if self.validateImgs:
+                # Validate images without alt by getting the page element
+                # for the image and validating whether this really is
+                # a page with images. Sometimes the structure tree seems
+                # to contain inconsistent data w.r.t the actual page
+                # so this check is often useful.
+                try:
+                    pg = element['/Pg']
+                    # Find which page is this by looking at the index
+                    pgnum = self.getPageNumber(pg)
+
+                    if pgnum:
+                        # This is the page, validate the page
+                        imgs = self.getPageImages(pgnum)
+
+                        if any(imgs):
+                            # Get the bit-depth of the images - if single bit
+                            # need to check against config
+                            if self.ignore1bitimgs:
+                                bits = [(img.bits != 1) for img in imgs]
+                                # If any img is not 1 bit, then fine, else don't
+                                # consider this result
+                                if not any(bits):
+                                    return
+                            checked = True
+                except KeyError:
+                    pass
+
+                # If not cross-checked reset page number
+                # if not checked: pgnum = 0
+                # We are adding the correct location of the image
+                # NOTE: This is conditionally put inside the if block because
+                # if validateImgs is True, then the resultmap for these keys
+                # won't be added, so we are adding them here.
+                self.resultMap["EIAO.A.10.1.1.4.PDF.2.1"][(pgnum,self.elementCount)] = r1
+                self.resultMap["EIAO.A.10.1.1.4.PDF.1.1"][(pgnum,self.elementCount)] = r2
+
+            # Add entry for element
+            self.add_figure(element, pgnum, r1, r2)
+
+    def handle_role_figure(self, element):
+        """ Alt text checks on an element role mapped to '/Figure' """
+
+        if self.figure_key(element) not in self.figures:
+            # Check if /Alt attribute exists. 
+            r1=self.check(element,"EIAO.A.10.1.1.4.PDF.1.1","/Alt",Pass=1,Fail=0)
+            # Check if /ActualText attribute exists.
+            r2=self.check(element,"EIAO.A.10.1.1.4.PDF.2.1","/ActualText",Pass=1,Fail=0)
+            # Add entry for element
+            self.add_figure(element, 0, r1, r2)
+
     def handler(self,element):
         # Do the A-WAM checks on PDF structure element.
-        # Applicability: /Document
         # Increase element count
         self.elementCount+=1
 
@@ -94,197 +330,9 @@ class PdfAWAMHandler:
         except:
             return
 
-        if structureType=='/Link':
-            # import pdb; pdb.set_trace()
-            # If properly specified, this should have a kid
-            # of type '/OBJR' which points to the actual
-            # link object.
-            try:
-                kids = element['/K']
-                # This need not be a list, in that case put in a list
-                # since we don't want to miss objects due to PDF
-                # vagueness !
-                if type(kids) not in (list, ArrayObject):
-                    kids = [kids]
-                    
-                for kid in kids:
-                    try:
-                        kid  = kid.get_object()
-                        # If this is not a dictionary object, skip it
-                        if type(kid) not in (dict, DictionaryObject):
-                            continue
-                        
-                        kidTyp = kid['/Type']
-
-                        if kidTyp == '/OBJR':
-                            # Get the object and append a tuple of the
-                            # object and the annotation to the list
-                            try:
-                                linkObj = kid['/Obj'].get_object()
-                                linkObjId = id(linkObj)
-                                if linkObjId not in self.linkAnnots:
-                                    self.linkAnnots[id(linkObj)] = (linkObj, element)
-                            except Exception as e:
-                                pass
-                    except Exception as e:
-                        pass
-            except Exception as e:
-                pass
-                        
-        elif structureType in list(pdfstruct.PdfTblStruct.typedict.keys()):
-            if structureType=='/Table':
-                # import pdb; pdb.set_trace()
-                
-                try:
-                    self.tableStruct = self.tableStructDict[id(element)]
-                except KeyError:
-                    self.tableStruct = pdfstruct.PdfTblStruct()
-                    self.tableStructDict[id(element)] = self.tableStruct
-
-            try:
-                # Find if this has a page element
-                pg = element['/Pg']
-
-                if not self.tableStruct.is_page_set():
-                    # Find the page number
-                    pages = self.get_flattened_pages(pg)
-
-                    try:
-                        pgnum = pages.index(pg) + 1
-                        self.tableStruct.set_page(pgnum)
-                    except ValueError:
-                        pass
-            except KeyError:
-                raise
-            
-            
-            try:
-                self.tableStruct.add(element)
-            except pdfstruct.PdfTblStructInvalidException as e:
-                raise
-        
-        # Applicability criterion: /Form
-        elif structureType == '/Form':
-            # For the time being, simply checking if the ['/K']['/Obj']
-            # is there for all form elements, not inspecting deep into
-            # it
-            try:
-                elem_acc = element['/K']['/Obj']
-                self.nFormEls += 1
-            except KeyError:
-                # Mark failure and don't check further
-                self.resultMap['EIAO.A.15.2.1.4.PDF.4.1'] = {(0, 1): 0}
-                
-        # Applicability criterion: /Document
-        elif structureType == '/Document':
-            # if not self.langcheck:
-            if 0:
-                # LANG AWAM is applicable
-                # Check if /Lang attribute exists. Return "" if not.
-                # AWAM indicator for /Lang in BWAM
-                self.check(element,"EIAO.A.10.4.1.4.PDF.1.1","/Lang",Pass=1,Fail=0)
-                # AWAM indicator for /lang in MWAM
-                self.check(element,"EIAO.A.0.0.0.4.PDF.4.1","/Lang",Fail=None)
-
-        # Applicability criterion: Element /Figure
-        elif structureType == '/Figure':
-            try:
-                self.figureEls.index(element)
-            except ValueError:
-                # Check if /Alt attribute exists.
-                # NOTE: If self.validateImgs is False, the AWAM values would be already
-                # updated after this step, so the if block below doesn't execute                
-                r1=self.check(element,"EIAO.A.10.1.1.4.PDF.1.1","/Alt",Pass=1,Fail=0,
-                              noAdd=self.validateImgs)
-                # Check if /ActualText attribute exists.
-
-                # NOTE: If self.validateImgs is False, the AWAM values would be already
-                # updated after this step, so the if block below doesn't execute
-                r2=self.check(element,"EIAO.A.10.1.1.4.PDF.2.1","/ActualText",Pass=1,Fail=0,
-                              noAdd=self.validateImgs)
-
-                pgnum, checked = 0, False
-                
-                if self.validateImgs:
-                    # Validate images without alt by getting the page element
-                    # for the image and validating whether this really is
-                    # a page with images. Sometimes the structure tree seems
-                    # to contain inconsistent data w.r.t the actual page
-                    # so this check is often useful.
-                    try:
-                        pg = element['/Pg']
-                        # Find which page is this by looking at the index
-                        pgnum, pages = 1, self.get_flattened_pages(pg)
-
-                        for page in pages:
-                            pgobj = page.get_object()
-                            if pgobj == pg:
-                                # This is the page, validate the page
-                                res = pg['/Resources'].get_object()
-                                try:
-                                    xobj = res['/XObject'].get_object()
-                                    imgs=[item.get_object() for item in list(xobj.values()) if \
-                                          item.get_object().get('/Subtype') in ('/Image')]
-
-                                    if any(imgs):
-                                        # Get the bit-depth of the images - if single bit
-                                        # need to check against config
-                                        if self.ignore1bitimgs:
-                                            try:
-                                                bits = [(img.get_object()['/BitsPerComponent'] != 1) for img in imgs]
-                                                # If any img is not 1 bit, then fine, else don't
-                                                # consider this result
-                                                if not any(bits):
-                                                    return
-                                            except KeyError:
-                                                pass
-                                        checked = True
-                                except KeyError:
-                                    pass
-                                break
-                            pgnum += 1
-                    except KeyError:
-                        pass
-
-                    # If not cross-checked reset page number
-                    # if not checked: pgnum = 0
-                    # We are adding the correct location of the image
-                    # NOTE: This is conditionally put inside the if block because
-                    # if validateImgs is True, then the resultmap for these keys
-                    # won't be added, so we are adding them here.
-                    self.resultMap["EIAO.A.10.1.1.4.PDF.2.1"][(pgnum,self.elementCount)] = r1
-                    self.resultMap["EIAO.A.10.1.1.4.PDF.1.1"][(pgnum,self.elementCount)] = r2
-                    if (not r1) and (not r2):                    
-                        try:
-                            self.failedImgs[pgnum].append(element)
-                        except KeyError:
-                            self.failedImgs[pgnum] = [element]
-                else:
-                    if (not r1) and (not r2):
-                        try:
-                            self.failedImgs[0].append(element)
-                        except KeyError:
-                            self.failedImgs[0] = [element]
-
-                # Add entry for element
-                self.figureEls.append(element)
-
-        # Applicability criterion: role /Figure
-        try:
-            role = self.roleMap[structureType]
-            if role == '/Figure':
-                try:
-                    self.figureEls.index(element)
-                except ValueError:
-                    # Check if /Alt attribute exists. 
-                    self.check(element,"EIAO.A.10.1.1.4.PDF.1.1","/Alt",Pass=1,Fail=0)
-                    # Check if /ActualText attribute exists.
-                    self.check(element,"EIAO.A.10.1.1.4.PDF.2.1","/ActualText",Pass=1,Fail=0)
-                    # Add entry for element
-                    self.figureEls.append(element)
-        except:
-            # No roles defined
-            pass
+        # Dispatch to the visitors registered for this type
+        for visitor in self.visitors.get(structureType, ()):
+            visitor(element)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+""" Time and memory budgets of checks run in worker processes
+
+The time budget is kept with a SIGALRM timer, which raises
+BudgetExceeded in the check when it runs out. That is not an
+Exception, so the catch-all handlers of the checker don't stop
+it, and it is raised again every tenth of a second in case a bare
+except swallowed it, till the timer is stopped. The memory budget
+is a limit on the address space of the process, which makes
+allocations beyond it fail with MemoryError.
+
+Both only work in the main thread of a process, and are meant for
+worker processes which check one document at a time.
+
+"""
+
+import signal
+import resource
+
+# Seconds between raising BudgetExceeded again
+REPEAT_INTERVAL = 0.1
+
+class BudgetExceeded(BaseException):
+    """ The time budget of a check ran out """
+
+# Whether the timer is running
+armed = False
+
+def alarm(signum, frame):
+    if armed:
+        raise BudgetExceeded('Time budget exceeded')
+
+def start_timer(seconds):
+    """ Raise BudgetExceeded after the given seconds, if not 0 """
+
+    global armed
+
+    if not seconds:
+        return
+
+    signal.signal(signal.SIGALRM, alarm)
+    armed = True
+    signal.setitimer(signal.ITIMER_REAL, seconds, REPEAT_INTERVAL)
+
+def stop_timer():
+    """ Stop the timer, if running """
+
+    global armed
+
+    if armed:
+        armed = False
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+def set_memory_limit(mb):
+    """ Limit the address space of this process to the given MB, if not 0 """
+
+    if not mb:
+        return
+
+    limit = int(float(mb)*1024*1024)
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def budget_result(budget, result=None):
+    """ Return the given partial report, or an empty one, marked
+    as cut short by the given budget ('time' or 'memory') """
+
+    if result is None:
+        result = {'result': [], 'summary': {'Total': 0, 'Fail': 0, 'Pass': 0}}
+
+    result = dict(result)
+    result['status'] = 'budget exceeded'
+    result['budget'] = budget
+    return result
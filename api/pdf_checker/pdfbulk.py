@@ -0,0 +1,133 @@
+""" Check many PDF URLs concurrently
+
+Downloads run concurrently, limited globally and per host, and each
+downloaded document is handed to the checker as soon as it arrives,
+so the checker is kept busy while other downloads wait on the network.
+Results are yielded in the order they complete, with their URL and
+timings.
+
+The event loop only schedules the work: downloads run in a thread
+pool through the pooled session of pdffetch, and checks run in their
+own executor (by default a single thread, since the checker is CPU
+bound).
+
+"""
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from . import config
+from . import pdffetch
+from .check_accessibility import check_accessibility
+
+async def check_urls_async(urls, password='', concurrency=None, per_host=None, executor=None):
+    """ Check the PDF documents at the given URLs (any iterable) and
+    yield a dictionary for each, as they complete, with the keys
+
+    url -> the URL
+    result -> the report as returned by check_accessibility, or None
+    error -> the error message if fetching or checking failed, or None
+    fetch_time, check_time, time -> time taken in seconds to fetch,
+                                    check and in total (from the start
+                                    of the download)
+
+    At most concurrency (default pdfwambulkconcurrency) downloads run at
+    once, and at most per_host (default pdfwambulkperhost) per host.
+    Checks run in the given executor, or in a single thread """
+
+    if concurrency is None:
+        concurrency = int(config.pdfwambulkconcurrency)
+    if per_host is None:
+        per_host = int(config.pdfwambulkperhost)
+
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(concurrency)
+    host_limits = {}
+
+    fetch_executor = ThreadPoolExecutor(max_workers=concurrency)
+    check_executor = executor
+    if check_executor is None:
+        check_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def check_url(url):
+        item = {'url': url, 'result': None, 'error': None,
+                'fetch_time': 0.0, 'check_time': 0.0, 'time': 0.0}
+        host = urlsplit(url).netloc
+
+        try:
+            host_limit = host_limits[host]
+        except KeyError:
+            host_limit = host_limits[host] = asyncio.Semaphore(per_host)
+
+        # Take the host slot first, so a download waiting for
+        # its host doesn't hold a global slot
+        async with host_limit:
+            async with limit:
+                start = time.time()
+                try:
+                    stream = await loop.run_in_executor(fetch_executor, pdffetch.fetch, url)
+                except Exception as e:
+                    item['error'] = str(e)
+                    item['fetch_time'] = item['time'] = time.time() - start
+                    return item
+
+        fetched = time.time()
+        item['fetch_time'] = fetched - start
+
+        try:
+            item['result'] = await loop.run_in_executor(check_executor, check_accessibility, stream, password)
+        except Exception as e:
+            item['error'] = str(e)
+        finally:
+            stream.close()
+
+        item['check_time'] = time.time() - fetched
+        item['time'] = time.time() - start
+        return item
+
+    urls = iter(urls)
+    pending = set()
+    exhausted = False
+
+    try:
+        while True:
+            # Keep enough tasks queued to fill all download
+            # slots, without taking in all the URLs at once
+            while (not exhausted) and len(pending) < 2*concurrency:
+                try:
+                    pending.add(asyncio.ensure_future(check_url(next(urls))))
+                except StopIteration:
+                    exhausted = True
+
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        fetch_executor.shutdown(wait=False)
+        if executor is None:
+            check_executor.shutdown(wait=False)
+
+def check_urls(urls, password='', concurrency=None, per_host=None, executor=None):
+    """ Check the PDF documents at the given URLs concurrently and yield
+    the results as they complete. This is the blocking version of
+    check_urls_async, which it runs in its own event loop """
+
+    loop = asyncio.new_event_loop()
+    results = check_urls_async(urls, password, concurrency, per_host, executor)
+
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
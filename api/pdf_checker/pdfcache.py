@@ -0,0 +1,371 @@
+""" On-disk caches of PDF documents """
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+from . import config
+from . import helper
+from . import pdffetch
+
+class PdfDiskCache(object):
+    """ Base class of caches kept as files in a folder which can
+    be shared by several processes. Files are written to a temporary
+    name and renamed into place, so readers never see partial files.
+    Files are evicted in least recently used order once the cache
+    grows beyond its size, under an exclusive lock on the folder """
+
+    def __init__(self, folder, maxsize):
+        self.folder = folder
+        # Maximum size in bytes
+        self.maxsize = maxsize
+        self.logger = helper.get_logger()
+
+        os.makedirs(folder, exist_ok=True)
+
+    @contextmanager
+    def lock(self):
+        """ Hold the lock of the cache folder """
+
+        with open(os.path.join(self.folder, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def write_json(self, path, value):
+        """ Write the value as JSON to the file at path """
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def touch(self, path):
+        """ Mark the file as recently used """
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def list_files(self, folder, suffix):
+        """ Return a list of (mtime, path, size) of the
+        files with the given suffix in folder """
+
+        files = []
+
+        for name in os.listdir(folder):
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(folder, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, path, st.st_size))
+
+        return files
+
+    def evict(self, files, keep=None):
+        """ Remove the least recently used of the given files, as
+        listed by list_files, till the cache fits in its size, keeping
+        the file keep. Should be called with the lock held """
+
+        total = sum([size for mtime, path, size in files])
+
+        for mtime, path, size in sorted(files):
+            if total <= self.maxsize:
+                break
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+                total -= size
+                self.logger.debug('Cache: evicted %s' % path)
+            except OSError:
+                pass
+
+class PdfUrlCache(PdfDiskCache):
+    """ Cache of PDF documents downloaded from URLs.
+
+    Documents are stored as content-addressed files under 'objects',
+    named by the SHA-256 of their data, so a document served from
+    several URLs is kept once. Every URL has an entry under 'urls'
+    with the hash of its document, its ETag and Last-Modified headers
+    and the time it was fetched. Entries older than the TTL are
+    revalidated with a conditional request. URL entries count toward
+    the size of the cache and are evicted with the documents, in least
+    recently used order. URL entries of evicted documents are dropped
+    when they are next looked up """
+
+    def __init__(self, folder, ttl, maxsize):
+        PdfDiskCache.__init__(self, folder, maxsize)
+        # TTL in seconds
+        self.ttl = ttl
+        self.objects = os.path.join(folder, 'objects')
+        self.urls = os.path.join(folder, 'urls')
+
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.urls, exist_ok=True)
+
+    def url_path(self, url):
+        return os.path.join(self.urls, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest + '.pdf')
+
+    def get_entry(self, url):
+        """ Return the cache entry of the URL, or None """
+
+        try:
+            with open(self.url_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Guard against hash collisions
+        if entry.get('url') != url:
+            return None
+
+        return entry
+
+    def put_entry(self, url, entry):
+        """ Write the cache entry of the URL """
+
+        self.write_json(self.url_path(url), entry)
+
+    def remove_entry(self, url):
+        """ Remove the cache entry of the URL """
+
+        try:
+            os.remove(self.url_path(url))
+        except OSError:
+            pass
+
+    def open_object(self, digest):
+        """ Open the cached document with the given hash and mark
+        it as recently used. Returns None if it is not cached """
+
+        path = self.object_path(digest)
+        try:
+            stream = open(path, 'rb')
+        except OSError:
+            return None
+
+        self.touch(path)
+        return stream
+
+    def store(self, stream):
+        """ Store the document in the given stream and return its hash """
+
+        sha = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.objects, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(pdffetch.CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    f.write(chunk)
+
+            digest = sha.hexdigest()
+            path = self.object_path(digest)
+            with self.lock():
+                os.replace(tmp, path)
+                self.evict(self.list_files(self.objects, '.pdf') + self.list_files(self.urls, '.json'), path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return digest
+
+    def fetch(self, url, maxsize=None):
+        """ Return the PDF document at the URL as a seekable stream,
+        from the cache if possible, downloading it otherwise """
+
+        entry = self.get_entry(url)
+        headers = {}
+
+        if entry is not None and not os.path.isfile(self.object_path(entry['hash'])):
+            # Its document was evicted
+            self.remove_entry(url)
+            entry = None
+
+        if entry is not None:
+            if (time.time() - entry['fetched']) < self.ttl:
+                stream = self.open_object(entry['hash'])
+                if stream is not None:
+                    self.logger.debug('URL cache: hit for %s' % url)
+                    self.touch(self.url_path(url))
+                    return stream
+
+            # Expired, revalidate with a conditional request
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        stream, response_headers = pdffetch.download(url, maxsize, headers)
+
+        if stream is None:
+            # Not modified
+            self.logger.debug('URL cache: %s not modified' % url)
+            entry['fetched'] = time.time()
+            self.put_entry(url, entry)
+            stream = self.open_object(entry['hash'])
+            if stream is not None:
+                return stream
+
+            # Evicted meanwhile
+            return pdffetch.download(url, maxsize)[0]
+
+        try:
+            digest = self.store(stream)
+        finally:
+            stream.close()
+
+        self.put_entry(url, {'url': url,
+                             'hash': digest,
+                             'etag': response_headers.get('ETag'),
+                             'last_modified': response_headers.get('Last-Modified'),
+                             'fetched': time.time()})
+
+        stream = self.open_object(digest)
+        if stream is None:
+            return pdffetch.download(url, maxsize)[0]
+
+        return stream
+
+class PdfResultCache(PdfDiskCache):
+    """ Cache of the reports of checked PDF documents. Reports are
+    keyed by the SHA-256 of the document data, the password, the
+    fingerprint of the checker code and the configuration affecting
+    the results, so a new version of the checker or a change in
+    its configuration invalidates them """
+
+    # Configuration affecting the results
+    config_keys = ('pdfwamvalidateimgs', 'pdfwamignoresinglebitimgs', 'pdfwamscansample',
+                   'pdfwamsniffsize', 'pdfwamshardpages')
+
+    def key(self, stream, password='', digest=None):
+        """ Return the cache key of the document in the given
+        stream, which is left at its current position. digest
+        is the SHA-256 of the document, computed if not given """
+
+        if digest is None:
+            digest = stream_digest(stream)
+
+        if password:
+            password = hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+        material = [digest, password, checker_fingerprint(),
+                    [str(getattr(config, key)) for key in self.config_keys]]
+        return hashlib.sha256(json.dumps(material).encode('utf-8')).hexdigest()
+
+    def result_path(self, key):
+        return os.path.join(self.folder, key + '.json')
+
+    def get(self, key):
+        """ Return the cached report for the key, or None """
+
+        path = self.result_path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        self.touch(path)
+        return result
+
+    def put(self, key, result):
+        """ Cache the report for the key """
+
+        path = self.result_path(key)
+        self.write_json(path, result)
+        with self.lock():
+            self.evict(self.list_files(self.folder, '.json'), path)
+
+def stream_digest(stream):
+    """ Return the SHA-256 of the document in the given
+    stream, which is left at its current position """
+
+    sha = hashlib.sha256()
+    pos = stream.tell()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(pdffetch.CHUNK_SIZE), b''):
+        sha.update(chunk)
+    stream.seek(pos)
+
+    return sha.hexdigest()
+
+def checker_modules():
+    """ Return the names of the modules of the checker package,
+    all of which are taken to determine the results. Tests and
+    the configuration, which is part of the keys, are left out """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    return sorted([name for name in os.listdir(folder)
+                   if name.endswith('.py') and not name.startswith('test_') and name != 'config.py'])
+
+# Fingerprint of the checker code, computed on first use
+fingerprint = None
+
+def checker_fingerprint():
+    """ Return a fingerprint of the version of the checker, which
+    is the SHA-256 of its code and the version of pypdf """
+
+    global fingerprint
+
+    if fingerprint is None:
+        import pypdf
+
+        sha = hashlib.sha256(pypdf.__version__.encode('utf-8'))
+        folder = os.path.dirname(os.path.abspath(__file__))
+        for name in checker_modules():
+            sha.update(name.encode('utf-8'))
+            with open(os.path.join(folder, name), 'rb') as f:
+                sha.update(f.read())
+
+        fingerprint = sha.hexdigest()
+
+    return fingerprint
+
+# Caches of this process, created on first use
+url_cache = None
+result_cache = None
+
+def get_url_cache():
+    """ Return the URL cache configured by the pdfwamurlcache* settings """
+
+    global url_cache
+
+    if url_cache is None:
+        url_cache = PdfUrlCache(config.pdfwamurlcachefolder,
+                                float(config.pdfwamurlcachettl)*3600,
+                                int(float(config.pdfwamurlcachesize)*1024*1024))
+
+    return url_cache
+
+def get_result_cache():
+    """ Return the result cache configured by the pdfwamresultcache* settings """
+
+    global result_cache
+
+    if result_cache is None:
+        result_cache = PdfResultCache(config.pdfwamresultcachefolder,
+                                      int(float(config.pdfwamresultcachesize)*1024*1024))
+
+    return result_cache
@@ -2,28 +2,48 @@
 
 from . import pdfAWAM
 import sys
+import json
 import optparse
+from concurrent.futures import ThreadPoolExecutor
 from . import config
-import requests
-import io
+from . import pdffetch
+from . import pdfpool
 
-USAGE="""%s [options] pdffile - Check PDF documents for accessibility"""
+USAGE="""%s [options] pdffile... - Check PDF documents for accessibility"""
 
 def checkAcc(pdffile_or_url, passwd='', verbose=False, report=False, json_value=False):
 
-    if pdffile_or_url.startswith('http://') or pdffile_or_url.startswith('https://'):
-        data = requests.get(pdffile_or_url).content
-        stream = io.BytesIO(data)
-    else:
-        stream = open(pdffile_or_url, 'rb')
+    stream = pdffetch.open_source(pdffile_or_url)
 
-    ret = pdfAWAM.extractAWAMIndicators(stream, passwd, verbose, report,
-                                        json_value, console=True)
+    try:
+        ret = pdfAWAM.extractAWAMIndicators(stream, passwd, verbose, report,
+                                            json_value, console=True)
+    finally:
+        stream.close()
     # import pdb;pdb.set_trace()
     if verbose:
         print(ret)
     return ret
 
+def checkAccPool(pdffiles_or_urls, passwd='', workers=2):
+    """ Check the documents in a pool of worker processes
+    and print the JSON result of each as it is done """
+
+    pool = pdfpool.PdfWorkerPool(workers)
+
+    def check(pdffile_or_url):
+        try:
+            return {'file': pdffile_or_url, 'result': pool.check(pdffile_or_url, passwd)}
+        except Exception as e:
+            return {'file': pdffile_or_url, 'error': str(e)}
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for ret in executor.map(check, pdffiles_or_urls):
+                print(json.dumps(ret))
+    finally:
+        pool.close()
+
 def setupOptions():
     if len(sys.argv)==1:
         sys.argv.append('-h')
@@ -40,18 +60,27 @@ def setupOptions():
     o.add_option('-j', '--json',
                  dest='json', help="Print JSON of result",action="store_true",
                  default=False)
+    o.add_option('-w', '--workers',
+                 dest='workers', help="Check the documents in this many worker processes, printing JSON of each result",
+                 type="int", default=0)
 
     options, args = o.parse_args()
-    return (args[0], options.__dict__)
+    return (args, options.__dict__)
 
 def main():
-    pdffile, options = setupOptions()
+    pdffiles, options = setupOptions()
 
     password = options.get('password','')
     verbose = options.get('verbose')
     report = options.get('report')
     json_flag = options.get('json')
-    checkAcc(pdffile, password, verbose, report, json_flag)
+    workers = options.get('workers')
+
+    if workers:
+        checkAccPool(pdffiles, password, workers)
+    else:
+        for pdffile in pdffiles:
+            checkAcc(pdffile, password, verbose, report, json_flag)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,170 @@
+""" A lightweight scanner for the marked content of page content streams """
+
+import re
+from io import BytesIO
+from pypdf.generic import read_object
+
+# The WCAG.PDF.04 and pagination artifact tests need only the marked
+# content of a page, not every path and text operator in it. Parsing
+# the whole content stream with pypdf's ContentStream makes an object
+# for every operand of every operator, which is very costly for pages
+# with lots of vector graphics. This scanner only finds the token
+# boundaries using regular expressions, and parses the operands of
+# the few operators it keeps.
+
+# Optional white-space followed by one token. The groups are
+# comment, array/dictionary delimiter, hex string, literal string,
+# name and regular token (number or operator) respectively.
+token_re = re.compile(rb'[\x00\t\n\x0c\r ]*(?:'
+                      rb'(%)[^\r\n]*|'
+                      rb'(<<|>>|[\[\]{}])|'
+                      rb'(<)|'
+                      rb'(\()|'
+                      rb'(/)[^\x00\t\n\x0c\r ()<>\[\]{}/%]*|'
+                      rb'([^\x00\t\n\x0c\r ()<>\[\]{}/%]+))')
+
+# Characters which matter inside a literal string
+literal_re = re.compile(rb'[()\\]')
+
+# End of inline image data
+inline_image_end_re = re.compile(rb'[\x00\t\n\x0c\r ]EI(?=[\x00\t\n\x0c\r ]|$)')
+
+# PDF white-space characters
+whitespace = b'\x00\t\n\x0c\r '
+
+# Marked content operators
+marked_content_ops = (b'BMC', b'BDC', b'EMC')
+# Text showing operators
+text_ops = (b'Tj', b'TJ', b"'", b'"', b'T*')
+
+def read_non_whitespace(stream):
+    """ Return the next byte of the stream which is not
+    white-space, or b'' at the end of the stream """
+
+    c = stream.read(1)
+    while c and c in whitespace:
+        c = stream.read(1)
+
+    return c
+
+def read_operands(data):
+    """ Parse the given operands data into a list of PDF objects """
+
+    stream = BytesIO(data)
+    operands = []
+
+    while True:
+        peek = read_non_whitespace(stream)
+        if not peek:
+            break
+
+        if peek == b'%':
+            # Skip comment
+            stream.readline()
+            continue
+
+        stream.seek(-1, 1)
+        operands.append(read_object(stream, None))
+
+    return operands
+
+def skip_literal(data, pos):
+    """ Return the position just after the literal string
+    starting at pos (just after its opening parenthesis) """
+
+    depth = 1
+    while depth > 0:
+        m = literal_re.search(data, pos)
+        if m is None:
+            # Unterminated string
+            return len(data)
+
+        c = m.group()
+        if c == b'\\':
+            # Escaped character
+            pos = m.end() + 1
+            continue
+        elif c == b'(':
+            depth += 1
+        else:
+            depth -= 1
+        pos = m.end()
+
+    return pos
+
+def marked_content_operations(data):
+    """ Scan the decoded content stream data of a page and return the
+    list of (operands, operator) for its marked content operators
+    (BMC, BDC, EMC), its XObject (Do) operators and the text showing
+    operators inside /Artifact marked content """
+
+    operations = []
+    # Start of the operands of the next operator
+    start = None
+    # Nesting of arrays and dictionaries
+    depth = 0
+    # Tags of the marked content sequences the
+    # scan is in, innermost last
+    tags = []
+    pos, end = 0, len(data)
+
+    while pos < end:
+        m = token_re.match(data, pos)
+        if m is None:
+            # Stray delimiter like ')' - skip it
+            pos += 1
+            continue
+
+        comment, delim, hexstr, literal, name, token = m.groups()
+        tokstart = m.start(m.lastindex)
+        pos = m.end()
+
+        if comment:
+            continue
+
+        if token is not None:
+            if depth == 0 and (token[0:1].isalpha() or token in (b"'", b'"')):
+                # Operator
+                keep = (token in marked_content_ops) or (token == b'Do') or \
+                       (token in text_ops and '/Artifact' in tags)
+
+                if keep:
+                    if start is None:
+                        operands = []
+                    else:
+                        operands = read_operands(data[start:tokstart])
+
+                    operations.append((operands, token))
+
+                    if token in (b'BMC', b'BDC'):
+                        tags.append(operands[0] if len(operands) else None)
+                    elif token == b'EMC' and len(tags):
+                        tags.pop()
+
+                elif token == b'ID':
+                    # Inline image data, skip till 'EI'
+                    m = inline_image_end_re.search(data, pos + 1)
+                    if m is None:
+                        break
+                    pos = m.end()
+
+                start = None
+                continue
+
+        if start is None:
+            start = tokstart
+
+        if delim is not None:
+            if delim in (b'<<', b'['):
+                depth += 1
+            elif delim in (b'>>', b']'):
+                depth = max(depth - 1, 0)
+        elif hexstr is not None:
+            try:
+                pos = data.index(b'>', pos) + 1
+            except ValueError:
+                break
+        elif literal is not None:
+            pos = skip_literal(data, pos)
+
+    return operations
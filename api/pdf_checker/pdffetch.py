@@ -0,0 +1,383 @@
+""" Open PDF documents from local files, uploads and URLs for checking """
+
+import io
+import os
+import re
+import mmap
+import tempfile
+import requests
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import config
+from . import helper
+from . import pdfsniff
+
+# Size of the chunks read from the response
+CHUNK_SIZE = 64*1024
+
+# Like 'bytes 0-65535/1048576'
+content_range_re = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)$')
+
+# HTTP session of this process, created on first use
+session = None
+session_pid = None
+
+class MappedFile(mmap.mmap):
+    """ A read-only memory map of a file, which keeps its name """
+
+    name = None
+
+class PdfFetchError(Exception):
+    """ Errors fetching a PDF document """
+
+class PdfTooLargeError(PdfFetchError):
+    """ The PDF document is larger than the configured maximum size """
+
+class PdfNotPdfError(PdfFetchError):
+    """ The document fetched is not a PDF document """
+
+class PdfRangeStream(io.RawIOBase):
+    """ A read-only, seekable stream over a remote PDF document, which
+    downloads the blocks being read on demand with HTTP Range requests.
+    A missing block is fetched together with the missing blocks after
+    it (read ahead), in one request. Blocks are kept in a cache of
+    limited size and evicted in least recently used order """
+
+    # Data is fetched as it is read
+    lazy = True
+
+    def __init__(self, url, size, blocksize, readahead, maxblocks, maxtransfer):
+        self.url = url
+        self.size = size
+        self.blocksize = blocksize
+        self.readahead = readahead
+        self.maxblocks = maxblocks
+        # Maximum number of bytes to download
+        self.maxtransfer = maxtransfer
+        self.transferred = 0
+        self.requests = 0
+        self.blocks = OrderedDict()
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence (%r)' % whence)
+
+        if pos < 0:
+            raise ValueError('Negative seek position %d' % pos)
+
+        self.pos = pos
+        return pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.pos + size, self.size)
+
+        data = []
+        pos = self.pos
+        while pos < end:
+            index = pos // self.blocksize
+            offset = pos - index*self.blocksize
+            chunk = self.get_block(index)[offset:offset + end - pos]
+            data.append(chunk)
+            pos += len(chunk)
+
+        self.pos = max(pos, self.pos)
+        return b''.join(data)
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def add_block(self, index, data):
+        """ Add a block to the cache """
+
+        self.blocks[index] = data
+        while len(self.blocks) > self.maxblocks:
+            self.blocks.popitem(last=False)
+
+    def get_block(self, index):
+        """ Return the block with the given index, fetching it with
+        the missing blocks after it if it is not cached """
+
+        try:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        except KeyError:
+            pass
+
+        nblocks = (self.size + self.blocksize - 1) // self.blocksize
+        last = index
+        while (last + 1 < min(index + self.readahead, nblocks)) and (last + 1) not in self.blocks:
+            last += 1
+
+        start = index*self.blocksize
+        end = min((last + 1)*self.blocksize, self.size) - 1
+        data = self.get_range(start, end)
+
+        for i in range(index, last + 1):
+            offset = (i - index)*self.blocksize
+            self.add_block(i, data[offset:offset + self.blocksize])
+
+        return self.blocks[index]
+
+    def get_range(self, start, end):
+        """ Download the bytes start..end (inclusive) of the document """
+
+        if self.transferred + (end - start + 1) > self.maxtransfer:
+            raise PdfTooLargeError('Reading PDF document %s needs more than %d bytes' % (self.url, self.maxtransfer))
+
+        timeout = (float(config.pdfwamconnecttimeout), float(config.pdfwamreadtimeout))
+        try:
+            response = get_session().get(self.url, headers={'Range': 'bytes=%d-%d' % (start, end)},
+                                         timeout=timeout)
+        except requests.RequestException as e:
+            raise PdfFetchError('Error fetching %s: %s' % (self.url, str(e)))
+
+        data = response.content
+        response.close()
+
+        if response.status_code != 206 or len(data) != (end - start + 1):
+            raise PdfFetchError('Error fetching bytes %d-%d of %s: status %d, got %d bytes' % (start, end, self.url,
+                                                                                                 response.status_code,
+                                                                                                 len(data)))
+
+        self.transferred += len(data)
+        self.requests += 1
+        return data
+
+def is_url(source):
+    """ Return whether the given source is a URL """
+
+    return source.startswith('http://') or source.startswith('https://')
+
+def max_size():
+    """ Return the maximum size of a PDF document in bytes """
+
+    return int(float(config.pdfmaxsize)*1024*1024)
+
+def get_session():
+    """ Return the HTTP session shared by all fetches of this process.
+    It keeps up to pdfwamfetchpoolsize connections alive per host and
+    blocks when they are all in use, and retries failed connections
+    and server errors pdfwamfetchretries times with exponential
+    backoff (pdfwamfetchbackoff) """
+
+    global session, session_pid
+
+    # Connections can't be shared with a forked process
+    if session is None or session_pid != os.getpid():
+        retry = Retry(total=int(config.pdfwamfetchretries),
+                      backoff_factor=float(config.pdfwamfetchbackoff),
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=('GET', 'HEAD'),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=int(config.pdfwamfetchpoolsize),
+                              pool_block=True,
+                              max_retries=retry)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session_pid = os.getpid()
+
+    return session
+
+def fetch(url, maxsize=None):
+    """ Fetch the PDF document at the given URL and return it as
+    a seekable stream, positioned at the start. Goes through the
+    URL cache if pdfwamurlcache is set, which needs the complete
+    documents. Otherwise large documents are read lazily with Range
+    requests if pdfwamrangefetch is set """
+
+    if int(config.pdfwamurlcache):
+        # Imported here since pdfcache imports this module
+        from . import pdfcache
+
+        try:
+            return pdfcache.get_url_cache().fetch(url, maxsize)
+        except OSError as e:
+            helper.get_logger().error('Error using URL cache, fetching without it: [%s]' % str(e))
+    elif int(config.pdfwamrangefetch):
+        return open_range(url, maxsize)
+
+    return download(url, maxsize)[0]
+
+def open_range(url, maxsize=None):
+    """ Return a PdfRangeStream for the PDF document at the given URL,
+    if the server supports Range requests and the document is at least
+    pdfwamrangeminsize MB. Otherwise the document is downloaded. At
+    most maxsize bytes (default pdfmaxsize MB) of the document are
+    downloaded, of documents up to pdfwamrangemaxsize MB """
+
+    if maxsize is None:
+        maxsize = max_size()
+
+    blocksize = int(config.pdfwamrangeblocksize)*1024
+    readahead = max(int(config.pdfwamrangereadahead), 1)
+    timeout = (float(config.pdfwamconnecttimeout), float(config.pdfwamreadtimeout))
+
+    # Ask for the first blocks, the reply tells whether
+    # ranges are supported and the size of the document
+    try:
+        response = get_session().get(url, headers={'Range': 'bytes=0-%d' % (blocksize*readahead - 1)},
+                                     stream=True, timeout=timeout)
+    except requests.RequestException as e:
+        raise PdfFetchError('Error fetching %s: %s' % (url, str(e)))
+
+    try:
+        m = content_range_re.match(response.headers.get('Content-Range', ''))
+        if response.status_code != 206 or m is None or int(m.group(1)) != 0:
+            # Ranges not supported
+            stream = None
+        else:
+            size = int(m.group(3))
+            if size > float(config.pdfwamrangemaxsize)*1024*1024:
+                raise PdfTooLargeError('PDF document %s is too large (%d bytes)' % (url, size))
+
+            if size < float(config.pdfwamrangeminsize)*1024*1024:
+                stream = None
+            else:
+                data = response.content
+                stream = PdfRangeStream(url, size, blocksize, readahead,
+                                        int(config.pdfwamrangecacheblocks), maxsize)
+                stream.transferred = len(data)
+                stream.requests = 1
+                for offset in range(0, len(data), blocksize):
+                    block = data[offset:offset + blocksize]
+                    # A partial block is complete only at the end
+                    if len(block) == blocksize or offset + len(block) == size:
+                        stream.add_block(offset // blocksize, block)
+    finally:
+        response.close()
+
+    if stream is None:
+        return download(url, maxsize)[0]
+
+    return stream
+
+def download(url, maxsize=None, headers=None):
+    """ Download the PDF document at the given URL, sending the given
+    extra request headers, and return a tuple of a seekable stream
+    positioned at the start and the response headers. The stream is
+    None if the server replies that the document is not modified.
+    The document is read in chunks and kept in memory up to
+    pdfwamspoolsize MB, and spooled to a temporary file beyond that.
+    Raises PdfTooLargeError if the document is larger than maxsize
+    bytes (default pdfmaxsize MB), and PdfNotPdfError as soon as the
+    start of the document shows it is not a PDF document """
+
+    if maxsize is None:
+        maxsize = max_size()
+
+    timeout = (float(config.pdfwamconnecttimeout), float(config.pdfwamreadtimeout))
+
+    try:
+        response = get_session().get(url, headers=headers, stream=True, timeout=timeout)
+    except requests.RequestException as e:
+        raise PdfFetchError('Error fetching %s: %s' % (url, str(e)))
+
+    try:
+        if response.status_code == 304:
+            return (None, response.headers)
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            raise PdfFetchError('Error fetching %s: %s' % (url, str(e)))
+
+        # Don't download at all if the server tells us
+        # the document is too large
+        length = response.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > maxsize:
+            raise PdfTooLargeError('PDF document %s is too large (%s bytes, maximum is %d bytes)' % (url, length, maxsize))
+
+        stream = tempfile.SpooledTemporaryFile(max_size=int(float(config.pdfwamspoolsize)*1024*1024))
+        size = 0
+        head = b''
+
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                # Stop as soon as it is clear this isn't a PDF
+                # document, like an HTML error or login page
+                if len(head) < pdfsniff.HEADER_WINDOW:
+                    head += chunk[:pdfsniff.HEADER_WINDOW]
+                    if len(head) >= pdfsniff.HEADER_WINDOW and pdfsniff.find_version(head) is None:
+                        raise PdfNotPdfError('%s is not a PDF document (%s)' % (url, pdfsniff.describe(head)))
+
+                size += len(chunk)
+                # Content-Length could be missing or wrong
+                if size > maxsize:
+                    raise PdfTooLargeError('PDF document %s is too large (more than %d bytes)' % (url, maxsize))
+                stream.write(chunk)
+        except requests.RequestException as e:
+            stream.close()
+            raise PdfFetchError('Error fetching %s: %s' % (url, str(e)))
+        except:
+            stream.close()
+            raise
+
+        if len(head) < pdfsniff.HEADER_WINDOW and pdfsniff.find_version(head) is None:
+            stream.close()
+            raise PdfNotPdfError('%s is not a PDF document (%s)' % (url, pdfsniff.describe(head)))
+    finally:
+        response.close()
+
+    stream.seek(0)
+    return (stream, response.headers)
+
+def map_file(path):
+    """ Return a read-only memory map of the file at path, which can
+    be used as a seekable stream. The file itself is closed already,
+    closing the map releases it """
+
+    with open(path, 'rb') as f:
+        try:
+            stream = MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return io.BytesIO()
+
+    stream.name = path
+    return stream
+
+def open_upload(upload):
+    """ Return an uploaded PDF document as a seekable stream. Uploads
+    spooled to a temporary file (like Django's TemporaryUploadedFile)
+    are memory mapped, those kept in memory are used as they are """
+
+    if hasattr(upload, 'temporary_file_path'):
+        return map_file(upload.temporary_file_path())
+
+    stream = getattr(upload, 'file', upload)
+    stream.seek(0)
+    return stream
+
+def open_source(source):
+    """ Open the given local file path or URL of a
+    PDF document and return it as a seekable stream """
+
+    if is_url(source):
+        return fetch(source)
+
+    return map_file(source)
@@ -0,0 +1,299 @@
+""" Pool of warm worker processes checking PDF documents
+
+Workers are forked from a fork server which imports the checker
+and pypdf once, so a new worker starts warm without importing
+anything. A worker is recycled, that is exits and is replaced
+by a fresh one, after it checked pdfwampoolmaxdocs documents or
+once its resident memory grows beyond pdfwampoolmaxrss MB, which
+gives back the memory a long running process would hold on to.
+
+Workers keep each check within pdfwamtimelimit seconds and their
+address space within pdfwammemorylimit MB (see pdfbudget). A check
+running out of either returns the results of the tests which were
+finished, marked as 'budget exceeded', and its worker is recycled.
+A worker stuck beyond the time limit, like in a C library call, is
+killed after KILL_GRACE more seconds.
+
+Workers read the configuration from the config module, so changes
+made to it at runtime in the parent process are not seen by them.
+As with any start method but fork, the main module of the program
+is imported by the workers, so it has to guard its code with
+if __name__ == '__main__'.
+
+"""
+
+import os
+import errno
+import resource
+import threading
+import multiprocessing
+
+from . import config
+from . import helper
+from . import pdfshard
+from . import pdfbudget
+from . import pdfAWAM
+from .check_accessibility import check_accessibility
+
+# Seconds after the time limit before a worker is killed
+KILL_GRACE = 5
+
+# Modules imported by the fork server
+preload_modules = [__package__ + '.check_accessibility', 'pypdf']
+
+class PdfWorkerError(Exception):
+    """ A worker died while checking a document """
+
+def rss():
+    """ Return the resident set size of this process in MB """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/(1024*1024)
+    except (OSError, ValueError, IndexError):
+        # Peak size, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def should_recycle(ndocs, max_docs=None, max_rss=None):
+    """ Return whether a worker which checked ndocs documents should
+    be recycled, by the given limits (default pdfwampoolmaxdocs and
+    pdfwampoolmaxrss MB, where 0 means no limit) """
+
+    if max_docs is None:
+        max_docs = int(config.pdfwampoolmaxdocs)
+    if max_rss is None:
+        max_rss = float(config.pdfwampoolmaxrss)
+
+    return bool((max_docs and ndocs >= max_docs) or (max_rss and rss() > max_rss))
+
+def check_budgeted(source, password, time_limit=0, memory_limit=0):
+    """ Check the PDF document within the time limit, in the main
+    thread of a worker process whose memory is limited to memory_limit
+    MB. Returns a (kind, value, over) tuple, where kind is 'result' or
+    'error' and over tells if the check ran out of its budget, in
+    which case the value is the partial result """
+
+    try:
+        pdfbudget.start_timer(time_limit)
+        try:
+            return ('result', check_accessibility(source, password=password), False)
+        finally:
+            pdfbudget.stop_timer()
+    except pdfAWAM.PdfWamBudgetExceeded as e:
+        return ('result', pdfbudget.budget_result(e.budget, e.result), True)
+    except pdfbudget.BudgetExceeded:
+        # Before the document was parsed, like while downloading
+        return ('result', pdfbudget.budget_result('time'), True)
+    except MemoryError:
+        return ('result', pdfbudget.budget_result('memory'), True)
+    except Exception as e:
+        # Like memory mapping a file beyond the limit
+        if isinstance(e, OSError) and e.errno == errno.ENOMEM and memory_limit:
+            return ('result', pdfbudget.budget_result('memory'), True)
+        return ('error', e, False)
+
+def worker_main(conn, max_docs, max_rss, time_limit, memory_limit):
+    """ Check the documents sent over the connection
+    till the worker is recycled """
+
+    ndocs = 0
+    pdfbudget.set_memory_limit(memory_limit)
+
+    while True:
+        try:
+            source, password = conn.recv()
+        except EOFError:
+            return
+
+        kind, value, over = check_budgeted(source, password, time_limit, memory_limit)
+
+        ndocs += 1
+        # Workers which ran out of a budget may be
+        # left in a bad state, and are recycled too
+        retire = over or should_recycle(ndocs, max_docs, max_rss)
+
+        try:
+            conn.send((kind, value, retire))
+        except Exception:
+            # Exceptions which can't be pickled
+            conn.send(('error', PdfWorkerError(str(value)), retire))
+
+        if retire:
+            return
+
+class PdfWorker(object):
+    """ A worker process and the connection to it """
+
+    def __init__(self, context, max_docs, max_rss, time_limit, memory_limit):
+        self.time_limit = time_limit
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=worker_main,
+                                       args=(child, max_docs, max_rss, time_limit, memory_limit),
+                                       daemon=True)
+        self.process.start()
+        child.close()
+
+    def check(self, source, password):
+        """ Return a (kind, value, retire) tuple, where kind is 'result'
+        or 'error' and retire tells if the worker is exiting """
+
+        try:
+            self.conn.send((source, password))
+            if self.time_limit and not self.conn.poll(self.time_limit + KILL_GRACE):
+                # Stuck where the timer can't stop it
+                self.process.kill()
+                return ('result', pdfbudget.budget_result('time'), True)
+            return self.conn.recv()
+        except (EOFError, OSError):
+            return ('error', PdfWorkerError('Worker died checking %s' % source), True)
+
+    def stop(self):
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+class PdfWorkerPool(object):
+    """ Pool of workers, started as they are needed. It can be
+    used from several threads, each check blocking the calling
+    thread till a worker is free and has checked the document """
+
+    def __init__(self, workers, max_docs=None, max_rss=None, time_limit=None, memory_limit=None):
+        self.workers = workers
+        if max_docs is None:
+            max_docs = int(config.pdfwampoolmaxdocs)
+        if max_rss is None:
+            max_rss = float(config.pdfwampoolmaxrss)
+        if time_limit is None:
+            time_limit = float(config.pdfwamtimelimit)
+        if memory_limit is None:
+            memory_limit = float(config.pdfwammemorylimit)
+        self.max_docs = max_docs
+        self.max_rss = max_rss
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.logger = helper.get_logger()
+
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(preload_modules)
+
+        # Idle workers, guarded by the condition which
+        # is notified when a worker is given back
+        self.idle = []
+        self.condition = threading.Condition()
+        # Workers running, idle or not
+        self.started = 0
+        self.recycled = 0
+
+    def get_worker(self):
+        """ Take an idle worker, starting one if there are less than
+        the number of workers, or else waiting for one """
+
+        with self.condition:
+            while True:
+                if self.idle:
+                    worker = self.idle.pop()
+                    if worker.process.is_alive():
+                        return worker
+                    # Killed while idle
+                    self.started -= 1
+                    continue
+                if self.started < self.workers:
+                    self.started += 1
+                    break
+                self.condition.wait()
+
+        try:
+            return PdfWorker(self.context, self.max_docs, self.max_rss,
+                             self.time_limit, self.memory_limit)
+        except:
+            with self.condition:
+                self.started -= 1
+                self.condition.notify()
+            raise
+
+    def put_worker(self, worker, retire):
+        """ Give back a worker, stopping it if it is retiring
+        so a new one is started in its place """
+
+        if retire:
+            worker.stop()
+
+        with self.condition:
+            if retire:
+                self.started -= 1
+                self.recycled += 1
+            else:
+                self.idle.append(worker)
+            self.condition.notify()
+
+    def check(self, source, password=''):
+        """ Check the PDF document at the given path or URL, or in
+        the given seekable stream, in a worker and return the result
+        as check_accessibility does. The result has a 'status' of
+        'budget exceeded' if the check was cut short """
+
+        if isinstance(source, str):
+            path, temporary = source, False
+        else:
+            path, temporary = pdfshard.stream_path(source)
+
+        try:
+            worker = self.get_worker()
+            try:
+                kind, value, retire = worker.check(path, password)
+            except BaseException:
+                # Like arguments which can't be pickled. The worker
+                # may be left half way through a message, so it is
+                # stopped, giving back its place in the pool
+                self.put_worker(worker, True)
+                raise
+            self.put_worker(worker, retire)
+        finally:
+            if temporary:
+                os.remove(path)
+
+        if retire:
+            self.logger.debug('Worker pool: recycled a worker')
+
+        if kind == 'error':
+            raise value
+
+        return value
+
+    def stats(self):
+        with self.condition:
+            return {'workers': self.workers, 'started': self.started, 'recycled': self.recycled}
+
+    def close(self):
+        """ Stop the idle workers """
+
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.started -= len(idle)
+
+        for worker in idle:
+            worker.stop()
+
+# Pool of this process, created on first use
+pool = None
+
+def get_pool():
+    """ Return the pool configured by the pdfwampool* settings """
+
+    global pool
+
+    if pool is None:
+        pool = PdfWorkerPool(int(config.pdfwampoolworkers))
+
+    return pool
+
+def check(source, password=''):
+    """ Check the given PDF document in the worker pool if
+    pdfwampool is set, or else in this process """
+
+    if int(config.pdfwampool):
+        return get_pool().check(source, password)
+
+    return check_accessibility(source, password=password)
@@ -0,0 +1,102 @@
+""" Page-sharded analysis of very large PDF documents
+
+The page-local checks (see PdfStruct.page_checks) of a document with
+many pages are run on contiguous shards of its pages by a pool of
+worker processes. Every worker opens the same file through a read-only
+memory map, so the pages are not copied into each process. The results
+are merged in page order, so they do not depend on which shard finishes
+first, and the tests pick them up through PdfStruct.page_result.
+
+"""
+
+import os
+import mmap
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from . import config
+from . import helper
+
+def shard_ranges(npages, nshards):
+    """ Split the pages 0..npages-1 into at most nshards
+    contiguous (start, stop) ranges """
+
+    size = max(-(-npages // max(nshards, 1)), 1)
+    return [(start, min(start + size, npages)) for start in range(0, npages, size)]
+
+def run_shard(path, password, start, stop):
+    """ Run the page-local checks on the pages start..stop-1 of the
+    PDF file at path and return the results as check name -> page
+    number -> result. This runs in a worker process """
+
+    # Imported here since pdfAWAM imports this module
+    from . import pdfAWAM
+
+    results = {}
+
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pdfobj = pdfAWAM.PdfReaderWrapper(data, password, helper.get_logger())
+            pdfobj.fix_indirect_object_xref()
+
+            for check, method in sorted(pdfobj.page_checks.items()):
+                func = getattr(pdfobj, method)
+                results[check] = dict([(pgnum, func(pgnum)) for pgnum in range(start, stop)])
+        finally:
+            data.close()
+
+    return results
+
+def stream_path(stream):
+    """ Return a (path, temporary) tuple for the file backing the given
+    stream. If the stream is not backed by a file, its data is written
+    to a temporary file which the caller has to remove """
+
+    name = getattr(stream, 'name', None)
+    if type(name) is str and os.path.isfile(name):
+        return (name, False)
+
+    pos = stream.tell()
+    stream.seek(0)
+
+    with tempfile.NamedTemporaryFile(prefix='pdfwam_', suffix='.pdf', delete=False) as f:
+        f.write(stream.read())
+
+    stream.seek(pos)
+    return (f.name, True)
+
+def analyze_pages(stream, password, npages, logger=None):
+    """ Run the page-local checks of the document in the given stream
+    on shards of its pages in a process pool and return the merged
+    results. Returns an empty dictionary if the sharded analysis fails,
+    in which case the checks are run in this process as usual """
+
+    if logger == None:
+        logger = helper.get_logger()
+
+    nworkers = max(int(config.pdfwamshardworkers), 1)
+    shards = shard_ranges(npages, nworkers)
+    logger.info('Analysing %d pages in %d shards' % (npages, len(shards)))
+
+    merged = {}
+    path, temporary = stream_path(stream)
+
+    try:
+        with ProcessPoolExecutor(max_workers=min(nworkers, len(shards))) as pool:
+            futures = [pool.submit(run_shard, path, password, start, stop) for start, stop in shards]
+            # Merge in page order
+            for future in futures:
+                for check, pages in future.result().items():
+                    try:
+                        merged[check].update(pages)
+                    except KeyError:
+                        merged[check] = pages
+    except Exception as e:
+        logger.error('Error in sharded analysis, falling back to serial: [%s]' % str(e))
+        return {}
+    finally:
+        if temporary:
+            os.remove(path)
+
+    return merged
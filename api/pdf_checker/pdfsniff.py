@@ -0,0 +1,90 @@
+""" Pre-flight sniffing of PDF documents
+
+Looks only at the first and last few KB of a document, to reject
+things which are not PDF documents (like HTML error pages) before
+they are fully downloaded or parsed, and to classify documents.
+
+"""
+
+import re
+import io
+from collections import namedtuple
+
+# The header has to be in the first KB of the file
+HEADER_WINDOW = 1024
+
+version_re = re.compile(rb'%PDF-(\d+\.\d+)')
+startxref_re = re.compile(rb'startxref\s+(\d+)')
+html_re = re.compile(rb'\s*<(!doctype|html|head|body|\?xml)', re.IGNORECASE)
+
+# What is known about a document from its head and tail. version
+# is None if there is no PDF header. startxref is the offset of the
+# last cross reference section, or None. trailer tells if there is a
+# 'trailer' keyword (documents with cross reference streams have none).
+# encrypted, linearized and tagged are True if '/Encrypt', '/Linearized'
+# and '/StructTreeRoot' are seen; False for encrypted and linearized
+# otherwise, but None (unknown) for tagged since the catalog can be
+# anywhere in the document.
+PdfSniffResult = namedtuple('PdfSniffResult', ('version', 'kind', 'startxref', 'trailer', 'eof',
+                                               'encrypted', 'linearized', 'tagged'))
+
+def find_version(head):
+    """ Return the PDF version from the header in
+    the given head of a document, or None """
+
+    m = version_re.search(head[:HEADER_WINDOW])
+    if m is None:
+        return None
+
+    return m.group(1).decode('ascii')
+
+def describe(head):
+    """ Return a description of what the document with the given head is """
+
+    if find_version(head) is not None:
+        return 'PDF document'
+    elif html_re.match(head):
+        return 'HTML document'
+    elif head.startswith(b'PK\x03\x04'):
+        return 'ZIP archive'
+    elif head.startswith(b'\x1f\x8b'):
+        return 'gzip file'
+    elif head.startswith((b'\x89PNG', b'\xff\xd8\xff', b'GIF8')):
+        return 'image'
+
+    return 'not a PDF document'
+
+def sniff(stream, size=4096):
+    """ Sniff the first and last size bytes of the document in
+    the given seekable stream and return a PdfSniffResult. The
+    stream is left at the start """
+
+    stream.seek(0, io.SEEK_END)
+    total = stream.tell()
+
+    stream.seek(0)
+    head = stream.read(size)
+
+    if total > size:
+        stream.seek(max(total - size, size))
+        tail = stream.read()
+    else:
+        tail = b''
+
+    stream.seek(0)
+
+    # The tail, overlapping the head for small documents
+    both = head + tail
+    tail = both[-size:]
+
+    startxref = None
+    for m in startxref_re.finditer(tail):
+        startxref = int(m.group(1))
+
+    tagged = None
+    if b'/StructTreeRoot' in both:
+        tagged = True
+
+    return PdfSniffResult(find_version(head), describe(head), startxref,
+                          b'trailer' in tail, b'%%EOF' in tail[-1024:],
+                          b'/Encrypt' in both, b'/Linearized' in head, tagged)
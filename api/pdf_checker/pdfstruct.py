@@ -1,12 +1,19 @@
 """ Provides class methods to query and perform operations on the PDF object structure """
 
 import re
+from io import BytesIO
 from . import helper
-import random
+from . import config
+from . import pdfcontent
+from collections import OrderedDict
 from pypdf.generic import *
 from pypdf.filters import *
 
 pdf_version_re = re.compile('PDF\-\d\.\d$')
+# Start of an indirect object like '12 0 obj'
+obj_header_re = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+# End of a stream dictionary
+stream_start_re = re.compile(rb'>>\s*stream(\r\n|\r|\n)')
     
 class PdfTblStructInvalidException(Exception):
     pass
@@ -117,12 +124,116 @@ class PdfTblStruct(object):
 
         return 1
         
+class PdfContentCache(object):
+    """ A per-document LRU cache of what is parsed or scanned from
+    page content streams, bounded by the size of the decoded content
+    the entries were made from. Keys are like (kind, page number) """
+
+    def __init__(self, maxsize):
+        # Budget in bytes of decoded content
+        self.maxsize = maxsize
+        self.size = 0
+        # Key -> (value, size)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the cached value for the given key, or None """
+
+        try:
+            value, size = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # Most recently used
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def add(self, key, value, size):
+        """ Cache the value for the given key, evicting the least
+        recently used entries to stay within budget """
+
+        # Too big to be cached at all
+        if size > self.maxsize:
+            return
+
+        try:
+            self.size -= self.entries.pop(key)[1]
+        except KeyError:
+            pass
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while self.size > self.maxsize:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+class PdfImage(object):
+    """ An image XObject in the image catalog of a PDF document """
+
+    def __init__(self, ref, image):
+        # Indirect reference to the image object
+        self.ref = ref
+        # Pages (numbers starting at 1) on which the image is used
+        self.pages = set()
+        self.width = image.get('/Width')
+        self.height = image.get('/Height')
+        # Image masks are 1 bit images without '/BitsPerComponent'
+        if image.get('/ImageMask'):
+            self.bits = 1
+        else:
+            self.bits = image.get('/BitsPerComponent')
+
+        # Filter chain, as a tuple of filter names
+        filters = image.get('/Filter', ())
+        if type(filters) not in (list, tuple, ArrayObject):
+            filters = (filters,)
+        self.filters = tuple([str(f) for f in filters])
+
+    def get_object(self):
+        return self.ref.get_object()
+
 class PdfStruct(object):
     """ Provide structure and methods on the enclosing PDF object """
 
     # NOTE - This has to be used as a mixin or parent class for
     # a class that inherits from pypdf.PdfReader. It does not work
     # on its own.
+
+    # Page-local checks, i.e those whose result for a page depends
+    # only on that page. Check name -> method taking the page number
+    # (starting at 0). These can be run on shards of the pages in
+    # worker processes, see pdfshard.
+    page_checks = {'external_links': '_has_external_links',
+                   'multimedia': '_has_multimedia',
+                   'scanned': '_get_is_scanned',
+                   'tab_order': '_has_tab_order'}
+
+    def page_result(self, check, pgnum):
+        """ Return the result of a page-local check for the given page
+        (starting at 0), taking it from the results of the page shards
+        if the document was analysed in shards """
+
+        try:
+            return self.page_results[check][pgnum]
+        except KeyError:
+            pass
+
+        # Cache the result per page
+        result = getattr(self, self.page_checks[check])(pgnum)
+        try:
+            self.page_results[check][pgnum] = result
+        except KeyError:
+            self.page_results[check] = {pgnum: result}
+
+        return result
+
     def fix_indirect_object_xref(self):
         """ Fix indirect cross object references """
 
@@ -244,6 +355,46 @@ class PdfStruct(object):
 
         return content
 
+    def page_operations(self, pgnum):
+        """ Given a page number, return the list of [operands, operator]
+        of its content stream. The content stream of a page is decoded
+        and parsed only once, as long as it fits in the content cache """
+
+        operations = self.content_cache.get(('operations', pgnum))
+        if operations is not None:
+            return operations
+
+        cs = self.content_stream(pgnum)
+        if cs is None:
+            return []
+
+        # Size of the decoded content, which is what is parsed
+        size = len(cs.get_data())
+        operations = cs.operations
+        self.content_cache.add(('operations', pgnum), operations, size)
+
+        return operations
+
+    def marked_content(self, pgnum):
+        """ Given a page number, return the list of [operands, operator]
+        of its marked content, XObject and artifact text operators only.
+        The content stream of a page is scanned only once, as long as it
+        fits in the content cache """
+
+        operations = self.content_cache.get(('marked', pgnum))
+        if operations is not None:
+            return operations
+
+        cs = self.content_stream(pgnum)
+        if cs is None:
+            return []
+
+        data = cs.get_data()
+        operations = pdfcontent.marked_content_operations(data)
+        self.content_cache.add(('marked', pgnum), operations, len(data))
+
+        return operations
+
     def has_bookmarks(self):
         """ Return whether the PDF document has bookmarks """
 
@@ -293,8 +444,8 @@ class PdfStruct(object):
             # Don't bother with pages containing no text
             return False
 
-        conts = self.content_stream(pgnum)
-        if conts != None:
+        operations = self.page_operations(pgnum)
+        if len(operations):
             # If operand is a 6 member integer list it indicates
             # the pixel/dimension extents of the box in which the
             # data is to be painted. Something like
@@ -306,7 +457,7 @@ class PdfStruct(object):
             # page, otherwise x2 will be same. The operator
             # is either 'Tm', 'cm' etc.
             text_extents = []
-            for x,y in conts.operations:
+            for x,y in operations:
                 if type(x) is list and len(x)==6:
                     text_extents.append(([float(item) for item in x], y))
 
@@ -449,7 +600,7 @@ class PdfStruct(object):
         to external objects """
 
         for pgnum in range(0, len(self.pages)):
-            if self._has_external_links(pgnum):
+            if self.page_result('external_links', pgnum):
                 return True
 
         return False
@@ -459,11 +610,20 @@ class PdfStruct(object):
         to multimedia """
 
         for pgnum in range(0, len(self.pages)):
-            if self._has_multimedia(pgnum):
+            if self.page_result('multimedia', pgnum):
                 return True
 
         return False
 
+    def _has_tab_order(self, pgnum):
+        """ Return whether the tab order of the page
+        follows the structure order """
+
+        try:
+            return self.pages[pgnum]['/Tabs'] == '/S'
+        except KeyError:
+            return False
+
     def has_embedded_multimedia(self):
         """ Find out if the PDF document contains an
         embedded multimedia file or attachment """
@@ -696,35 +856,150 @@ class PdfStruct(object):
         except (KeyError, ValueError, AssertionError) as e:
             pass
 
+    def iter_structure_tree(self, tree):
+        """ Return an iterator over the structure elements of the
+        given structure tree branch, in document order """
+
+        # This walks the tree using an explicit stack, so deep trees
+        # don't hit the recursion limit. Indirect objects are visited
+        # only once, keyed by their (idnum, generation), so nested
+        # elements are not walked again and self-referencing /K
+        # entries can't make the walk loop forever.
+        visited = set()
+        self.struct_nodes = 0
+        self.struct_revisits = 0
+
+        stack = [tree]
+
+        while len(stack):
+            item = stack.pop()
+
+            if type(item) is IndirectObject:
+                ref = (item.idnum, item.generation)
+                if ref in visited:
+                    self.struct_revisits += 1
+                    continue
+
+                visited.add(ref)
+                try:
+                    item = item.get_object()
+                except Exception as e:
+                    self.logger.error('Error resolving structure element %d %d: [%s]' % (ref[0], ref[1], str(e)))
+                    continue
+
+            if type(item) in (list, ArrayObject):
+                # Reversed, so that kids are popped in order
+                stack.extend(reversed(item))
+            elif type(item) in (dict, DictionaryObject):
+                self.struct_nodes += 1
+                yield item
+
+                # Take the kids without resolving them, so
+                # that their references can be tracked.
+                if type(item) is DictionaryObject:
+                    kids = item.raw_get('/K') if '/K' in item else None
+                else:
+                    kids = item.get('/K')
+
+                if kids is not None:
+                    stack.append(kids)
+            # Anything else (like marked content ids) is a leaf
+
+    def resource_key(self, res):
+        """ Return the key of a resources dictionary in the resource
+        table, its indirect reference if it has one, otherwise a key
+        made from its structure """
+
+        if type(res) is IndirectObject:
+            return (res.idnum, res.generation)
+
+        ref = getattr(res, 'indirect_reference', None)
+        if ref is not None:
+            return (ref.idnum, ref.generation)
+
+        return self.structure_key(res)
+
+    def structure_key(self, obj):
+        """ Return a hashable key from the structure of an inline
+        object, using references for indirect objects in it """
+
+        if type(obj) is IndirectObject:
+            return ('R', obj.idnum, obj.generation)
+        elif isinstance(obj, dict):
+            return ('D',) + tuple(sorted([(str(k), self.structure_key(v)) for k, v in obj.items()]))
+        elif isinstance(obj, list):
+            return ('A',) + tuple([self.structure_key(v) for v in obj])
+
+        return ('V', str(obj))
+
+    def build_resource_table(self):
+        """ Intern the /Resources dictionaries of all pages, so that
+        pages sharing the same resources share a resource id """
+
+        # Resource id -> resources dictionary
+        self.resource_table = []
+        # Page index -> resource id (None if page has no resources)
+        self.page_resource_ids = []
+        ids = {}
+
+        for pgnum in range(len(self.pages)):
+            pg = self.pages[pgnum]
+            try:
+                res = pg.raw_get('/Resources')
+                key = self.resource_key(res)
+            except KeyError:
+                self.page_resource_ids.append(None)
+                continue
+            except Exception as e:
+                self.logger.error("Error getting resource tree", e)
+                self.page_resource_ids.append(None)
+                continue
+
+            try:
+                rid = ids[key]
+            except KeyError:
+                rid = len(self.resource_table)
+                ids[key] = rid
+                self.resource_table.append(res.get_object())
+
+            self.page_resource_ids.append(rid)
+
+        self.logger.info('Resource table: %d pages, %d unique resources' % (len(self.page_resource_ids),
+                                                                           len(self.resource_table)))
+
+    def get_resource_id(self, pgnum=0):
+        """ Return the resource id of the given page """
+
+        if self.resource_table is None:
+            self.build_resource_table()
+
+        try:
+            return self.page_resource_ids[pgnum]
+        except IndexError:
+            return None
+
     def get_resource_tree(self, pgnum=0):
         """ Returns the resource tree """
 
-        try:
-            # import pdb;pdb.set_trace()
-            return self.pages[pgnum]['/Resources']
-        except Exception as e:
-            self.logger.error("Error getting resource tree", e)
+        rid = self.get_resource_id(pgnum)
+        if rid is not None:
+            return self.resource_table[rid]
 
     def resource_iterator(self):
         """ Return an iterator on all unique resource trees """
 
-        # This is an odd-way of creating an iterator
-        # but I want to make sure, we don't have duplicates
-        all_res = []
-
-        for x in range(len(self.pages)):
-            res = self.get_resource_tree(x)
-            try:
-                all_res.index(res)
-            except ValueError:
-                all_res.append(res)
+        if self.resource_table is None:
+            self.build_resource_table()
 
-        return all_res
+        return self.resource_table
 
     def get_is_scanned(self):
         """ Returns whether the PDF is a scanned document,
         by inspecting the resource structure """
 
+        # Scanned and sampled pages
+        self.scanned_pages = (0, 0)
+
         # Check list of producers first
         if self.producer:
             prodl = [prod.lower() for prod in self.scproducers]
@@ -741,26 +1016,64 @@ class PdfStruct(object):
         # This more rigorous check added after
         # http://www.eu2005.lu/en/savoir_lux/lux_publications/livre_presidence/grand_duche.pdf
         # returned as a scanned PDF wrongly!
-        # Check for upto 3 pages
-        pgnum = len(self.pages)
-        if pgnum==1:
-            return self._get_is_scanned()
-        elif pgnum==2:
-            # Check pages 1 & 2
-            return self._get_is_scanned() and self._get_is_scanned(1)
-        elif pgnum>2:
-            # Check 1st page and 2 random pages
-            pg1 = random.randrange(0, pgnum)
-            pg2 = random.randrange(0, pgnum)
-            return self._get_is_scanned() and \
-                   self._get_is_scanned(pg1) and \
-                   self._get_is_scanned(pg2)
+        # The document is scanned only if all the sampled pages
+        # look scanned, so stop at the first one which does not.
+        nscanned, nsampled = 0, 0
+        for pgnum in self.sample_pages(int(config.pdfwamscansample)):
+            nsampled += 1
+            if not self.page_result('scanned', pgnum):
+                break
+            nscanned += 1
+
+        self.scanned_pages = (nscanned, nsampled)
+        return (nsampled > 0) and (nscanned == nsampled)
+
+    def sample_pages(self, budget):
+        """ Return a deterministic, stratified sample of at most
+        budget page numbers (starting at 0). The pages are split
+        into budget strata of equal size and the middle page of
+        each is taken, except for the first stratum which
+        gives the first page """
+
+        npages = len(self.pages)
+        budget = max(budget, 1)
+        if npages <= budget:
+            return list(range(npages))
+
+        return [0] + [((2*i + 1)*npages) // (2*budget) for i in range(1, budget)]
+
+    def get_scanned_fraction(self):
+        """ Return the fraction of the pages sampled by the last
+        scan check which look image-only, or None if no pages
+        were sampled """
+
+        nscanned, nsampled = self.scanned_pages
+        if nsampled == 0:
+            return None
+
+        return float(nscanned) / nsampled
     
     def _get_is_scanned(self, pgnum=0):
         """ Return whether document is scanned w.r.t the given page """
 
+        # The result depends only on the resources of the
+        # page, so it is computed once per resource id
+        rid = self.get_resource_id(pgnum)
+        if rid is None:
+            return False
+
+        try:
+            return self.resource_scanned[rid]
+        except KeyError:
+            scanned = self._resource_is_scanned(self.resource_table[rid])
+            self.resource_scanned[rid] = scanned
+            return scanned
+
+    def _resource_is_scanned(self, res):
+        """ Return whether the given resources look like those
+        of a scanned page, images but no fonts """
+
         # Check presence of '/Font' resource
-        res = self.get_resource_tree(pgnum)
         font= '/Font' in res
         # Make sure the font resource is not empty
         if font:
@@ -784,49 +1097,159 @@ class PdfStruct(object):
         if not hasattr(xobj, 'values'):
             return False
 
-        img = xobj and '/Image' in [item.get_object().get('/Subtype') for item in list(xobj.values()) if item]
+        img = xobj and '/Image' in [self.xobject_dict(item).get('/Subtype') for item in list(xobj.values()) if item]
         # Flag as scanned if font is missing and has at least 1 image
         return (not font) and img
 
-    def image_iterator(self):
-        """ An iterator over the images in the current PDF object """
+    def xobject_dict(self, obj):
+        """ Return the dictionary of an XObject. For documents read
+        lazily over the network, only the dictionary of an XObject not
+        read yet is parsed, without its stream data, which can be large
+        for images. The data is read when the object itself is needed """
 
-        allimgs = []
+        if type(obj) is IndirectObject and getattr(self.stream, 'lazy', False) and \
+           not self.is_encrypted and \
+           self.cache_get_indirect_object(obj.generation, obj.idnum) is None:
+            try:
+                item = self._read_stream_dict(obj)
+            except Exception as e:
+                self.logger.debug('Error reading dictionary of', obj, e)
+                item = None
 
-        for pgnum in range(len(self.pages)):
-            pg = self.pages[pgnum]
-            xobj = None
+            if item is not None:
+                return item
+
+        return obj.get_object()
+
+    def _read_stream_dict(self, ref):
+        """ Parse the dictionary of the stream object with the given
+        reference from the document, or return None if it can't be
+        found in the first KB of the object """
+
+        try:
+            offset = self.xref[ref.generation][ref.idnum]
+        except KeyError:
+            return None
+
+        self.stream.seek(offset)
+        window = self.stream.read(4096)
+
+        m = obj_header_re.match(window)
+        if m is None or int(m.group(1)) != ref.idnum:
+            return None
+
+        end = stream_start_re.search(window, m.end())
+        if end is None:
+            return None
+
+        item = read_object(BytesIO(window[m.end():end.start() + 2].lstrip()), self)
+        if not isinstance(item, DictionaryObject):
+            return None
 
-            res = pg['/Resources']
+        return item
 
+    def build_image_catalog(self):
+        """ Build the catalog of image XObjects used in the document,
+        including those inside form XObjects. Images are keyed by
+        their indirect reference so each appears only once """
+
+        self.image_catalog = {}
+        # Page number -> list of images on the page
+        self.page_images = {}
+        # Resource id -> list of images used by the resources
+        res_images = {}
+
+        for pgnum in range(len(self.pages)):
+            rid = self.get_resource_id(pgnum)
+            if rid is None:
+                self.page_images[pgnum+1] = []
+                continue
+
+            # Pages sharing resources share the image list
             try:
-                xobj = res['/XObject']
+                imgs = res_images[rid]
             except KeyError:
+                imgs = self._resource_images(self.resource_table[rid])
+                res_images[rid] = imgs
+
+            for img in imgs:
+                img.pages.add(pgnum+1)
+            self.page_images[pgnum+1] = imgs
+
+    def _resource_images(self, res):
+        """ Return the list of images in the given resources,
+        adding them to the image catalog """
+
+        imgs = []
+        # Images and form XObjects seen in these resources
+        seen, forms = set(), set()
+        stack = [res]
+
+        while len(stack):
+            res = stack.pop()
+            try:
+                xobj = res.get_object()['/XObject'].get_object()
+            except (KeyError, TypeError, AttributeError):
+                continue
+
+            if not hasattr(xobj, 'items'):
+                continue
+
+            for name, ref in list(xobj.items()):
+                # XObjects are streams, which are always indirect
+                if type(ref) is not IndirectObject:
+                    continue
+
+                key = (ref.idnum, ref.generation)
                 try:
-                    xobj = res.get('/XObject')
-                except:
-                    pass
+                    item = self.xobject_dict(ref)
+                    subtype = item.get('/Subtype')
+                except Exception as e:
+                    self.logger.error('Error getting XObject %s: [%s]' % (name, str(e)))
+                    continue
 
-            if xobj is not None and hasattr(xobj, 'values'):
-                count = 0
-                for item in list(xobj.values()):
-                    if item != None and item.get_object().get('/Subtype') in ('/Image'):
-                        item = item.get_object()
-                        try:
-                            allimgs.index(item)
-                        except ValueError:
-                            allimgs.append(item)
-                            count += 1
-                            yield item
+                if subtype == '/Image':
+                    try:
+                        img = self.image_catalog[key]
+                    except KeyError:
+                        img = PdfImage(ref, item)
+                        self.image_catalog[key] = img
+
+                    if key not in seen:
+                        seen.add(key)
+                        imgs.append(img)
+                elif subtype == '/Form' and key not in forms:
+                    forms.add(key)
+                    if '/Resources' in item:
+                        stack.append(item['/Resources'])
+
+        return imgs
+
+    def get_image_catalog(self):
+        """ Return the image catalog, building it if needed """
+
+        if self.image_catalog is None:
+            self.build_image_catalog()
+
+        return self.image_catalog
+
+    def get_page_images(self, pgnum):
+        """ Return the images used on the page with the
+        given number (starting at 1) """
+
+        self.get_image_catalog()
+        return self.page_images.get(pgnum, [])
+
+    def image_iterator(self):
+        """ An iterator over the images in the current PDF object """
+
+        for img in list(self.get_image_catalog().values()):
+            yield img.get_object()
 
     def get_num_images(self):
         """ Return number of images in the PDF file """
 
-        count = 0
-        for x in self.image_iterator():
-            count += 1
-
-        return count
+        return len(self.get_image_catalog())
 
     def get_num_artifact_imags(self):
         """ Return number of images which are artifacts """
@@ -879,11 +1302,12 @@ class PdfStruct(object):
         # starting from ['/Artifact'...] ending with ['EMC']
         # as a generator
 
-        cs = self.content_stream(pgnum)
         mark = 0
         artElems = []
 
-        for operands, operator in cs.operations:
+        # Only the marked content of the page is needed here, so
+        # the content stream is scanned instead of fully parsed.
+        for operands, operator in self.marked_content(pgnum):
             # like (['/Artifact'], 'BMC') or
             # like (['/Artifact', {}], 'BDC')
             # Bug #273 with URL https://www.sor.no/Documents/organisasjon/S%C3%B8r-Pluss-informasjonsdokument-20130529.pdf
@@ -911,25 +1335,19 @@ class PdfStruct(object):
         """ Return if the document or any image in the
         document is LZW encoded """
 
-        is_lzw = False
-
-        # For each image object try to see if it is
-        # LZW encoded
-        for i in self.image_iterator():
-            f = i.get('/Filter', '')
-            if f == 'LZWDecode':
+        # For each image object see if LZW is
+        # one of its filters
+        for img in list(self.get_image_catalog().values()):
+            if ('/LZWDecode' in img.filters) or ('/LZW' in img.filters):
                 return True
-            elif f=='':
+            elif len(img.filters) == 0:
                 try:
                     # No filter given, try LZWDecode
-                    l=LZWDecode.decode(i.getData())
+                    LZWDecode.decode(img.get_object().get_data())
                     # Decoding success, is lzw encoded
                     return True
                 except Exception as e:
                     # Not LZW encoded
-                    return False
-            else:
-                # Some other filter
-                pass
+                    pass
 
         return False
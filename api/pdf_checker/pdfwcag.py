@@ -2,6 +2,7 @@ import re
 import json
 import collections
 from . import pdfstruct
+from . import pdfsniff
 import logging
 from . import config
 from . import helper
@@ -23,6 +24,8 @@ class PdfWCAG(pdfstruct.PdfStruct):
     version_re = re.compile(r'\%PDF-\d+\.\d+', re.IGNORECASE)
     # Header types
     header_re = re.compile(r'/h[1-9]',re.IGNORECASE)
+    # Header structure types collected from the structure tree
+    header_types = tuple(['/H%d' % i for i in range(1, 10)] + ['/h%d' % i for i in range(1, 10)])
     # Parsed form field element types
     # (from WCAG 2.0 techniques)
     form_elems = ('/Tx','/Btn','/Ch','/Sig')
@@ -64,6 +67,12 @@ class PdfWCAG(pdfstruct.PdfStruct):
                     'wcag.pdf.15': 'submit buttons in forms',
                     'wcag.pdf.17': 'consistent page-numbers' }
 
+    # Page-local checks of the tests, in addition to
+    # those of the structure class
+    page_checks = dict(pdfstruct.PdfStruct.page_checks,
+                       bg_images='page_bg_images',
+                       pagination='page_pagination_keys')
+
     is_scanned = property(lambda self: self.get_is_scanned(), None, None)
     struct_tree = property(lambda self:self.get_structure_tree(), None, None)
     font = property(lambda self: self.get_font_resource(), None, None)
@@ -102,27 +111,43 @@ class PdfWCAG(pdfstruct.PdfStruct):
                         'egovmon.pdf.03': 'EIAO.A.10.3.2.4.PDF.1.1'
                         }
 
+        # AWAM handler, created by init()
+        self.awamHandler = None
         self.n_artifact_imgs = 0
+        # Resource table, built on first use
+        self.resource_table = None
+        self.page_resource_ids = []
+        # Resource id -> whether it looks scanned
+        self.resource_scanned = {}
+        # Scanned and sampled pages of the scan check
+        self.scanned_pages = (0, 0)
+        # Image catalog, built on first use
+        self.image_catalog = None
+        self.page_images = {}
+        # Parsed page content, shared by all the tests
+        self.content_cache = pdfstruct.PdfContentCache(int(config.pdfwamcontentcache)*1024*1024)
+        # Results of the page-local checks computed on page
+        # shards, as check name -> page number -> result
+        self.page_results = {}
         self.memo = {}
         self.verbose = verbose
         # Logger
         self.logger = helper.get_logger()        
-        # Read the PDF for signature
-        # self.read(self.stream)
+        # Result of sniffing the PDF, set by read()
+        self.preflight = None
         
     def read(self, stream):
-        """ Read the PDF file """
+        """ Sniff the PDF file before it is parsed, rejecting it
+        if it is not a PDF document """
 
-        # Rewind stream to beginning
-        stream.seek(0)
-        # This just reads the PDF version
+        # This only reads the head and the tail of the file
         # Rest is handled by pyPdf.
-        s = stream.read(8).decode("utf-8")
-        if not self.version_re.match(s):
+        self.preflight = pdfsniff.sniff(stream, int(config.pdfwamsniffsize)*1024)
+        if self.preflight.version is None:
             self.logger.error("PdfStructureError: Missing PDF version marker!")
-            raise PdfStructureError('Error - missing PDF version marker!')
+            raise PdfStructureError('Error - missing PDF version marker (%s)!' % self.preflight.kind)
 
-        self.version = s.replace('%PDF-','')
+        self.version = self.preflight.version
         
     def fill_info(self):
         """ Fill metadata information for the document """
@@ -208,15 +233,28 @@ class PdfWCAG(pdfstruct.PdfStruct):
         # Fill in the meta AWAM ids
         # awamHandler is the object
         self.awamHandler=PdfAWAMHandler(roleMap=roleMap,debug=0,
+                                        getPageNumber=self.get_page_number,
+                                        getPageImages=self.get_page_images,
                                         validateImages=int(config.pdfwamvalidateimgs),
                                         ignoreSingleBitImgs=int(config.pdfwamignoresinglebitimgs))
         # awam_handler is the function!
         self.awam_handler=self.awamHandler.handler
+        # Structure elements which the document tests collect
+        # during the walk of the structure tree
+        self.headerEls = {}
+        self.awamHandler.register(self.header_types, self.collect_header)
 
         # Initialize all AWAM IDs
         for awamid in list(self.awamids.values()):
             self.awamHandler.resultMap[awamid] = {(0,1): 0}
 
+    def collect_header(self, element):
+        """ Collect a header element of the structure tree, in
+        document order and without duplicates """
+
+        if id(element) not in self.headerEls:
+            self.headerEls[id(element)] = element
+
     def set_awam_id(self, name, value=1, page=0):
         """ Set the value for the AWAM ID matching the given test """
 
@@ -264,6 +302,11 @@ class PdfWCAG(pdfstruct.PdfStruct):
 
         # Scanned PDF AWAM -> EGOVMON.PDF.08
         self.set_awam_id('egovmon.pdf.08', int(not self.get_is_scanned()))
+        self.logger.info('Scan check: %d of %d sampled pages look image-only' % self.scanned_pages)
+
+        # Walk the structure tree once, all structure element
+        # based checks below use what was collected in this walk
+        self.walk_structure_tree()
 
         # Consistent headers AWAM -> WCAG.PDF.09
         if (self.structroot != None) and (len(self.structroot) > 0):
@@ -292,119 +335,42 @@ class PdfWCAG(pdfstruct.PdfStruct):
             # (example: for the document tests/fw208_accessible.pdf)
             self.set_awam_id('egovmon.pdf.03', 1)
 
-        # If structroot is None or empty return
-        if (self.structroot==None) or (len(self.structroot)==0):
-            self.logger.warning("Empty structure tree root")
-            return
-
-        try:
-            # Search the /K kids of the structure tree root
-            if type(self.structroot['/K']) is list:
-                self.search(self.structroot['/K'])
-            else:
-                self.search(self.structroot['/K'].get_object())
-        except KeyError as ex:
-            self.logger.error('Error getting key "/K" from struct root:', ex)
-
         # Update the memo with WCAG.PDF.01 result
         handler = self.awamHandler
-        nimgs = len(handler.figureEls)
+        nimgs = len(handler.figures)
 
         if nimgs>0:
             # Some images are present so wcag.pdf.01 is applicable
-            nfimgs = len(handler.failedImgs)
+            nfimgs = sum([len(figs) for figs in handler.failedImgs.values()])
             self.memo['wcag.pdf.01'] = (nfimgs, nimgs - nfimgs)
 
-    def awam_dispatcher(self, item):
-        """ Dispatch function calls to AWAM handler """
+    def walk_structure_tree(self):
+        """ Walk the structure tree, dispatching every structure
+        element to the visitors registered with the AWAM handler """
 
-        if type(item) in (NameObject, NumberObject):
-            self.awam_handler(item)
-        elif type(item) in (dict, DictionaryObject, IndirectObject):
-            try:
-                if type(item['/S']) is IndirectObject:
-                    self.search(item['/S'])
-                else:
-                    self.awam_handler(item)
-                    # Ticket #125: Need to search recursively
-                    # into the Kids of this object, if any
-                    try:
-                        item_kids = item['/K']
-                        for k in item_kids:
-                            try:
-                                # This is important since a Kid might
-                                # be a number object, so it can cause
-                                # an exception and then control may
-                                # not pass on to next kid ! - this
-                                # caused a bug in wrong reporting of
-                                # link annotation test failure for OO
-                                # exported PDF documents.
-                                self.search(k.get_object())
-                            except:
-                                pass
-                    except:
-                        pass
-
-            except KeyError as e:
-                # FIXME: Check if this always should be pass
-                pass
-        else:
-            self.logger.error("PdfStructureError: invalid type of item",type(item))
-            raise PdfStructureError
-
-        return
-
-    def search(self, tree):
-        """ Traverse the PDF structure tree which is a PDF number tree """
+        # If structroot is None or empty return
+        if (self.structroot==None) or (len(self.structroot)==0):
+            self.logger.warning("Empty structure tree root")
+            return
 
-        # Print all items within the branch
-        if type(tree) in (NameObject, NumberObject):
+        try:
+            # Search the /K kids of the structure tree root
+            kids = self.structroot.raw_get('/K')
+        except KeyError as ex:
+            self.logger.error('Error getting key "/K" from struct root:', ex)
             return
 
-        if type(tree) in (IndirectObject, dict, DictionaryObject):
-            self.awam_dispatcher(tree)
-            # Try to search kids of this tree
+        for element in self.iter_structure_tree(kids):
             try:
-                self.search(tree['/K'])
-            except KeyError as e:
-                pass
-
-        elif type(tree) in (list, ArrayObject):
-            for item in tree:
-                item_obj = item.get_object()
-                self.awam_dispatcher(item_obj)
+                self.awam_handler(element)
+            except Exception as e:
+                # An element failing a check (like an invalid table
+                # structure) should not stop the walk, the failure
+                # is recorded by the handler.
+                self.logger.debug('Error handling structure element:', e)
 
-                try:
-                    l = item_obj['/K']
-                except KeyError:
-                    # Item has no kids.
-                    continue
-                except TypeError:
-                    # An object that is unsubscriptable
-                    # like a NumberObject
-                    continue
-                    
-
-                # Ticket #125: Need to check for type ArrayObject
-                # also, otherwise we might skip Kids of this
-                # object
-                if type(l) not in (list, ArrayObject):
-                    l = [l]
-
-                for kid in l:
-                    kid = kid.get_object()
-
-                    if type(kid) is IndirectObject:
-                        self.awam_dispatcher(kid)
-                    elif type(kid) in (dict, DictionaryObject):
-                        self.awam_dispatcher(kid)
-                    elif type(kid) is (int, NumberObject):
-                        self.awam_dispatcher(self.numstree[kid])
-        else:
-            self.logger.error("PdfStructureError: invalid type of item", type(tree))
-            raise PdfStructureError
-
-        return
+        self.logger.info('Structure tree walk: %d elements, %d revisits skipped' % (self.struct_nodes,
+                                                                                    self.struct_revisits))
 
     def document_headers_consistent(self):
         """ Return whether the document uses headers consistently.
@@ -420,39 +386,26 @@ class PdfWCAG(pdfstruct.PdfStruct):
             self.logger.error('Error accessing self.outline attribute - ', ex)
             # return True
 
-        # Load all pages info
-        # Flatten page dictionary
-        self._flatten()
-        pgs = self.flattened_pages
-
-        # Numbers dictionary, get all header types from it
-        vals = [v.get_object() for v in list(self.numstree.values())]
-
         headers = {}
         for count in range(len(self.pages)):
             headers[count+1] = []
 
-        for v in vals:
-            items = [item.get_object() for item in v]
-            for item in items:
+        # Header elements are collected during the structure tree walk
+        for item in list(self.headerEls.values()):
+            try:
+                # Get page to which the item belongs
                 try:
-                    if self.header_re.match(item['/S']):
-                        # Get page to which the item belongs
-                        try:
-                            item_pg = item['/Pg']
-                        except KeyError:
-                            print('No /Pg key found, checking inside /K')
-                            item_pg = item['/K']['/Pg']
-                        # Get page number
-                        try:
-                            pgnum = pgs.index(item_pg) + 1
-                            headers[pgnum].append(item)
-                        except ValueError:
-                            # Page not matching, skip this
-                            pass
-
-                except TypeError as e:
-                    pass
+                    item_pg = item['/Pg']
+                except KeyError:
+                    print('No /Pg key found, checking inside /K')
+                    item_pg = item['/K']['/Pg']
+                # Get page number
+                pgnum = self.get_page_number(item_pg)
+                if pgnum:
+                    headers[pgnum].append(item)
+
+            except (KeyError, TypeError) as e:
+                pass
 
         # The first header if any should be H1, otherwise
         # we can return error straight-
@@ -563,8 +516,12 @@ class PdfWCAG(pdfstruct.PdfStruct):
     def run_all_tests(self):
         """ Run all PDF WAM tests """
 
-        self.init()
-        self.process_awam()
+        # The document is processed and its structure tree
+        # walked only once, even if this is called again
+        if self.awamHandler is None:
+            self.init()
+            self.process_awam()
+
         results = self.awamHandler.resultMap
 
         for test_id in self.test_ids:
@@ -596,12 +553,18 @@ class PdfWCAG(pdfstruct.PdfStruct):
                         for (page, count), status in val.items():
                             if status: succ += 1
                             else: fail += 1
-                            self.memo[test_id] = (fail, succ)                                    
+
+                        # Once all the results of the test are counted
+                        if len(val):
+                            self.memo[test_id] = (fail, succ)
                         
                 # Nothing to do with ret, since function is independent
             except AttributeError:
                 pass
-        
+
+        cache = self.content_cache
+        self.logger.info('Content cache: %d hits, %d misses, %d evictions' % (cache.hits, cache.misses,
+                                                                             cache.evictions))
         return results
 
     def update_result(self, result, pg, target=None):
@@ -735,6 +698,7 @@ class PdfWCAG(pdfstruct.PdfStruct):
         
         for extLink, pg in self.get_external_links():
             count += 1
+            pgnum = self.get_page_number(pg)
 
             # import pdb; pdb.set_trace()
             
@@ -753,9 +717,9 @@ class PdfWCAG(pdfstruct.PdfStruct):
                     # of associating a structure artifact to a page
                     # so the page number here might sometimes be
                     # wrong. (Example: tests/extlinks/lesson5.pdf)
-                    self.logger.error("Error: Link [%s] doesn't have a corresponding link annotation object (pg: %d)" % (linkUri, pg.num+1))
+                    self.logger.error("Error: Link [%s] doesn't have a corresponding link annotation object (pg: %d)" % (linkUri, pgnum))
                     # fail the test
-                    wamdict['EGOVMON.A.WCAG.PDF.11'][(pg.num+1, count)] = 0
+                    wamdict['EGOVMON.A.WCAG.PDF.11'][(pgnum, count)] = 0
                 except KeyError:
                     pass
             else:
@@ -764,25 +728,25 @@ class PdfWCAG(pdfstruct.PdfStruct):
                 try:
                     rect=extLink['/Rect']
                     uri=extLink['/A']
-                    self.logger.debug("Link [%s] HAS a corresponding link annotation object (pg: %d)" % (linkUri, pg.num+1))
-                    wamdict['EGOVMON.A.WCAG.PDF.11'][(pg.num+1, count)] = 1
+                    self.logger.debug("Link [%s] HAS a corresponding link annotation object (pg: %d)" % (linkUri, pgnum))
+                    wamdict['EGOVMON.A.WCAG.PDF.11'][(pgnum, count)] = 1
                 except KeyError:
                     # fail the test
-                    wamdict['EGOVMON.A.WCAG.PDF.11'][(pg.num+1, count)] = 0                    
+                    wamdict['EGOVMON.A.WCAG.PDF.11'][(pgnum, count)] = 0                    
 
             # Now for Alt test
             try:
                 alt=extLink['/Alt']
                 if not alt:
-                    self.logger.debug('Error: Null /Alt entry found for Link [%s], (pg: %d)' % (linkUri, pg.num+1))
-                    wamdict['EGOVMON.A.WCAG.PDF.13'][(pg.num+1, count)] = 0
+                    self.logger.debug('Error: Null /Alt entry found for Link [%s], (pg: %d)' % (linkUri, pgnum))
+                    wamdict['EGOVMON.A.WCAG.PDF.13'][(pgnum, count)] = 0
                 else:
-                    wamdict['EGOVMON.A.WCAG.PDF.13'][(pg.num+1, count)] = 1
-                    self.logger.debug('ALT Key is good for Link [%s], (pg: %d)' % (linkUri, pg.num+1))
+                    wamdict['EGOVMON.A.WCAG.PDF.13'][(pgnum, count)] = 1
+                    self.logger.debug('ALT Key is good for Link [%s], (pg: %d)' % (linkUri, pgnum))
             except KeyError:
-                self.logger.debug('Error: No /Alt key found for Link [%s], (pg: %d)' % (linkUri, pg.num+1))
+                self.logger.debug('Error: No /Alt key found for Link [%s], (pg: %d)' % (linkUri, pgnum))
                 # Failed
-                wamdict['EGOVMON.A.WCAG.PDF.13'][(pg.num+1, count)] = 0                                        
+                wamdict['EGOVMON.A.WCAG.PDF.13'][(pgnum, count)] = 0                                        
 
         # Nothing to return since we are modifying wamdict in place
         return 1
@@ -1028,6 +992,44 @@ class PdfWCAG(pdfstruct.PdfStruct):
         self.logger.info('wcag.pdf.06 - Test completed')
         return results
 
+    def page_bg_images(self, pgnum):
+        """ Return the invalid /Artifact elements and the number of
+        image artifacts on the given page (starting at 0). The
+        elements are returned as strings, so the result can be
+        sent across from a page shard worker """
+
+        imgRe = re.compile(r'(\/Im\d+)|(\/Fm\d+)')
+        invalid, nimgs = [], 0
+
+        for artifactElems in self.artifact_elements(pgnum):
+            # First element is the artifact element
+            artifact, artype = artifactElems[0]
+            if artype=='BMC':
+                # artifact should be like ['/Artifact']
+                if len(artifact) != 1:
+                    # Error
+                    self.logger.debug('/Artifact type is BMC, however artifact element',artifact,'has invalid length!')
+                    invalid.append(str(artifact))
+            elif artype=='BDC':
+                # artifact should be like ['/Artifact', {}]
+                if len(artifact) != 2:
+                    # Error
+                    self.logger.debug('/Artifact type is BMC, however artifact element',artifact,'has invalid length!')
+                    invalid.append(str(artifact))
+            # Check if this specifies an image
+            operands = [x[0] for x,y in artifactElems[1:] if len(x)>0]
+            operands_s = []
+            for opr in operands:
+                try:
+                    operands_s.append(str(opr))
+                except UnicodeEncodeError:
+                    operands_s.append(str(opr))
+
+            if any([imgRe.match(opr) for opr in operands_s]):
+                nimgs += 1
+
+        return invalid, nimgs
+
     def document_bg_images_accessible(self):
         """ Test if any background image is specified correctly.
         This is test #4 in PDF WCAG 2.0 techniques """
@@ -1038,43 +1040,21 @@ class PdfWCAG(pdfstruct.PdfStruct):
         # type elements which could be images and verifies
         # if they are specified correctly.
 
-        imgRe = re.compile(r'(\/Im\d+)|(\/Fm\d+)')
         imgArtifacts = 0
 
         results = self.init_result()
-        
-        for pg in range(len(self.pages)):
-            for artifactElems in self.artifact_elements(pg):
-                # First element is the artifact element
-                artifact, artype = artifactElems[0]
-                if artype=='BMC':
-                    # artifact should be like ['/Artifact']
-                    if len(artifact) != 1:
-                        # Error
-                        self.logger.debug('/Artifact type is BMC, however artifact element',artifact,'has invalid length!')
-                        self.update_result(results[0], pg+1, artifact)
-                elif artype=='BDC':
-                    # artifact should be like ['/Artifact', {}]
-                    if len(artifact) != 2:
-                        # Error
-                        self.logger.debug('/Artifact type is BMC, however artifact element',artifact,'has invalid length!')
-                        self.update_result(results[0], pg+1, artifact)                        
-                # Check if this specifies an image
-                operands = [x[0] for x,y in artifactElems[1:] if len(x)>0]
-                operands_s = []
-                for opr in operands:
-                    try:
-                        operands_s.append(str(opr))
-                    except UnicodeEncodeError:
-                        operands_s.append(str(opr))
 
-                if any([imgRe.match(opr) for opr in operands_s]):
-                    imgArtifacts += 1
-                    self.update_result(results[1], pg+1)                    
+        for pg in range(len(self.pages)):
+            invalid, nimgs = self.page_result('bg_images', pg)
+            for artifact in invalid:
+                self.update_result(results[0], pg+1, artifact)
+            if nimgs:
+                imgArtifacts += nimgs
+                self.update_result(results[1], pg+1)
 
         self.logger.info('Number of img artifacts =>',imgArtifacts)
         self.logger.info("Number of images =>", self.get_num_images())
-        self.logger.info("Numer of figure elements =>",len(self.awamHandler.figureEls))
+        self.logger.info("Numer of figure elements =>",len(self.awamHandler.figures))
         
         self.nArtifactImgs = imgArtifacts
         
@@ -1086,6 +1066,90 @@ class PdfWCAG(pdfstruct.PdfStruct):
         # Not applicable
         return 2
 
+    def page_pagination_keys(self, pgnum):
+        """ Return the pagination artifact keys of the given page
+        (starting at 0) as a dictionary, for WCAG.PDF.14 """
+
+        pgKeys = {}
+
+        for artifactElems in self.artifact_elements(pgnum):
+            # First element is the artifact element
+            artifact, artype = artifactElems[0]
+            
+            # Skip this
+            if (len(artifact) < 3): continue
+            artifactDict = artifact[1]
+            
+            # This has to be a property dictionary
+            try:
+                atype = artifactDict['/Type']
+                # If atype is pagination look for /Subtype
+                if (atype == '/Pagination'):
+                    if '/Subtype' in artifactDict:
+                        subtype = artifactDict['/Subtype']
+                        key = '.'.join((str(pgnum+1),subtype))
+                        # Bug: text apparently could also be part of
+                        # the '/Contents' element here.
+                        # File: bugs/wcag.14/testdokument.pdf
+                        if '/Contents' in artifactDict:
+                            text = artifactDict['/Contents']
+                        else:
+                            text = self.get_artifact_content(artifactElems)
+                        # print 'TEXT:',text
+                        # For header simply check it is a non-empty
+                        # string. For footer, check if the page number
+                        # is part of the string. No need of stricter
+                        # checking (against page section headers etc)
+                        # for the time being, since most PDF documents
+                        # don't implement even the basic Artifact
+                        # property list for this test anyway!
+
+                        # Bug: Sometimes the /Footer data is presented as
+                        # part of '/Header' subtype. E.g: bugs/wcag.14/testdokument.pdf
+                        # So we need to account for it. hence using defaultdict here.
+                        if subtype == '/Header':
+                            if text:
+                                # Sometimes '/Header' is used for '/Footer' also
+                                if key in pgKeys:
+                                    # Use '/Footer' key
+                                    key = '.'.join((str(pgnum+1),'/Footer'))
+                                pgKeys[key] = 1
+                        elif (subtype == '/Footer'):
+                            # pgstr1 = '%d ' % (pg+1)
+                            # pgstr2 = ' %d' % (pg+1)
+                            # pgstr3 = ' %d ' % (pg+1)                            
+                            # if text.startswith(pgstr1) or \
+                            #    text.endswith(pgstr2) or \
+                            #    (pgstr3 in text):
+                            if text:
+                                # Reverse swap - not much chance of this, but just in case.
+                                if key in pgKeys:
+                                    # Use '/Header' key
+                                    key = '.'.join((str(pgnum+1),'/Header'))                                   
+                                pgKeys[key] = 1
+                    else:
+                        # Some PDF files dont seem to define this key
+                        # In that case, check whether the /Attached keys
+                        # are defined. If so both Top and Bottom should
+                        # be defined. For example, the test file
+                        # tests/kommune/hole/Budsjettdokument-\ horingsutkast\ oppdatert\ av\ Per2.pdf
+                        # don't define Subtypes but still shows running
+                        # headers/footers correctly.
+                        try:
+                            attKey = artifactDict['/Attached']
+                            if type(attKey) in (list, ArrayObject):
+                                val = attKey[0]
+                            else:
+                                val = attKey
+                            pgKeys['.'.join((str(pgnum+1),val))] = 1
+                        except KeyError:
+                            pass
+                                
+            except KeyError:
+                pass
+
+        return pgKeys
+
     def document_has_running_headers_and_footers(self):
         """ Test if the document provides running page headers
         and footers. This is test #14 in PDF WCAG 2.0 techniques 
@@ -1113,83 +1177,7 @@ class PdfWCAG(pdfstruct.PdfStruct):
         pgKeys = {}
         
         for pg in range(len(self.pages)):
-            artElems = self.artifact_elements(pg)
-            for artifactElems in artElems:
-                # First element is the artifact element
-                artifact, artype = artifactElems[0]
-                
-                # Skip this
-                if (len(artifact) < 3): continue
-                artifactDict = artifact[1]
-                
-                # This has to be a property dictionary
-                try:
-                    atype = artifactDict['/Type']
-                    # If atype is pagination look for /Subtype
-                    if (atype == '/Pagination'):
-                        if '/Subtype' in artifactDict:
-                            subtype = artifactDict['/Subtype']
-                            key = '.'.join((str(pg+1),subtype))
-                            # Bug: text apparently could also be part of
-                            # the '/Contents' element here.
-                            # File: bugs/wcag.14/testdokument.pdf
-                            if '/Contents' in artifactDict:
-                                text = artifactDict['/Contents']
-                            else:
-                                text = self.getArtifactContent(artifactElems)
-                            # print 'TEXT:',text
-                            # For header simply check it is a non-empty
-                            # string. For footer, check if the page number
-                            # is part of the string. No need of stricter
-                            # checking (against page section headers etc)
-                            # for the time being, since most PDF documents
-                            # don't implement even the basic Artifact
-                            # property list for this test anyway!
-
-                            # Bug: Sometimes the /Footer data is presented as
-                            # part of '/Header' subtype. E.g: bugs/wcag.14/testdokument.pdf
-                            # So we need to account for it. hence using defaultdict here.
-                            if subtype == '/Header':
-                                if text:
-                                    # Sometimes '/Header' is used for '/Footer' also
-                                    if key in pgKeys:
-                                        # Use '/Footer' key
-                                        key = '.'.join((str(pg+1),'/Footer'))
-                                    pgKeys[key] = 1
-                            elif (subtype == '/Footer'):
-                                # pgstr1 = '%d ' % (pg+1)
-                                # pgstr2 = ' %d' % (pg+1)
-                                # pgstr3 = ' %d ' % (pg+1)                            
-                                # if text.startswith(pgstr1) or \
-                                #    text.endswith(pgstr2) or \
-                                #    (pgstr3 in text):
-                                if text:
-                                    # Reverse swap - not much chance of this, but just in case.
-                                    if key in pgKeys:
-                                        # Use '/Header' key
-                                        key = '.'.join((str(pg+1),'/Header'))                                   
-                                    pgKeys[key] = 1
-                        else:
-                            # Some PDF files dont seem to define this key
-                            # In that case, check whether the /Attached keys
-                            # are defined. If so both Top and Bottom should
-                            # be defined. For example, the test file
-                            # tests/kommune/hole/Budsjettdokument-\ horingsutkast\ oppdatert\ av\ Per2.pdf
-                            # don't define Subtypes but still shows running
-                            # headers/footers correctly.
-                            try:
-                                attKey = artifactDict['/Attached']
-                                if type(attKey) in (list, ArrayObject):
-                                    val = attKey[0]
-                                else:
-                                    val = attKey
-                                pgKeys['.'.join((str(pg+1),val))] = 1
-                            except KeyError:
-                                pass
-                                    
-                except KeyError:
-                    pass
-
+            pgKeys.update(self.page_result('pagination', pg))
 
         # print pgKeys
         # if there is only one page we don't expect it
@@ -1256,13 +1244,8 @@ class PdfWCAG(pdfstruct.PdfStruct):
 
         count = 0
         for p in range(len(self.pages)):
-            try:
-                pg = self.pages[p]
-                tab = pg['/Tabs']
-                if tab == '/S':
-                    count += 1
-            except KeyError:
-                pass
+            if self.page_result('tab_order', p):
+                count += 1
 
         if count == len(self.pages):
             # Passed
@@ -1271,6 +1254,24 @@ class PdfWCAG(pdfstruct.PdfStruct):
         # Failed
         return 0
 
+    def combine_sc244(self):
+        """ Replace the wcag.pdf.11 and wcag.pdf.13 results in the
+        memo by the wcag.pdf.sc244 result combining them """
+
+        # Only one of them is there if the checks were cut short by
+        # a budget, which is not a verdict on SC 2.4.4 and is dropped
+        if ('wcag.pdf.11' in self.memo) and ('wcag.pdf.13' in self.memo):
+            f11, p11 = self.memo['wcag.pdf.11']
+            f13, p13 = self.memo['wcag.pdf.13']
+            # Fail is the min of fails, pass is the max of passes
+            fail = min(f11, f13)
+            succ = max(p11, p13)
+            # Add an sc244 entry
+            self.memo['wcag.pdf.sc244'] = (fail, succ)
+
+        self.memo.pop('wcag.pdf.11', None)
+        self.memo.pop('wcag.pdf.13', None)
+
     def get_dict(self):
         """ Return test results as a dictionary converted to JSON """
         
@@ -1280,16 +1281,7 @@ class PdfWCAG(pdfstruct.PdfStruct):
         }
 
         # Pre-preparation for wcag.pdf.11 and wcag.pdf.13
-        if ('wcag.pdf.11' in self.memo) or ('wcag.pdf.13' in self.memo):
-            f11, p11 = self.memo['wcag.pdf.11']
-            f13, p13 = self.memo['wcag.pdf.13']
-            # Fail is the min of fails, pass is the max of passes
-            fail = min(f11, f13)
-            succ = max(p11, p13)
-            # Add an sc244 entry
-            self.memo['wcag.pdf.sc244'] = (fail, succ)
-            del self.memo['wcag.pdf.11']
-            del self.memo['wcag.pdf.13']
+        self.combine_sc244()
 
         tfail, tpass = 0, 0
 
@@ -1325,16 +1317,7 @@ class PdfWCAG(pdfstruct.PdfStruct):
         """ Print a report of the tests run and their status """
 
         # Pre-preparation for wcag.pdf.11 and wcag.pdf.13
-        if ('wcag.pdf.11' in self.memo) or ('wcag.pdf.13' in self.memo):
-            f11, p11 = self.memo['wcag.pdf.11']
-            f13, p13 = self.memo['wcag.pdf.13']
-            # Fail is the min of fails, pass is the max of passes
-            fail = min(f11, f13)
-            succ = max(p11, p13)
-            # Add an sc244 entry
-            self.memo['wcag.pdf.sc244'] = (fail, succ)
-            del self.memo['wcag.pdf.11']
-            del self.memo['wcag.pdf.13']
+        self.combine_sc244()
             
         print('\n***Test Report***')
         
@@ -0,0 +1,562 @@
+""" Test opening PDF files, fetching them from a local HTTP server and caching
+them, and checking them in worker processes """
+
+import io
+import os
+import gc
+import resource
+import hashlib
+import logging
+import shutil
+import unittest
+import tempfile
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from api.pdf_checker import config
+from api.pdf_checker import pdffetch
+from api.pdf_checker import pdfcache
+from api.pdf_checker import pdfbulk
+from api.pdf_checker import pdfsniff
+from api.pdf_checker import pdfAWAM
+from api.pdf_checker import pdfpool
+from api.pdf_checker import helper
+from api.pdf_checker import pdfbudget
+from api.pdf_checker.check_accessibility import check_accessibility
+
+PDF_FILE = os.path.join(os.path.dirname(__file__), 'testfiles/wcag.pdf.01/images-with-and-without-ALT.pdf')
+# A PDF file taking a while to check
+SLOW_FILE = os.path.join(os.path.dirname(__file__), 'testfiles/wcag.pdf.06/many_tables_tagged.pdf')
+# A PDF file with external links, checked for SC 2.4.4
+LINKS_FILE = os.path.join(os.path.dirname(__file__), 'testfiles/wcag.pdf.09/multiple_pages_header_fail.pdf')
+# A PDF file with large images
+IMAGES_FILE = os.path.join(os.path.dirname(__file__), 'testfiles/wcag.pdf.04/no_decorative_image.pdf')
+
+class PdfHandler(BaseHTTPRequestHandler):
+    """ Serves the test PDF file at /doc.pdf, the same without
+    a Content-Length at /chunked.pdf, a header claiming a huge
+    document at /huge.pdf and an HTML page at /page.html """
+
+    protocol_version = 'HTTP/1.1'
+    data = open(PDF_FILE, 'rb').read()
+    etag = '"1"'
+    # Number of GET requests by path
+    requests = {}
+    # Client addresses of the connections
+    clients = set()
+    # Concurrent requests to /slow.pdf by host, and their maximum
+    active = {}
+    max_active = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        self.requests[self.path] = self.requests.get(self.path, 0) + 1
+        self.clients.add(self.client_address)
+
+        if self.path == '/etag.pdf' and self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+        elif self.path == '/flaky.pdf' and self.requests[self.path] == 1:
+            # Fail the first time
+            self.send_error(503)
+        elif self.path in ('/range.pdf', '/images.pdf') and self.headers.get('Range'):
+            data = self.data
+            if self.path == '/images.pdf':
+                data = open(IMAGES_FILE, 'rb').read()
+            start, end = self.headers.get('Range').replace('bytes=', '').split('-')
+            start, end = int(start), min(int(end), len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(data[start:end + 1])
+        elif self.path.startswith('/slow.pdf'):
+            host = self.headers.get('Host')
+            with self.lock:
+                self.active[host] = self.active.get(host, 0) + 1
+                self.max_active[host] = max(self.max_active.get(host, 0), self.active[host])
+            time.sleep(0.1)
+            with self.lock:
+                self.active[host] -= 1
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.data)))
+            self.end_headers()
+            self.wfile.write(self.data)
+        elif self.path in ('/doc.pdf', '/etag.pdf', '/other.pdf', '/flaky.pdf', '/range.pdf'):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.data)))
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            self.wfile.write(self.data)
+        elif self.path == '/chunked.pdf':
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(self.data)
+        elif self.path == '/page.html':
+            # An error page, larger than the maximum size
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'<!DOCTYPE html><html><body>' + b' '*(2*1024*1024) + b'</body></html>')
+        elif self.path == '/huge.pdf':
+            self.send_response(200)
+            self.send_header('Content-Length', str(2*1024*1024*1024))
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestOpen(unittest.TestCase):
+
+    def test_map_file(self):
+        stream = pdffetch.open_source(PDF_FILE)
+        self.assertEqual(stream.name, PDF_FILE)
+        self.assertEqual(stream.read(), PdfHandler.data)
+        stream.close()
+        self.assertTrue(stream.closed)
+
+    def test_open_upload(self):
+        class TemporaryUpload:
+            def temporary_file_path(self):
+                return PDF_FILE
+
+        stream = pdffetch.open_upload(TemporaryUpload())
+        self.assertTrue(isinstance(stream, pdffetch.MappedFile))
+        stream.close()
+
+        memory = io.BytesIO(PdfHandler.data)
+        memory.read()
+        self.assertTrue(pdffetch.open_upload(memory) is memory)
+        self.assertEqual(memory.tell(), 0)
+
+class ServerMixin:
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), PdfHandler)
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+class TestFetch(ServerMixin, unittest.TestCase):
+
+    def test_fetch(self):
+        stream = pdffetch.fetch(self.url + '/doc.pdf')
+        self.assertEqual(stream.read(), PdfHandler.data)
+        stream.close()
+
+    def test_spool_to_disk(self):
+        spoolsize = config.pdfwamspoolsize
+        config.pdfwamspoolsize = 0.001
+        try:
+            stream = pdffetch.fetch(self.url + '/doc.pdf')
+        finally:
+            config.pdfwamspoolsize = spoolsize
+
+        self.assertTrue(stream._rolled)
+        self.assertEqual(stream.read(), PdfHandler.data)
+        stream.close()
+
+    def test_content_length_too_large(self):
+        self.assertRaises(pdffetch.PdfTooLargeError, pdffetch.fetch, self.url + '/huge.pdf')
+
+    def test_body_too_large(self):
+        self.assertRaises(pdffetch.PdfTooLargeError, pdffetch.fetch,
+                          self.url + '/chunked.pdf', maxsize=1024)
+
+    def test_not_found(self):
+        self.assertRaises(pdffetch.PdfFetchError, pdffetch.fetch, self.url + '/missing.pdf')
+
+    def test_not_pdf(self):
+        # Rejected from the first chunk, before reaching the maximum size
+        with self.assertRaises(pdffetch.PdfNotPdfError) as cm:
+            pdffetch.fetch(self.url + '/page.html', maxsize=1024*1024)
+        self.assertTrue('HTML document' in str(cm.exception))
+
+class TestSniff(unittest.TestCase):
+
+    def test_sniff(self):
+        stream = io.BytesIO(PdfHandler.data)
+        stream.seek(100)
+        result = pdfsniff.sniff(stream)
+
+        self.assertEqual(stream.tell(), 0)
+        self.assertEqual(result.version, PdfHandler.data[5:8].decode('ascii'))
+        self.assertEqual(result.kind, 'PDF document')
+        self.assertTrue(result.eof)
+        self.assertFalse(result.encrypted)
+        self.assertEqual(result.startxref, int(PdfHandler.data.rsplit(b'startxref', 1)[1].split()[0]))
+
+    def test_describe(self):
+        self.assertEqual(pdfsniff.describe(b'\n<html><head>'), 'HTML document')
+        self.assertEqual(pdfsniff.describe(b'PK\x03\x04'), 'ZIP archive')
+        self.assertEqual(pdfsniff.describe(b'hello'), 'not a PDF document')
+
+    def test_reject(self):
+        self.assertRaises(pdfAWAM.PdfWamProcessingError, check_accessibility,
+                          io.BytesIO(b'<html><body>Not found</body></html>'))
+
+class TestSession(ServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        PdfHandler.requests.clear()
+        PdfHandler.clients.clear()
+        self.backoff = config.pdfwamfetchbackoff
+        config.pdfwamfetchbackoff = 0
+        pdffetch.session = None
+
+    def tearDown(self):
+        config.pdfwamfetchbackoff = self.backoff
+        pdffetch.session = None
+
+    def test_keep_alive(self):
+        for i in range(3):
+            pdffetch.fetch(self.url + '/doc.pdf').close()
+        self.assertEqual(PdfHandler.requests['/doc.pdf'], 3)
+        self.assertEqual(len(PdfHandler.clients), 1)
+
+    def test_retry(self):
+        stream = pdffetch.fetch(self.url + '/flaky.pdf')
+        self.assertEqual(stream.read(), PdfHandler.data)
+        stream.close()
+        self.assertEqual(PdfHandler.requests['/flaky.pdf'], 2)
+
+    def test_no_retry(self):
+        retries = config.pdfwamfetchretries
+        config.pdfwamfetchretries = 0
+        try:
+            self.assertRaises(pdffetch.PdfFetchError, pdffetch.fetch, self.url + '/flaky.pdf')
+        finally:
+            config.pdfwamfetchretries = retries
+
+class TestBulk(ServerMixin, unittest.TestCase):
+
+    def test_check_urls(self):
+        PdfHandler.max_active.clear()
+        port = self.server.server_address[1]
+        urls = ['http://%s:%d/slow.pdf?%d' % (host, port, i)
+                for i in range(6) for host in ('127.0.0.1', 'localhost')]
+        urls.append(self.url + '/missing.pdf')
+
+        results = list(pdfbulk.check_urls(urls, concurrency=3, per_host=2))
+        expected = check_accessibility(PDF_FILE)
+
+        self.assertEqual(sorted([item['url'] for item in results]), sorted(urls))
+        for item in results:
+            if item['url'].endswith('/missing.pdf'):
+                self.assertTrue(item['error'])
+            else:
+                self.assertEqual(item['error'], None)
+                self.assertEqual(item['result'], expected)
+                self.assertTrue(item['time'] >= item['fetch_time'] >= 0.1)
+
+        self.assertEqual(max(PdfHandler.max_active.values()), 2)
+
+class TestRangeStream(ServerMixin, unittest.TestCase):
+
+    settings = {'pdfwamrangefetch': 1,
+                'pdfwamrangeminsize': 0,
+                'pdfwamrangeblocksize': 1,
+                'pdfwamrangereadahead': 2,
+                'pdfwamrangecacheblocks': 4}
+
+    def setUp(self):
+        self.saved = dict([(key, getattr(config, key)) for key in self.settings])
+        for key, value in self.settings.items():
+            setattr(config, key, value)
+
+    def tearDown(self):
+        for key, value in self.saved.items():
+            setattr(config, key, value)
+
+    def test_read(self):
+        stream = pdffetch.fetch(self.url + '/range.pdf')
+        self.assertTrue(isinstance(stream, pdffetch.PdfRangeStream))
+        data = PdfHandler.data
+
+        self.assertEqual(stream.read(10), data[:10])
+        stream.seek(-3000, 2)
+        self.assertEqual(stream.read(2500), data[-3000:-500])
+        stream.seek(1000)
+        self.assertEqual(stream.read(), data[1000:])
+        self.assertEqual(stream.read(), b'')
+        self.assertTrue(len(stream.blocks) <= 4)
+
+    def test_check(self):
+        stream = pdffetch.fetch(self.url + '/range.pdf')
+        result, expected = check_accessibility(stream), check_accessibility(PDF_FILE)
+        self.assertEqual(result['result'], expected['result'])
+        self.assertEqual(result['summary'], expected['summary'])
+        # Hashing would need the whole document
+        self.assertEqual(result['document'], dict(expected['document'], hash=None))
+        self.assertTrue(stream.requests > 1)
+
+    def test_images_not_read(self):
+        config.pdfwamrangeblocksize = 64
+        stream = pdffetch.fetch(self.url + '/images.pdf')
+        result, expected = check_accessibility(stream), check_accessibility(IMAGES_FILE)
+        self.assertEqual(result['result'], expected['result'])
+        self.assertTrue(stream.transferred < stream.size/4)
+
+    def test_fallback(self):
+        stream = pdffetch.fetch(self.url + '/doc.pdf')
+        self.assertFalse(isinstance(stream, pdffetch.PdfRangeStream))
+        self.assertEqual(stream.read(), PdfHandler.data)
+
+    def test_max_transfer(self):
+        stream = pdffetch.open_range(self.url + '/range.pdf', maxsize=4096)
+        self.assertRaises(pdffetch.PdfTooLargeError, stream.read)
+
+class TestUrlCache(ServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        PdfHandler.requests.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def fetch(self, cache, path):
+        stream = cache.fetch(self.url + path)
+        data = stream.read()
+        stream.close()
+        return data
+
+    def test_hit(self):
+        cache = pdfcache.PdfUrlCache(self.folder, 3600, 1024*1024)
+        self.assertEqual(self.fetch(cache, '/etag.pdf'), PdfHandler.data)
+        self.assertEqual(self.fetch(cache, '/etag.pdf'), PdfHandler.data)
+        self.assertEqual(PdfHandler.requests['/etag.pdf'], 1)
+
+    def test_revalidate(self):
+        cache = pdfcache.PdfUrlCache(self.folder, 0, 1024*1024)
+        self.assertEqual(self.fetch(cache, '/etag.pdf'), PdfHandler.data)
+        self.assertEqual(self.fetch(cache, '/etag.pdf'), PdfHandler.data)
+        self.assertEqual(PdfHandler.requests['/etag.pdf'], 2)
+
+    def test_content_addressed(self):
+        cache = pdfcache.PdfUrlCache(self.folder, 3600, 1024*1024)
+        self.fetch(cache, '/etag.pdf')
+        self.fetch(cache, '/other.pdf')
+        self.assertEqual(len(os.listdir(cache.objects)), 1)
+        self.assertEqual(len(os.listdir(cache.urls)), 2)
+
+    def test_evict(self):
+        cache = pdfcache.PdfUrlCache(self.folder, 3600, 1)
+        self.assertEqual(self.fetch(cache, '/etag.pdf'), PdfHandler.data)
+        other = os.path.join(cache.objects, 'x.pdf')
+        with open(other, 'wb') as f:
+            f.write(b'x')
+        os.utime(other, (0, 0))
+        self.fetch(cache, '/chunked.pdf')
+        self.assertFalse(os.path.exists(other))
+        self.assertEqual(len(os.listdir(cache.objects)), 1)
+
+    def test_evict_entries(self):
+        # Room for the document only, so older URL entries are evicted
+        cache = pdfcache.PdfUrlCache(self.folder, 3600, len(PdfHandler.data) + 1)
+        for path in ('/doc.pdf', '/etag.pdf', '/other.pdf'):
+            self.assertEqual(self.fetch(cache, path), PdfHandler.data)
+
+        self.assertEqual(len(os.listdir(cache.objects)), 1)
+        self.assertEqual(os.listdir(cache.urls), [os.path.basename(cache.url_path(self.url + '/other.pdf'))])
+
+    def test_evicted_document(self):
+        cache = pdfcache.PdfUrlCache(self.folder, 0, 1024*1024)
+        self.fetch(cache, '/etag.pdf')
+        for name in os.listdir(cache.objects):
+            os.remove(os.path.join(cache.objects, name))
+
+        # The entry is dropped, so the document is downloaded
+        # again without a conditional request
+        self.assertEqual(self.fetch(cache, '/etag.pdf'), PdfHandler.data)
+        self.assertEqual(PdfHandler.requests['/etag.pdf'], 2)
+        self.assertEqual(len(os.listdir(cache.objects)), 1)
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = pdfcache.PdfResultCache(self.folder, 1024*1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_key(self):
+        with open(PDF_FILE, 'rb') as stream:
+            key = self.cache.key(stream)
+            self.assertEqual(stream.tell(), 0)
+            self.assertEqual(self.cache.key(stream), key)
+            self.assertNotEqual(self.cache.key(stream, 'secret'), key)
+
+            for name in ('pdfwamvalidateimgs', 'pdfwamscansample', 'pdfwamsniffsize', 'pdfwamshardpages'):
+                value = getattr(config, name)
+                setattr(config, name, int(value) + 1)
+                try:
+                    self.assertNotEqual(self.cache.key(stream), key, name)
+                finally:
+                    setattr(config, name, value)
+
+    def test_checker_modules(self):
+        modules = pdfcache.checker_modules()
+        for name in ('pdfAWAM.py', 'pdfwcag.py', 'pdfsniff.py', 'pdfshard.py', 'pdfcontent.py'):
+            self.assertTrue(name in modules, name)
+        self.assertFalse('test_fetch.py' in modules)
+
+    def test_document_info(self):
+        result = check_accessibility(PDF_FILE)
+        self.assertEqual(result['document'], {'size': len(PdfHandler.data),
+                                              'pages': 1,
+                                              'hash': hashlib.sha256(PdfHandler.data).hexdigest()})
+
+    def test_get_put(self):
+        self.assertEqual(self.cache.get('x'), None)
+        self.cache.put('x', {'summary': {'Total': 1}})
+        self.assertEqual(self.cache.get('x'), {'summary': {'Total': 1}})
+
+class TestPool(unittest.TestCase):
+
+    def test_recycle(self):
+        pool = pdfpool.PdfWorkerPool(1, max_docs=2, max_rss=0)
+        try:
+            expected = check_accessibility(PDF_FILE)
+            for i in range(3):
+                self.assertEqual(pool.check(PDF_FILE), expected)
+            self.assertEqual(pool.check(io.BytesIO(PdfHandler.data)), expected)
+        finally:
+            pool.close()
+
+        self.assertEqual(pool.stats(), {'workers': 1, 'started': 0, 'recycled': 2})
+
+    def test_error(self):
+        pool = pdfpool.PdfWorkerPool(1)
+        try:
+            self.assertRaises(pdfAWAM.PdfWamProcessingError, pool.check, io.BytesIO(b'<html></html>'))
+            self.assertRaises(FileNotFoundError, pool.check, '/nonexistent.pdf')
+        finally:
+            pool.close()
+
+    def test_check_raises(self):
+        pool = pdfpool.PdfWorkerPool(1)
+        results = []
+
+        def check():
+            # A password which can't be sent to the worker
+            for i in range(3):
+                try:
+                    pool.check(PDF_FILE, lambda: '')
+                except Exception as e:
+                    results.append(type(e))
+            results.append(pool.check(PDF_FILE))
+
+        try:
+            thread = threading.Thread(target=check, daemon=True)
+            thread.start()
+            # Hangs if the place of the worker is not given back
+            thread.join(60)
+            self.assertFalse(thread.is_alive())
+        finally:
+            pool.close()
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[3], check_accessibility(PDF_FILE))
+        self.assertEqual(pool.stats(), {'workers': 1, 'started': 0, 'recycled': 3})
+
+    def test_time_limit(self):
+        pool = pdfpool.PdfWorkerPool(1, time_limit=0.5)
+        try:
+            result = pool.check(SLOW_FILE)
+        finally:
+            pool.close()
+
+        self.assertEqual(result['status'], 'budget exceeded')
+        self.assertEqual(result['budget'], 'time')
+        # Tests finished before the time ran out are kept
+        expected = check_accessibility(SLOW_FILE)
+        self.assertTrue(0 < result['summary']['Total'] < expected['summary']['Total'])
+        for item in result['result']:
+            self.assertTrue(item in expected['result'])
+        self.assertEqual(pool.stats()['recycled'], 1)
+
+def address_space():
+    """ Return the size in MB of the address space of this process """
+
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmSize:'):
+                return int(line.split()[1]) / 1024.0
+
+class TestBudget(unittest.TestCase):
+
+    def out_of_memory(self, func, *args):
+        """ Call the function with the memory of the process limited,
+        running out of it while the external links are checked """
+
+        # More than what is left
+        def get_external_links(pdf):
+            return [(bytearray(1024*1024*1024), None)]
+
+        pdfAWAM.PdfReaderWrapper.get_external_links = get_external_links
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        try:
+            pdfbudget.set_memory_limit(address_space() + 256)
+            return func(*args)
+        finally:
+            resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+            del pdfAWAM.PdfReaderWrapper.get_external_links
+
+    @unittest.skipUnless(os.path.exists('/proc/self/status'), 'needs /proc')
+    def test_memory_limit(self):
+        expected = check_accessibility(LINKS_FILE)
+        self.assertTrue('wcag.pdf.sc244' in [item['Test'] for item in expected['result']])
+
+        with self.assertRaises(pdfAWAM.PdfWamBudgetExceeded) as cm:
+            self.out_of_memory(check_accessibility, LINKS_FILE)
+        self.assertEqual(cm.exception.budget, 'memory')
+
+        # Tests finished before the memory ran out are kept,
+        # without SC 2.4.4 whose tests did not finish
+        result = cm.exception.result
+        self.assertTrue(0 < result['summary']['Total'] < expected['summary']['Total'])
+        for item in result['result']:
+            self.assertTrue(item in expected['result'])
+        self.assertFalse('wcag.pdf.sc244' in [item['Test'] for item in result['result']])
+        self.assertEqual(result['document'], expected['document'])
+
+        # As returned by the workers
+        kind, value, over = self.out_of_memory(pdfpool.check_budgeted, LINKS_FILE, '')
+        self.assertEqual((kind, over), ('result', True))
+        self.assertEqual(value, pdfbudget.budget_result('memory', result))
+
+class TestHelper(unittest.TestCase):
+
+    def test_logger_handlers(self):
+        for i in range(3):
+            helper.get_logger()
+        self.assertEqual(len(logging.getLogger('pdfwam').handlers), 1)
+
+    def test_memoize_released(self):
+        class Document:
+            @helper.memoize
+            def double(self, n):
+                return 2*n
+
+        doc = Document()
+        self.assertEqual(doc.double(2), 4)
+        cache = Document.double.__closure__[0].cell_contents
+        self.assertEqual(len(cache), 1)
+
+        del doc
+        gc.collect()
+        self.assertEqual(len(cache), 0)
+
+if __name__ == "__main__":
+    unittest.main()
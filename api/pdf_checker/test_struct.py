@@ -0,0 +1,461 @@
+""" Test the structure tree handler and the checks built on it """
+
+import io
+import os
+import types
+import unittest
+
+from api.pdf_checker import config
+from api.pdf_checker import helper
+from api.pdf_checker import pdfAWAM
+from api.pdf_checker import pdfstruct
+from api.pdf_checker import pdfcontent
+from api.pdf_checker.pdfAWAMHandler import PdfAWAMHandler
+from pypdf.generic import IndirectObject, DictionaryObject, ArrayObject, NameObject
+
+TESTFILES = os.path.join(os.path.dirname(__file__), 'testfiles')
+
+def make_pdf(objects):
+    """ Return the data of a PDF document made of the given
+    objects, numbered from 1, the first being the catalog,
+    followed by the document information """
+
+    objects = objects + [b'<< /Title (Test) >>']
+    data = b'%PDF-1.4\n'
+    offsets = []
+    for num, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b'%d 0 obj\n%s\nendobj\n' % (num, obj)
+
+    xref = len(data)
+    data += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        data += b'%010d 00000 n \n' % offset
+    data += b'trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1,
+                                                                                  len(objects), xref)
+    return data
+
+def stream(entries, data):
+    """ Return a stream object with the given dictionary entries """
+
+    return b'<< %s /Length %d >>\nstream\n%s\nendstream' % (entries, len(data), data)
+
+class DocumentMixin:
+
+    def open_document(self, data):
+        """ Return the parsed document with the given data """
+
+        return pdfAWAM.PdfReaderWrapper(io.BytesIO(data), logger=helper.get_logger())
+
+    def check_document(self, path):
+        """ Run all tests on the document at the given path under
+        testfiles and return the parsed document """
+
+        stream = open(os.path.join(TESTFILES, path), 'rb')
+        self.addCleanup(stream.close)
+        pdf = pdfAWAM.PdfReaderWrapper(stream, logger=helper.get_logger())
+        pdf.fix_indirect_object_xref()
+        pdf.run_all_tests()
+        return pdf
+
+class Objects(dict):
+    """ Indirect objects of a test document, by object number """
+
+    def get_object(self, ref):
+        return self[ref.idnum]
+
+    def add(self, item):
+        ref = IndirectObject(len(self) + 1, 0, self)
+        self[ref.idnum] = item
+        return ref
+
+def element(structureType, kids=None):
+    """ Return a structure element of the given type and kids """
+
+    item = DictionaryObject({NameObject('/S'): NameObject(structureType)})
+    if kids is not None:
+        item[NameObject('/K')] = kids
+    return item
+
+class TestStructureTree(unittest.TestCase):
+
+    def setUp(self):
+        stream = open(os.path.join(TESTFILES, 'wcag.pdf.04/decorative-image.pdf'), 'rb')
+        self.addCleanup(stream.close)
+        self.pdf = pdfAWAM.PdfReaderWrapper(stream, logger=helper.get_logger())
+
+    def test_cycles(self):
+        objects = Objects()
+        document, para, span = element('/Document'), element('/P'), element('/Span')
+        documentRef, paraRef, spanRef = objects.add(document), objects.add(para), objects.add(span)
+        # The span refers to itself and back to the document
+        document[NameObject('/K')] = ArrayObject([paraRef, spanRef])
+        para[NameObject('/K')] = ArrayObject([spanRef, paraRef])
+        span[NameObject('/K')] = ArrayObject([spanRef, documentRef])
+
+        elements = list(self.pdf.iter_structure_tree(documentRef))
+        self.assertEqual([item['/S'] for item in elements], ['/Document', '/P', '/Span'])
+        self.assertEqual((self.pdf.struct_nodes, self.pdf.struct_revisits), (3, 4))
+
+    def test_deep_tree(self):
+        depth = 5000
+        objects = Objects()
+        # Direct and indirect kids
+        tree = element('/Span')
+        for i in range(depth):
+            tree = element('/Div', objects.add(tree) if i % 2 else tree)
+
+        elements = list(self.pdf.iter_structure_tree(tree))
+        self.assertEqual(len(elements), depth + 1)
+        self.assertEqual(elements[-1]['/S'], '/Span')
+
+class TestHandler(unittest.TestCase):
+
+    def test_registry(self):
+        handler = PdfAWAMHandler(roleMap={'/Image': '/Figure', '/Para': '/P'})
+        for structureType in ('/Link', '/Table', '/TR', '/TD', '/Form', '/Document', '/Figure', '/Image'):
+            self.assertTrue(handler.visitors.get(structureType), structureType)
+        self.assertFalse('/Para' in handler.visitors)
+
+        # Visitors of the checks share the registry
+        visited = []
+        handler.register(('/H1', '/Image'), visited.append)
+        elements = [{'/S': '/H1'}, {'/S': '/P'}, {'/S': '/Image', '/Alt': 'A chart'}, {'/S': '/Image'}]
+        for element in elements:
+            handler.handler(element)
+
+        self.assertEqual(visited, [elements[0], elements[2], elements[3]])
+        self.assertEqual(handler.elementCount, 4)
+
+    def test_role_figure(self):
+        handler = PdfAWAMHandler(roleMap={'/Image': '/Figure'})
+        # Direct objects are told apart by id, so kept alive
+        elements = [{'/S': '/Image', '/Alt': 'A chart'}, {'/S': '/Image'}, {'/S': '/Figure', '/ActualText': 'A'}]
+        for element in elements:
+            handler.handler(element)
+
+        self.assertEqual(len(handler.figures), 3)
+        self.assertEqual({page: [figure.ordinal for figure in figures]
+                          for page, figures in handler.failedImgs.items()}, {0: [2]})
+
+class TestFigures(DocumentMixin, unittest.TestCase):
+
+    def test_alt(self):
+        pdf = self.check_document('wcag.pdf.01/images-with-and-without-ALT.pdf')
+        handler = pdf.awamHandler
+
+        self.assertEqual(len(handler.figures), 2)
+        self.assertEqual(sum([len(figures) for figures in handler.failedImgs.values()]), 1)
+        self.assertEqual(pdf.memo['wcag.pdf.01'], (1, 1))
+        # Built once
+        self.assertTrue(handler.failedImgs is handler.failedImgs)
+
+    def test_role_mapped(self):
+        pdf = self.check_document('wcag.pdf.04/decorative_image_multiple.pdf')
+        handler = pdf.awamHandler
+
+        # Figures of types mapped to /Figure are counted too
+        roles = handler.role_types('/Figure')
+        mapped = [element for element in pdf.iter_structure_tree(pdf.structroot.raw_get('/K'))
+                  if element.get('/S') in roles and element['/S'] != '/Figure']
+        self.assertEqual(len(mapped), 4)
+        self.assertEqual(len(handler.figures), 87)
+        self.assertEqual(handler.failedImgs, {})
+        self.assertEqual(pdf.memo['wcag.pdf.01'], (0, 87))
+
+class TestReport(DocumentMixin, unittest.TestCase):
+
+    def sc244(self, path):
+        """ Return the SC 2.4.4 status of the document at the path """
+
+        for item in self.check_document(path).get_dict()['result']:
+            if item['Test'] == 'wcag.pdf.sc244':
+                return item['Status']
+
+    def test_sc244_results(self):
+        # Links are found by their page number in the
+        # page index, one result per external link
+        self.assertEqual(self.sc244('wcag.pdf.11/single_link_pass.pdf'), {'Fail': 0, 'Pass': 1})
+        self.assertEqual(self.sc244('wcag.pdf.09/multiple_pages_header_fail.pdf'), {'Fail': 38, 'Pass': 16})
+        # No external links, not applicable
+        self.assertEqual(self.sc244('wcag.pdf.18/title_fail.pdf'), None)
+
+    def test_sc244(self):
+        pdf = self.check_document('wcag.pdf.11/single_link_pass.pdf')
+
+        pdf.memo = {'wcag.pdf.11': (1, 2), 'wcag.pdf.13': (3, 1)}
+        self.assertEqual(pdf.get_dict()['result'], [{'Test': 'wcag.pdf.sc244', 'Status': {'Fail': 1, 'Pass': 2},
+                                                     'Description': 'accessible external links'}])
+
+        # Only one half, like when cut short by a budget
+        pdf.memo = {'wcag.pdf.18': 1, 'wcag.pdf.11': (1, 2)}
+        result = pdf.get_dict()
+        self.assertEqual([item['Test'] for item in result['result']], ['wcag.pdf.18'])
+        self.assertEqual(result['summary'], {'Total': 1, 'Fail': 0, 'Pass': 1})
+
+        for half in ('wcag.pdf.11', 'wcag.pdf.13'):
+            pdf.memo = {half: (1, 2)}
+            pdf.combine_sc244()
+            self.assertEqual(pdf.memo, {})
+
+class TestImages(DocumentMixin, unittest.TestCase):
+
+    def document(self, nestedFilter=b'', data=b'\xff\xff'):
+        """ Return a document with an image used directly by its page,
+        with the given data and no filter, and one used by a form
+        XObject on the page, with the given filter entry """
+
+        image = b'/Type /XObject /Subtype /Image /Width 2 /Height 1 /ColorSpace /DeviceGray /BitsPerComponent 8'
+        return self.open_document(make_pdf([
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 10 10] /Contents 7 0 R '
+            b'/Resources << /XObject << /Fm0 4 0 R /Im1 6 0 R >> >> >>',
+            stream(b'/Type /XObject /Subtype /Form /BBox [0 0 10 10] /Resources << /XObject << /Im0 5 0 R >> >>',
+                   b'/Im0 Do'),
+            stream(image + nestedFilter, b'\xff\xff'),
+            stream(image, data),
+            stream(b'', b'/Fm0 Do /Im1 Do')]))
+
+    def test_form_images(self):
+        pdf = self.document()
+
+        catalog = pdf.get_image_catalog()
+        self.assertEqual(sorted(catalog.keys()), [(5, 0), (6, 0)])
+        # The image of the form XObject is on the page
+        self.assertEqual(catalog[(5, 0)].pages, {1})
+        self.assertEqual(sorted([img.ref.idnum for img in pdf.get_page_images(1)]), [5, 6])
+        self.assertEqual(pdf.get_num_images(), 2)
+
+    def test_lzw_encoded(self):
+        self.assertTrue(self.document(b' /Filter /LZWDecode').is_lzw_encoded())
+        self.assertTrue(self.document(b' /Filter [/LZW]').is_lzw_encoded())
+        self.assertTrue(self.document(b' /Filter [/FlateDecode /LZWDecode]').is_lzw_encoded())
+        # Other filters, and data which is not LZW encoded
+        self.assertFalse(self.document(b' /Filter /DCTDecode').is_lzw_encoded())
+        self.assertFalse(self.document().is_lzw_encoded())
+        # No filter given, but the data decodes as LZW
+        self.assertTrue(self.document(data=bytes.fromhex('800B6050220C0C8501')).is_lzw_encoded())
+
+class TestResources(DocumentMixin, unittest.TestCase):
+
+    def setUp(self):
+        # Pages 1 and 2 share resources by reference, pages 3 and 4
+        # have their own copies of the same inline resources
+        image = b'<< /XObject << /Im0 9 0 R >> >>'
+        self.pdf = self.open_document(make_pdf([
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [3 0 R 4 0 R 5 0 R 6 0 R] /Count 4 >>',
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 10 10] /Contents 11 0 R /Resources 7 0 R >>',
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 10 10] /Contents 11 0 R /Resources 7 0 R >>',
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 10 10] /Contents 11 0 R /Resources %s >>' % image,
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 10 10] /Contents 11 0 R /Resources %s >>' % image,
+            b'<< /Font << /F1 8 0 R >> /XObject << /Im0 9 0 R >> >>',
+            b'<< /Type /Font /Subtype /TrueType /BaseFont /Test /FontDescriptor 10 0 R >>',
+            stream(b'/Type /XObject /Subtype /Image /Width 1 /Height 1 /ColorSpace /DeviceGray '
+                   b'/BitsPerComponent 8 /Filter /DCTDecode', b'\xff'),
+            b'<< /Type /FontDescriptor /FontName /Test /FontFile2 12 0 R >>',
+            stream(b'', b'/Im0 Do'),
+            stream(b'', b'font')]))
+
+    def test_table(self):
+        pdf = self.pdf
+
+        self.assertEqual(len(pdf.resource_iterator()), 2)
+        self.assertEqual(pdf.page_resource_ids, [0, 0, 1, 1])
+        # The same resources as read from the pages
+        for pgnum in range(4):
+            self.assertEqual(pdf.get_resource_tree(pgnum), pdf.pages[pgnum]['/Resources'])
+        self.assertEqual(pdf.get_resource_id(4), None)
+
+    def test_checks(self):
+        pdf = self.pdf
+
+        self.assertTrue(pdf.has_font())
+        self.assertTrue(pdf.has_embedded_fonts())
+        self.assertEqual([font['/BaseFont'] for font in pdf.get_embedded_fonts()], ['/Test'])
+
+        # Checked once per resource id, as for each page
+        self.assertEqual([pdf.page_result('scanned', pgnum) for pgnum in range(4)], [False, False, True, True])
+        self.assertEqual([bool(pdf._resource_is_scanned(page['/Resources'])) for page in pdf.pages],
+                         [False, False, True, True])
+        self.assertEqual(len(pdf.resource_scanned), 2)
+
+        self.assertEqual(pdf.get_num_images(), 1)
+        self.assertEqual(pdf.get_image_catalog()[(9, 0)].pages, {1, 2, 3, 4})
+        self.assertEqual([len(pdf.get_page_images(pgnum)) for pgnum in range(1, 5)], [1, 1, 1, 1])
+
+class TestScanned(DocumentMixin, unittest.TestCase):
+
+    def sample(self, npages, budget):
+        pages = pdfstruct.PdfStruct.sample_pages(types.SimpleNamespace(pages=range(npages)), budget)
+        self.assertEqual(pages, sorted(set(pages)))
+        self.assertTrue(all([0 <= pgnum < npages for pgnum in pages]))
+        return pages
+
+    def document(self, fonts):
+        """ Return an untagged document with a page for each of the
+        flags given, with an image and a font if the flag is set,
+        or with the image only, like a scanned page """
+
+        npages = len(fonts)
+        image, font, content = npages + 3, npages + 4, npages + 5
+        pages = [b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 10 10] /Contents %d 0 R '
+                 b'/Resources << %s/XObject << /Im0 %d 0 R >> >> >>' %
+                 (content, b'/Font << /F1 %d 0 R >> ' % font if hasFont else b'', image) for hasFont in fonts]
+
+        return self.open_document(make_pdf([
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join([b'%d 0 R' % (i + 3) for i in range(npages)]),
+                                                         npages)] + pages + [
+            stream(b'/Type /XObject /Subtype /Image /Width 1 /Height 1 /ColorSpace /DeviceGray '
+                   b'/BitsPerComponent 8 /Filter /DCTDecode', b'\xff'),
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+            stream(b'', b'/Im0 Do')]))
+
+    def test_sample_pages(self):
+        # All pages within budget
+        self.assertEqual(self.sample(5, 5), [0, 1, 2, 3, 4])
+        self.assertEqual(self.sample(3, 10), [0, 1, 2])
+        self.assertEqual(self.sample(0, 3), [])
+        self.assertEqual(self.sample(7, 1), [0])
+        self.assertEqual(self.sample(7, 0), [0])
+        # The first page, then the middle of each stratum
+        self.assertEqual(self.sample(10, 3), [0, 5, 8])
+        self.assertEqual(self.sample(10, 9), [0, 1, 2, 3, 5, 6, 7, 8, 9])
+
+        pages = self.sample(1000000, 100)
+        self.assertEqual(len(pages), 100)
+        self.assertEqual(pages[:3], [0, 15000, 25000])
+        self.assertEqual(pages[-1], 995000)
+        # Deterministic
+        self.assertEqual(self.sample(1000000, 100), pages)
+
+    def test_scanned_fraction(self):
+        scansample = config.pdfwamscansample
+        config.pdfwamscansample = 3
+        self.addCleanup(setattr, config, 'pdfwamscansample', scansample)
+
+        # Pages 1, 3 and 5 are sampled
+        pdf = self.document([False]*5)
+        self.assertTrue(pdf.get_is_scanned())
+        self.assertEqual((pdf.scanned_pages, pdf.get_scanned_fraction()), ((3, 3), 1.0))
+
+        # Stops at the first sampled page with text
+        pdf = self.document([False, False, True, False, False])
+        self.assertFalse(pdf.get_is_scanned())
+        self.assertEqual((pdf.scanned_pages, pdf.get_scanned_fraction()), ((1, 2), 0.5))
+
+        # Pages not sampled are not looked at
+        pdf = self.document([False, True, False, False, False])
+        self.assertTrue(pdf.get_is_scanned())
+
+    def test_tagged(self):
+        pdf = self.check_document('wcag.pdf.04/decorative-image.pdf')
+
+        # Tagged documents are not sampled
+        self.assertFalse(pdf.get_is_scanned())
+        self.assertEqual(pdf.get_scanned_fraction(), None)
+
+class TestContentCache(DocumentMixin, unittest.TestCase):
+
+    def test_evict(self):
+        cache = pdfstruct.PdfContentCache(100)
+        cache.add(1, ['a'], 40)
+        cache.add(2, ['b'], 40)
+        # Page 1 is now the most recently used
+        self.assertEqual(cache.get(1), ['a'])
+        cache.add(3, ['c'], 40)
+
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), ['a'])
+        self.assertEqual(cache.get(3), ['c'])
+        self.assertEqual((cache.size, cache.evictions), (80, 1))
+
+        # Too big to be cached
+        cache.add(4, ['d'], 101)
+        self.assertEqual(cache.get(4), None)
+        self.assertEqual(cache.size, 80)
+
+        # Adding again replaces the entry
+        cache.add(3, ['e'], 20)
+        self.assertEqual(cache.get(3), ['e'])
+        self.assertEqual(cache.size, 60)
+
+    def test_hit(self):
+        stream = open(os.path.join(TESTFILES, 'wcag.pdf.04/decorative-image.pdf'), 'rb')
+        self.addCleanup(stream.close)
+        pdf = pdfAWAM.PdfReaderWrapper(stream, logger=helper.get_logger())
+        cache = pdf.content_cache
+
+        operations = pdf.page_operations(0)
+        marked = pdf.marked_content(0)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # The same lists, not parsed or scanned again
+        self.assertTrue(pdf.page_operations(0) is operations)
+        self.assertTrue(pdf.marked_content(0) is marked)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_budget(self):
+        stream = open(os.path.join(TESTFILES, 'wcag.pdf.04/decorative_image_multiple.pdf'), 'rb')
+        self.addCleanup(stream.close)
+        pdf = pdfAWAM.PdfReaderWrapper(stream, logger=helper.get_logger())
+        size = len(pdf.content_stream(0).get_data())
+        # Room for the entries of one page only
+        pdf.content_cache = cache = pdfstruct.PdfContentCache(size)
+
+        pdf.marked_content(0)
+        pdf.page_operations(0)
+        self.assertEqual((len(cache.entries), cache.evictions), (1, 1))
+        self.assertTrue(cache.size <= size)
+
+class TestContentScanner(unittest.TestCase):
+
+    def scan(self, data):
+        """ Return the (operands, operator) scanned from the data,
+        with the operators as strings """
+
+        return [(operands, operator.decode()) for operands, operator in pdfcontent.marked_content_operations(data)]
+
+    def test_literal_strings(self):
+        operations = self.scan(b'/Artifact BMC BT (a \\) b \\( c (nested) \\\\) Tj ET EMC '
+                               b'(EMC \\) BDC) Tj')
+        self.assertEqual(operations, [(['/Artifact'], 'BMC'),
+                                      (['a ) b ( c (nested) \\'], 'Tj'),
+                                      ([], 'EMC')])
+
+    def test_hex_strings_and_comments(self):
+        operations = self.scan(b'/Artifact BMC <41 42> Tj % EMC (\n[<4344>] TJ EMC')
+        self.assertEqual(operations, [(['/Artifact'], 'BMC'), (['AB'], 'Tj'), ([['CD']], 'TJ'), ([], 'EMC')])
+
+    def test_inline_image(self):
+        operations = self.scan(b'q BI /W 2 /H 1 /BPC 8 /CS /G ID \x00EMC) BDC EIx\xff EI Q '
+                               b'/Span <</MCID 1>> BDC /Im0 Do EMC')
+        self.assertEqual(operations, [(['/Span', {'/MCID': 1}], 'BDC'), (['/Im0'], 'Do'), ([], 'EMC')])
+
+    def test_nested_operands(self):
+        operations = self.scan(b'/Artifact <</Attached [/Top /Bottom] /BBox [0 0 [1 (x]) 2] 3] '
+                               b'/Sub <</A <</B (>> EMC)>> >> >> BDC [(a) -120 (b)] TJ EMC')
+        self.assertEqual(operations, [(['/Artifact', {'/Attached': ['/Top', '/Bottom'],
+                                                      '/BBox': [0, 0, [1, 'x]', 2], 3],
+                                                      '/Sub': {'/A': {'/B': '>> EMC'}}}], 'BDC'),
+                                      ([['a', -120, 'b']], 'TJ'),
+                                      ([], 'EMC')])
+
+    def test_marked_content_nesting(self):
+        operations = self.scan(b'/P <</MCID 0>> BDC (text) Tj '
+                               b'/Artifact BMC /Span BMC (a) Tj EMC (b) Tj EMC '
+                               b'(after) Tj EMC EMC (unbalanced) Tj')
+        self.assertEqual([operator for operands, operator in operations],
+                         ['BDC', 'BMC', 'BMC', 'Tj', 'EMC', 'Tj', 'EMC', 'EMC', 'EMC'])
+        # Text is kept inside /Artifact only, nested or not
+        self.assertEqual([operands for operands, operator in operations if operator == 'Tj'], [['a'], ['b']])
+
+    def test_read_non_whitespace(self):
+        stream = io.BytesIO(b' \t\r\n\x00\x0cx ')
+        self.assertEqual(pdfcontent.read_non_whitespace(stream), b'x')
+        self.assertEqual(pdfcontent.read_non_whitespace(stream), b'')
+
+if __name__ == "__main__":
+    unittest.main()
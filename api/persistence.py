@@ -0,0 +1,199 @@
+""" Saving of check results to the database
+
+Connections to SQLite are set up with the pdfwamdb* pragmas as they
+are opened. The journal mode, by default WAL, where readers don't
+block the writer and commits don't wait for a full sync, is kept in
+the database file, so it is only switched to by the processes saving
+results, the server and the job workers, not by every management
+command. Logger rows are saved by a background writer thread, one
+per server process, which commits them in batches, so requests don't
+each take the database lock. If pdfwamdbwait is set, requests wait
+for the batch of their results to be committed; otherwise they
+return as soon as their results are queued, and the rows have no id
+or creation time in the response.
+
+"""
+
+import time
+import queue
+import atexit
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from django.db import connections, transaction
+
+from .models import Logger
+from api.pdf_checker import config
+from api.pdf_checker import helper
+
+def configure_sqlite(sender, connection, **kwargs):
+    """ Set the pdfwamdb* pragmas of a new SQLite connection """
+
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA synchronous=%s' % config.pdfwamdbsynchronous)
+        cursor.execute('PRAGMA busy_timeout=%d' % int(config.pdfwamdbbusytimeout))
+        # Negative sizes are in KB
+        cursor.execute('PRAGMA cache_size=%d' % -int(float(config.pdfwamdbcachesize)*1024))
+
+def set_journal_mode(connection=None):
+    """ Switch the SQLite database of the connection (default that
+    of this thread) to the pdfwamdbjournal journal mode """
+
+    if connection is None:
+        connection = connections['default']
+
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=%s' % config.pdfwamdbjournal)
+
+class ResultWriter(object):
+    """ Background thread saving Logger rows in batches """
+
+    def __init__(self, batch_size, interval):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.logger = helper.get_logger()
+        # Tuples of rows and the future told when they are saved,
+        # and None to stop the thread
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+
+    def save(self, *loggers):
+        """ Queue the Logger rows to be saved, and return a future
+        whose result is the rows once they are committed """
+
+        future = Future()
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='ResultWriter', daemon=True)
+                self.thread.start()
+
+        self.queue.put((loggers, future))
+        return future
+
+    def take(self):
+        """ Wait for rows to save and take up to batch_size of them,
+        waiting interval seconds for more. Returns the items taken
+        and whether the writer is stopping """
+
+        item = self.queue.get()
+        if item is None:
+            return ([], True)
+
+        items = [item]
+        count = len(item[0])
+        deadline = time.monotonic() + self.interval
+
+        while count < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return (items, True)
+            items.append(item)
+            count += len(item[0])
+
+        return (items, False)
+
+    def commit(self, items):
+        """ Save the rows of the items in one transaction """
+
+        with transaction.atomic():
+            Logger.objects.bulk_create([logger for loggers, future in items for logger in loggers])
+
+    def write(self, items):
+        """ Save the rows of the items and tell their futures """
+
+        try:
+            self.commit(items)
+        except Exception as e:
+            if len(items) == 1:
+                self.logger.error('Result writer: could not save results: %s' % str(e))
+                with self.lock:
+                    self.failed += len(items[0][0])
+                items[0][1].set_exception(e)
+                return
+            # Don't fail all the requests for the rows of one
+            for item in items:
+                self.write([item])
+            return
+
+        with self.lock:
+            self.batches += 1
+            self.written += sum(len(loggers) for loggers, future in items)
+
+        for loggers, future in items:
+            future.set_result(loggers)
+
+    def run(self):
+        try:
+            try:
+                set_journal_mode()
+            except Exception as e:
+                self.logger.error('Result writer: could not set the journal mode: %s' % str(e))
+
+            while True:
+                items, stop = self.take()
+                if items:
+                    self.write(items)
+                if stop:
+                    return
+        finally:
+            # The connection of this thread
+            connections.close_all()
+
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'batches': self.batches,
+                    'written': self.written, 'failed': self.failed}
+
+    def close(self):
+        """ Save the rows queued and stop the thread """
+
+        with self.lock:
+            thread = self.thread
+
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join()
+
+# Writer of this process, created on first use
+writer = None
+
+def get_writer():
+    """ Return the writer configured by the pdfwamdb* settings """
+
+    global writer
+
+    if writer is None:
+        writer = ResultWriter(int(config.pdfwamdbbatchsize), float(config.pdfwamdbflushinterval))
+        atexit.register(writer.close)
+
+    return writer
+
+def save(*loggers):
+    """ Save the Logger rows through the writer, waiting
+    for them to be committed if pdfwamdbwait is set """
+
+    future = get_writer().save(*loggers)
+    if int(config.pdfwamdbwait):
+        future.result()
+
+async def save_async(*loggers):
+    """ Like save, without blocking the event loop """
+
+    future = get_writer().save(*loggers)
+    if int(config.pdfwamdbwait):
+        await asyncio.wrap_future(future)
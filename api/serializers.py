@@ -1,10 +1,50 @@
 from rest_framework import serializers
 
-from .models import Logger
+from .models import Logger, Job
 
 class LoggerSerializer(serializers.ModelSerializer):
 
     class Meta: 
 
         model = Logger
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+class LoggerListSerializer(serializers.ModelSerializer):
+
+    class Meta:
+
+        model = Logger
+        exclude = ['accessibility_report']
+
+class JobSerializer(serializers.ModelSerializer):
+
+    job_id = serializers.IntegerField(source='id', read_only=True)
+    queue_time = serializers.SerializerMethodField()
+    process_time = serializers.SerializerMethodField()
+    accessibility_report = serializers.SerializerMethodField()
+
+    class Meta:
+
+        model = Job
+        fields = ['job_id', 'status', 'pdf_url', 'error', 'attempts', 'logger',
+                  'created_at', 'started_at', 'finished_at',
+                  'queue_time', 'process_time', 'accessibility_report']
+
+    def get_queue_time(self, job):
+        """ Seconds the job waited in the queue """
+
+        if job.started_at is None:
+            return None
+        return (job.started_at - job.created_at).total_seconds()
+
+    def get_process_time(self, job):
+        """ Seconds taken to check the document """
+
+        if job.started_at is None or job.finished_at is None:
+            return None
+        return (job.finished_at - job.started_at).total_seconds()
+
+    def get_accessibility_report(self, job):
+        if job.logger is None:
+            return None
+        return job.logger.accessibility_report
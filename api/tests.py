@@ -1,3 +1,470 @@
-from django.test import TestCase
+import os
+import json
+import base64
+import time
+import shutil
+import datetime
+import threading
+import tempfile
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connections
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from .models import Logger, Job
+from . import jobs
+from . import checkpool
+from . import persistence
+from api.pdf_checker import config
+from api.pdf_checker.test_fetch import ServerMixin, PdfHandler
+
+TESTFILES = os.path.join(os.path.dirname(__file__), 'pdf_checker', 'testfiles')
+
+def upload(name='doc.pdf', data=None):
+    """ Return an uploaded file of the test PDF document, or of the given data """
+
+    if data is None:
+        data = PdfHandler.data
+    return SimpleUploadedFile(name, data, content_type='application/pdf')
+
+# Results are saved by the writer thread, on its own connection,
+# so the tests don't run in a transaction
+
+class BatchCheckTest(ServerMixin, TransactionTestCase):
+
+    def test_files(self):
+        response = self.client.post('/api/check-pdf/batch/',
+                                    {'pdf_files': [upload('a.pdf'), upload('b.html', b'<html></html>')]})
+        self.assertEqual(response.status_code, 200)
+
+        results = response.json()['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['pdf_file'], 'a.pdf')
+        self.assertEqual(results[0]['pdf_url'], 'Uploaded file')
+        report = results[0]['accessibility_report']
+        self.assertEqual(report['document']['size'], len(PdfHandler.data))
+        self.assertEqual(results[0]['total'], report['summary']['Total'])
+        self.assertTrue(results[0]['id'])
+        # Errors are reported per document
+        self.assertEqual(sorted(results[1].keys()), ['error', 'pdf_file'])
+        self.assertEqual(results[1]['pdf_file'], 'b.html')
+        self.assertTrue('not a PDF file' in results[1]['error'])
+
+        self.assertEqual(Logger.objects.count(), 1)
+
+    def test_urls_and_files(self):
+        response = self.client.post('/api/check-pdf/batch/',
+                                    {'pdf_urls': [self.url + '/doc.pdf', self.url + '/missing.pdf'],
+                                     'pdf_files': [upload()]})
+        results = response.json()['results']
+
+        self.assertEqual([sorted(result.keys()) for result in results][1], ['error', 'pdf_url'])
+        self.assertEqual([result['pdf_url'] for result in results],
+                         [self.url + '/doc.pdf', self.url + '/missing.pdf', 'Uploaded file'])
+        self.assertEqual(results[0]['accessibility_report'], results[2]['accessibility_report'])
+        self.assertEqual(Logger.objects.count(), 2)
+
+    def test_json(self):
+        response = self.client.post('/api/check-pdf/batch/',
+                                    {'pdf_urls': [self.url + '/doc.pdf']}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['pdf_url'], self.url + '/doc.pdf')
+        self.assertEqual(Logger.objects.get().pdf_url, self.url + '/doc.pdf')
+
+    def test_local_urls(self):
+        path = os.path.join(TESTFILES, 'wcag.pdf.01', 'images-with-and-without-ALT.pdf')
+        response = self.client.post('/api/check-pdf/batch/',
+                                    {'pdf_urls': [path, 'file://' + path, 'ftp://example.com/doc.pdf']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        for result in response.json()['results']:
+            self.assertEqual(sorted(result.keys()), ['error', 'pdf_url'])
+            self.assertTrue(result['error'].startswith('Not an http(s) URL'))
+        self.assertEqual(Logger.objects.count(), 0)
+
+    def test_invalid(self):
+        for data in ({}, {'pdf_urls': []}, {'pdf_urls': [1, 2]}, {'pdf_urls': {'url': 'http://a'}}):
+            response = self.client.post('/api/check-pdf/batch/', data, content_type='application/json')
+            self.assertEqual(response.status_code, 400, data)
+
+        # A single URL is taken as a list of one
+        response = self.client.post('/api/check-pdf/batch/', {'pdf_urls': 'doc.pdf'}, content_type='application/json')
+        self.assertEqual(response.json()['results'], [{'pdf_url': 'doc.pdf', 'error': 'Not an http(s) URL: doc.pdf'}])
+
+        maxitems = config.pdfwambatchmaxitems
+        config.pdfwambatchmaxitems = 2
+        try:
+            response = self.client.post('/api/check-pdf/batch/', {'pdf_urls': ['http://a', 'http://b', 'http://c']},
+                                        content_type='application/json')
+        finally:
+            config.pdfwambatchmaxitems = maxitems
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('At most 2' in response.json()['error'])
+
+class JobTest(ServerMixin, TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.jobfolder = config.pdfwamjobfolder
+        config.pdfwamjobfolder = self.folder
+
+    def tearDown(self):
+        config.pdfwamjobfolder = self.jobfolder
+        shutil.rmtree(self.folder)
+
+    def test_password(self):
+        job = jobs.enqueue(pdf_url=self.url + '/doc.pdf', password='secret')
+        stored = Job.objects.filter(id=job.id).values_list('password', flat=True).get()
+
+        self.assertFalse('secret' in stored)
+        self.assertEqual(jobs.decrypt_password(stored), 'secret')
+        self.assertNotEqual(jobs.encrypt_password('secret'), stored)
+        self.assertEqual(jobs.encrypt_password(''), '')
+        self.assertRaises(ValueError, jobs.decrypt_password, stored[:-4] + 'AAAA')
+
+    def test_claim(self):
+        first = jobs.enqueue(pdf_url=self.url + '/doc.pdf')
+        second = jobs.enqueue(pdf_file=upload())
+        self.assertTrue(second.pdf_file.startswith(self.folder))
+        self.assertTrue(os.path.isfile(second.pdf_file))
+
+        job = jobs.claim_job()
+        self.assertEqual((job.id, job.status, job.attempts), (first.id, Job.RUNNING, 1))
+        self.assertTrue(job.started_at is not None)
+        self.assertEqual(job.heartbeat_at, job.started_at)
+        self.assertEqual(jobs.claim_job().id, second.id)
+        self.assertEqual(jobs.claim_job(), None)
+
+    def test_requeue_stale(self):
+        for name in ('doc.pdf', 'other.pdf', 'etag.pdf', 'slow.pdf'):
+            jobs.enqueue(pdf_url=self.url + '/' + name, password='secret')
+        stale, retried, running, slow = [jobs.claim_job() for i in range(4)]
+
+        old = timezone.now() - datetime.timedelta(minutes=float(config.pdfwamjobtimeout) + 1)
+        Job.objects.filter(id__in=[stale.id, retried.id]).update(started_at=old, heartbeat_at=old)
+        Job.objects.filter(id=retried.id).update(attempts=int(config.pdfwamjobattempts))
+        # Running for long, but its worker is alive
+        Job.objects.filter(id=slow.id).update(started_at=old)
+
+        self.assertEqual(jobs.requeue_stale(), 1)
+        for job in (stale, retried, running, slow):
+            job.refresh_from_db()
+
+        self.assertEqual((stale.status, stale.started_at, stale.heartbeat_at), (Job.QUEUED, None, None))
+        self.assertNotEqual(stale.password, '')
+        # Failed after its last attempt, without its password
+        self.assertEqual((retried.status, retried.error, retried.password), (Job.FAILED, 'Check did not finish', ''))
+        self.assertEqual(running.status, Job.RUNNING)
+        self.assertEqual(slow.status, Job.RUNNING)
+
+    def test_run_job(self):
+        jobs.enqueue(pdf_file=upload(), password='secret')
+        job = jobs.claim_job()
+
+        self.assertFalse(jobs.run_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error, job.password), (Job.DONE, '', ''))
+        self.assertFalse(os.path.exists(job.pdf_file))
+        self.assertEqual(job.logger.pdf_url, 'Uploaded file')
+        self.assertEqual(job.logger.size, len(PdfHandler.data))
+        self.assertTrue(job.finished_at is not None)
+
+    def test_run_job_failed(self):
+        jobs.enqueue(pdf_url=self.url + '/missing.pdf', password='secret')
+        job = jobs.claim_job()
+        jobs.run_job(job)
+        job.refresh_from_db()
+
+        self.assertEqual((job.status, job.password, job.logger), (Job.FAILED, '', None))
+        self.assertTrue('404' in job.error)
+
+        # Encrypted with another key
+        jobs.enqueue(pdf_url=self.url + '/doc.pdf')
+        job = jobs.claim_job()
+        job.password = 'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+        jobs.run_job(job)
+        job.refresh_from_db()
+
+        self.assertEqual((job.status, job.password), (Job.FAILED, ''))
+        self.assertEqual(job.error, 'The password of the job could not be decrypted')
+
+class JobHeartbeatTest(TransactionTestCase):
+
+    def test_heartbeat(self):
+        jobs.enqueue(pdf_url='http://example.com/doc.pdf')
+        job = jobs.claim_job()
+        old = timezone.now() - datetime.timedelta(minutes=float(config.pdfwamjobtimeout) + 1)
+        Job.objects.filter(id=job.id).update(started_at=old, heartbeat_at=old)
+
+        interval = config.pdfwamjobheartbeat
+        config.pdfwamjobheartbeat = 0.05
+        stop = threading.Event()
+        thread = threading.Thread(target=jobs.heartbeat, args=(job.id, stop))
+        try:
+            thread.start()
+            time.sleep(0.5)
+        finally:
+            stop.set()
+            thread.join()
+            config.pdfwamjobheartbeat = interval
+
+        job.refresh_from_db()
+        self.assertTrue(job.heartbeat_at > old + datetime.timedelta(minutes=1))
+        # Not stale, as its worker is alive
+        self.assertEqual(jobs.requeue_stale(), 0)
+
+class AsyncCheckTest(ServerMixin, TransactionTestCase):
+
+    def setUp(self):
+        # One worker and one waiting check
+        self.pool = checkpool.pool = checkpool.CheckPool(1, 1)
+
+    def tearDown(self):
+        if self.pool.pool is not None:
+            self.pool.pool.close()
+        checkpool.pool = None
+
+    async def test_admission(self):
+        # Take the room of the pool
+        self.assertTrue(self.pool.admit())
+        self.assertTrue(self.pool.admit())
+
+        response = await self.async_client.post('/api/check-pdf/async/', {'pdf_file': upload()})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(config.pdfwamasyncretryafter))
+
+        stats = (await self.async_client.get('/api/check-pdf/async/stats/')).json()
+        self.assertEqual((stats['admitted'], stats['rejected'], stats['completed']), (2, 1, 0))
+
+        # Admitted again once there is room
+        self.pool.release()
+        response = await self.async_client.post('/api/check-pdf/async/', {'pdf_file': upload()})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['size'], len(PdfHandler.data))
+
+        stats = (await self.async_client.get('/api/check-pdf/async/stats/')).json()
+        self.assertEqual((stats['admitted'], stats['rejected'], stats['completed']), (1, 1, 2))
+        self.assertEqual((stats['in_flight'], stats['queued'], stats['fetching']), (0, 0, 0))
+
+    async def test_invalid(self):
+        response = await self.async_client.get('/api/check-pdf/async/')
+        self.assertEqual(response.status_code, 405)
+        response = await self.async_client.post('/api/check-pdf/async/', {'pdf_url': '/etc/passwd'})
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.post('/api/check-pdf/async/', {})
+        self.assertEqual(response.status_code, 400)
+        for body in ('{"pdf_url": ', '["http://example.com/doc.pdf"]', '{"pdf_url": ["http://example.com/doc.pdf"]}'):
+            response = await self.async_client.post('/api/check-pdf/async/', body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.pool.stats()['admitted'], 0)
+
+    async def test_json(self):
+        response = await self.async_client.post('/api/check-pdf/async/',
+                                                {'pdf_url': self.url + '/doc.pdf', 'password': ''},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual(data['pdf_url'], self.url + '/doc.pdf')
+        self.assertEqual(data['size'], len(PdfHandler.data))
+
+class ListLoggersTest(TestCase):
+
+    def setUp(self):
+        # Ties on the process time, and a row without metrics
+        times = [1.0, 2.0, 2.0, 2.0, 2.0, 3.0, None, 2.0]
+        Logger.objects.bulk_create([Logger(pdf_url='http://example.com/%d.pdf' % i, process_time=t,
+                                           pages=i, content_hash=('%064x' % (i % 2)))
+                                    for i, t in enumerate(times)])
+        self.ids = list(Logger.objects.order_by('id').values_list('id', flat=True))
+
+    def list_all(self, **params):
+        """ Return the rows of all the pages of the listing, asking for
+        two per page, and the number of pages """
+
+        rows, pages = [], 0
+        params['limit'] = 2
+        while True:
+            response = self.client.get('/api/loggers', params)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            rows += data['results']
+            pages += 1
+            if data['next'] is None:
+                return rows, pages
+            params['cursor'] = data['next']
+
+    def test_ties(self):
+        rows, pages = self.list_all(order='-process_time')
+        ids = [row['id'] for row in rows]
+
+        # No row skipped or repeated, ties in descending id order
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(ids, [row.id for row in Logger.objects.exclude(process_time=None).order_by('-process_time', '-id')])
+        self.assertEqual(pages, 4)
+
+        rows, pages = self.list_all(order='process_time')
+        self.assertEqual([row['id'] for row in rows],
+                         [row.id for row in Logger.objects.exclude(process_time=None).order_by('process_time', 'id')])
+
+    def test_created_at_ties(self):
+        Logger.objects.update(created_at=timezone.now())
+        rows, pages = self.list_all()
+        self.assertEqual([row['id'] for row in rows], list(reversed(self.ids)))
+        self.assertFalse('accessibility_report' in rows[0])
+
+    def test_filters(self):
+        rows, pages = self.list_all(order='-process_time', min_process_time=2, max_process_time=2.5)
+        self.assertEqual(sorted([row['id'] for row in rows]), [self.ids[i] for i in (1, 2, 3, 4, 7)])
+
+        rows, pages = self.list_all(content_hash='%064x' % 1, min_pages=3)
+        self.assertEqual([row['pages'] for row in rows], [7, 5, 3])
+
+        response = self.client.get('/api/loggers', {'limit': 1000})
+        self.assertEqual(len(response.json()['results']), len(self.ids))
+        self.assertEqual(response.json()['next'], None)
+
+    def test_invalid(self):
+        cursors = ['zzz', base64.urlsafe_b64encode(b'5').decode(), base64.urlsafe_b64encode(b'["x", 1]').decode()]
+        for params in [{'order': 'pdf_url'}, {'order': '-accessibility_report'}, {'limit': 'x'},
+                       {'min_pages': 'abc'}, {'max_process_time': 'slow'}, {'min_created_at': 'nope'}] + \
+                      [{'cursor': cursor} for cursor in cursors]:
+            response = self.client.get('/api/loggers', params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertTrue('error' in response.json())
+
+        # A cursor of another order
+        cursor = base64.urlsafe_b64encode(json.dumps([2.0, self.ids[-1]]).encode()).decode()
+        response = self.client.get('/api/loggers', {'cursor': cursor})
+        self.assertEqual(response.status_code, 400)
+
+class ResultWriterTest(TransactionTestCase):
+
+    def setUp(self):
+        self.writers = []
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.close()
+
+    def writer(self, batch_size, interval):
+        writer = persistence.ResultWriter(batch_size, interval)
+        self.writers.append(writer)
+        return writer
+
+    def logger(self, pdf_url='http://example.com/doc.pdf'):
+        return Logger(pdf_url=pdf_url, accessibility_report={})
+
+    def test_batch_size(self):
+        # Written once the batch is full, without waiting the interval
+        writer = self.writer(3, 60)
+        start = time.time()
+        futures = [writer.save(self.logger()) for i in range(3)]
+        for future in futures:
+            self.assertTrue(future.result(10)[0].id)
+
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(writer.stats(), {'queued': 0, 'batches': 1, 'written': 3, 'failed': 0})
+        self.assertEqual(Logger.objects.count(), 3)
+
+    def test_interval(self):
+        writer = self.writer(100, 0.2)
+        start = time.time()
+        loggers = writer.save(self.logger(), self.logger()).result(10)
+
+        self.assertTrue(0.15 <= time.time() - start < 10)
+        self.assertEqual(len(loggers), 2)
+        self.assertEqual(writer.stats()['batches'], 1)
+
+        # The next batch starts with the next row
+        writer.save(self.logger()).result(10)
+        self.assertEqual(writer.stats()['batches'], 2)
+
+    def test_failed_batch(self):
+        writer = self.writer(2, 60)
+        # A row the database refuses, in the batch of a good one
+        bad = writer.save(self.logger(None))
+        good = writer.save(self.logger())
+
+        self.assertRaises(IntegrityError, bad.result, 10)
+        self.assertTrue(good.result(10)[0].id)
+
+        # The writer keeps going
+        self.assertTrue(writer.thread.is_alive())
+        writer.save(self.logger(), self.logger())
+        writer.close()
+        self.assertEqual(writer.stats(), {'queued': 0, 'batches': 2, 'written': 3, 'failed': 1})
+        self.assertEqual(Logger.objects.count(), 3)
+
+    def test_close(self):
+        # Rows queued are written before the thread stops
+        writer = self.writer(100, 60)
+        futures = [writer.save(self.logger()) for i in range(5)]
+        writer.close()
+
+        self.assertFalse(writer.thread.is_alive())
+        self.assertTrue(all([future.done() for future in futures]))
+        self.assertEqual(Logger.objects.count(), 5)
+
+    def test_no_wait(self):
+        wait = config.pdfwamdbwait
+        config.pdfwamdbwait = 0
+        try:
+            logger = self.logger()
+            persistence.save(logger)
+            persistence.get_writer().close()
+        finally:
+            config.pdfwamdbwait = wait
+            persistence.writer = None
+
+        self.assertTrue(logger.id)
+        self.assertEqual(Logger.objects.get().id, logger.id)
+
+class SqliteTest(TestCase):
+
+    def connect(self, path):
+        """ Return a new connection to the SQLite database at path """
+
+        connection = DatabaseWrapper(dict(connections['default'].settings_dict, NAME=path), alias='pragmas')
+        self.addCleanup(connection.close)
+        connection.ensure_connection()
+        return connection
+
+    def pragma(self, connection, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        path = os.path.join(folder, 'wal.sqlite3')
+        connection = self.connect(path)
+        # Left to the processes saving results
+        self.assertEqual(self.pragma(connection, 'journal_mode'), 'delete')
+        # NORMAL
+        self.assertEqual(self.pragma(connection, 'synchronous'), 1)
+        self.assertEqual(self.pragma(connection, 'busy_timeout'), int(config.pdfwamdbbusytimeout))
+        self.assertEqual(self.pragma(connection, 'cache_size'), -int(float(config.pdfwamdbcachesize)*1024))
+
+        synchronous = config.pdfwamdbsynchronous
+        config.pdfwamdbsynchronous = 'FULL'
+        try:
+            connection = self.connect(os.path.join(folder, 'full.sqlite3'))
+        finally:
+            config.pdfwamdbsynchronous = synchronous
+        self.assertEqual(self.pragma(connection, 'synchronous'), 2)
+
+    def test_journal_mode(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'wal.sqlite3')
+
+        persistence.set_journal_mode(self.connect(path))
+        # Kept in the database file
+        self.assertEqual(self.pragma(self.connect(path), 'journal_mode'), 'wal')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(20)[18:20], b'\x02\x02')
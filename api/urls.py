@@ -1,6 +1,12 @@
 from django.urls import path
-from .views import check_pdf
+from .views import check_pdf, check_pdf_batch, create_job, job_status, check_pdf_async, check_pdf_async_stats, list_loggers
 
 urlpatterns = [
     path('check-pdf/', check_pdf, name='check_pdf'),
+    path('check-pdf/batch/', check_pdf_batch, name='check_pdf_batch'),
+    path('check-pdf/async/', check_pdf_async, name='check_pdf_async'),
+    path('check-pdf/async/stats/', check_pdf_async_stats, name='check_pdf_async_stats'),
+    path('loggers', list_loggers, name='list_loggers'),
+    path('jobs/', create_job, name='create_job'),
+    path('jobs/<int:job_id>/', job_status, name='job_status'),
 ]
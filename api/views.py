@@ -1,10 +1,23 @@
+import json
+import time
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.utils.dateparse import parse_datetime
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from .serializers import LoggerSerializer
-from api.pdf_checker.check_accessibility import check_accessibility
-import tempfile
-import os
+from .models import Logger, Job, report_metrics
+from .serializers import LoggerSerializer, LoggerListSerializer, JobSerializer
+from . import jobs
+from . import persistence
+from .checkpool import get_pool
+from api.pdf_checker import config
+from api.pdf_checker import pdfpool
+from api.pdf_checker.pdffetch import open_upload, is_url
 
 @api_view(['POST'])
 def check_pdf(request):
@@ -21,34 +34,312 @@ def check_pdf(request):
         return Response({"error": "Either pdf_url or pdf_file is required."}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
+        start = time.time()
+
         # If pdf_url is provided, use it to perform the check
         if pdf_url:
-            accessibility_report = check_accessibility(pdf_url, password=password)
+            accessibility_report = pdfpool.check(pdf_url, password=password)
         
-        # If pdf_file is provided, save it to a temporary file for checking
+        # If pdf_file is provided, check it in place: large uploads are
+        # memory mapped from the temporary file Django spooled them to,
+        # small ones are read from memory
         elif pdf_file:
-            # Save the uploaded file to a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                tmp_file.write(pdf_file.read())
-                tmp_file_path = tmp_file.name
-
-            # Perform the check using the file's path
-            accessibility_report = check_accessibility(tmp_file_path, password=password)
-
-            # Delete the temporary file after processing
-            os.remove(tmp_file_path)
+            stream = open_upload(pdf_file)
+            try:
+                accessibility_report = pdfpool.check(stream, password=password)
+            finally:
+                stream.close()
 
         # Save the result using the LoggerSerializer (optional)
         serializer = LoggerSerializer(data={
             "pdf_url": pdf_url if pdf_url else "Uploaded file",
-            "accessibility_report": accessibility_report
+            "accessibility_report": accessibility_report,
+            **report_metrics(accessibility_report, time.time() - start)
         })
 
         if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            logger = Logger(**serializer.validated_data)
+            persistence.save(logger)
+            return Response(LoggerSerializer(logger).data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def check_item(source, password):
+    """ Check one document of a batch, a URL or an uploaded file,
+    and return a tuple of its report, error message and the seconds
+    the check took """
+
+    start = time.time()
+
+    try:
+        if isinstance(source, str):
+            # Don't let clients check files on the server
+            if not is_url(source):
+                return (None, "Not an http(s) URL: %s" % source, 0.0)
+            accessibility_report = pdfpool.check(source, password=password)
+        else:
+            stream = open_upload(source)
+            try:
+                accessibility_report = pdfpool.check(stream, password=password)
+            finally:
+                stream.close()
+    except Exception as e:
+        return (None, str(e), time.time() - start)
+
+    return (accessibility_report, None, time.time() - start)
+
+@api_view(['POST'])
+def check_pdf_batch(request):
+    # URLs, as a JSON list or as repeated form fields
+    if hasattr(request.data, 'getlist'):
+        pdf_urls = request.data.getlist("pdf_urls")
+    else:
+        pdf_urls = request.data.get("pdf_urls", [])
+        if isinstance(pdf_urls, str):
+            pdf_urls = [pdf_urls]
+
+    # Uploaded files, as repeated pdf_files fields
+    pdf_files = request.FILES.getlist("pdf_files")
+
+    password = request.data.get("password", "")
+
+    if not isinstance(pdf_urls, list) or not all(isinstance(url, str) for url in pdf_urls):
+        return Response({"error": "pdf_urls must be a list of URLs."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if not pdf_urls and not pdf_files:
+        return Response({"error": "Either pdf_urls or pdf_files is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    maxitems = int(config.pdfwambatchmaxitems)
+    if len(pdf_urls) + len(pdf_files) > maxitems:
+        return Response({"error": "At most %d documents can be checked per request." % maxitems},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    sources = pdf_urls + pdf_files
+
+    # Check the documents concurrently, downloads of some
+    # overlapping the checks of others
+    with ThreadPoolExecutor(max_workers=int(config.pdfwambatchworkers)) as executor:
+        futures = [executor.submit(check_item, source, password) for source in sources]
+        outcomes = [future.result() for future in futures]
+
+    results = []
+    loggers = []
+    for source, (accessibility_report, error, process_time) in zip(sources, outcomes):
+        if isinstance(source, str):
+            item = {"pdf_url": source}
+        else:
+            item = {"pdf_file": source.name}
+
+        if error is None:
+            logger = Logger(pdf_url=item.get("pdf_url", "Uploaded file"),
+                            accessibility_report=accessibility_report,
+                            **report_metrics(accessibility_report, process_time))
+            loggers.append((item, logger))
+        else:
+            item["error"] = error
+
+        results.append(item)
+
+    # Save all the results at once
+    persistence.save(*[logger for item, logger in loggers])
+
+    for item, logger in loggers:
+        item.update(LoggerSerializer(logger).data)
+
+    return Response({"results": results}, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+def create_job(request):
+    # Takes the same data as check_pdf, but only queues the
+    # check and returns the job to poll for its result
+    pdf_url = request.data.get("pdf_url")
+    pdf_file = request.FILES.get("pdf_file")
+    password = request.data.get("password", "")
+
+    if not pdf_url and not pdf_file:
+        return Response({"error": "Either pdf_url or pdf_file is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Don't let clients check files on the server
+    if pdf_url and not is_url(pdf_url):
+        return Response({"error": "pdf_url must be an http(s) URL."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if pdf_url:
+        job = jobs.enqueue(pdf_url=pdf_url, password=password)
+    else:
+        job = jobs.enqueue(pdf_file=pdf_file, password=password)
+
+    return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['GET'])
+def job_status(request, job_id):
+    try:
+        job = Job.objects.select_related('logger').get(id=job_id)
+    except Job.DoesNotExist:
+        return Response({"error": "No such job."}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response(JobSerializer(job).data)
+
+@csrf_exempt
+async def check_pdf_async(request):
+    # Async variant of check_pdf for ASGI servers. Fetches
+    # without blocking and checks in a bounded process pool,
+    # turning requests away when the pool is full
+    if request.method != 'POST':
+        return JsonResponse({"error": "Method not allowed."}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    # Form data or a JSON object, like check_pdf takes
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError as e:
+            return JsonResponse({"error": "JSON parse error - %s" % str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(data, dict):
+            return JsonResponse({"error": "The JSON body must be an object."}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        data = request.POST
+
+    pdf_url = data.get("pdf_url")
+    pdf_file = request.FILES.get("pdf_file")
+    password = data.get("password", "")
+
+    if not pdf_url and not pdf_file:
+        return JsonResponse({"error": "Either pdf_url or pdf_file is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Don't let clients check files on the server
+    if pdf_url and not (isinstance(pdf_url, str) and is_url(pdf_url)):
+        return JsonResponse({"error": "pdf_url must be an http(s) URL."}, status=status.HTTP_400_BAD_REQUEST)
+
+    pool = get_pool()
+    if not pool.admit():
+        response = JsonResponse({"error": "Too many checks in progress, try again later."},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response["Retry-After"] = str(config.pdfwamasyncretryafter)
+        return response
+
+    try:
+        start = time.time()
+
+        if pdf_url:
+            accessibility_report = await pool.check_url(pdf_url, password)
+        else:
+            stream = open_upload(pdf_file)
+            try:
+                accessibility_report = await pool.check_stream(stream, password)
+            finally:
+                stream.close()
+
+        serializer = LoggerSerializer(data={
+            "pdf_url": pdf_url if pdf_url else "Uploaded file",
+            "accessibility_report": accessibility_report,
+            **report_metrics(accessibility_report, time.time() - start)
+        })
+
+        if serializer.is_valid():
+            logger = Logger(**serializer.validated_data)
+            await persistence.save_async(logger)
+            return JsonResponse(LoggerSerializer(logger).data, status=status.HTTP_201_CREATED)
+
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    finally:
+        pool.release()
+
+@api_view(['GET'])
+def check_pdf_async_stats(request):
+    # Queue depth and in-flight counts of the async check
+    # pool of this server process
+    return Response(get_pool().stats())
+
+# Columns the loggers can be sorted and filtered on
+LOGGER_COLUMNS = ('created_at', 'process_time', 'size', 'pages', 'total', 'failed', 'passed')
+
+def encode_cursor(value, id):
+    """ Encode the position after the row with the given sort value and id """
+
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, column):
+    """ Return the sort value and id of a cursor, for the given sort column """
+
+    value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if column == 'created_at':
+        value = parse_datetime(value)
+        if value is None:
+            raise ValueError('Invalid cursor')
+    return (value, int(id))
+
+@api_view(['GET'])
+def list_loggers(request):
+    # Lists the loggers without their reports, sorted by one of
+    # LOGGER_COLUMNS ("order", default newest first) and filtered
+    # by ranges of them ("min_<column>", "max_<column>") and by
+    # content_hash. Pages are fetched with the "next" cursor of
+    # the previous page (keyset pagination), so deep pages cost
+    # as little as the first one
+    params = request.query_params
+
+    order = params.get("order", "-created_at")
+    column = order.lstrip("-")
+    descending = order.startswith("-")
+    if column not in LOGGER_COLUMNS:
+        return Response({"error": "order must be one of %s, optionally prefixed with -." % ", ".join(LOGGER_COLUMNS)},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = int(params.get("limit", config.pdfwamlistsize))
+    except ValueError:
+        return Response({"error": "limit must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, int(config.pdfwamlistmaxsize)))
+
+    loggers = Logger.objects.defer("accessibility_report")
+
+    try:
+        for name in LOGGER_COLUMNS:
+            for prefix, lookup in (("min_", "gte"), ("max_", "lte")):
+                value = params.get(prefix + name)
+                if value is not None:
+                    loggers = loggers.filter(**{"%s__%s" % (name, lookup): value})
+    except (ValueError, TypeError, ValidationError):
+        return Response({"error": "Invalid filter value."}, status=status.HTTP_400_BAD_REQUEST)
+
+    content_hash = params.get("content_hash")
+    if content_hash:
+        loggers = loggers.filter(content_hash=content_hash)
+
+    # Rows logged without metrics have no place in their order
+    if column != "created_at":
+        loggers = loggers.filter(**{column + "__isnull": False})
+
+    comparison = "lt" if descending else "gt"
+    cursor = params.get("cursor")
+    if cursor:
+        try:
+            value, last_id = decode_cursor(cursor, column)
+        except (ValueError, TypeError):
+            return Response({"error": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST)
+
+        loggers = loggers.filter(Q(**{"%s__%s" % (column, comparison): value}) |
+                                 Q(**{column: value, "id__" + comparison: last_id}))
+
+    if descending:
+        loggers = loggers.order_by("-" + column, "-id")
+    else:
+        loggers = loggers.order_by(column, "id")
+
+    # One more to tell if there is a next page
+    rows = list(loggers[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], column), rows[-1].id)
+
+    return Response({"results": LoggerListSerializer(rows, many=True).data, "next": next_cursor})